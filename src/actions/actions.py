@@ -0,0 +1,129 @@
+#!/usr/local/sbin/charm-env python3
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+
+# Load modules from $CHARM_DIR/lib
+sys.path.append('lib')
+
+from charms.layer import basic
+basic.bootstrap_charm_deps()
+basic.init_config_states()
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.unitdata as unitdata
+import charms_openstack.charm
+
+# This charm's library contains all of the handler code associated with
+# manila -- we need to import it to get the definitions for the charm.
+import charm.openstack.manila_generic  # noqa
+import charm.openstack.profiling as profiling
+import charm.openstack.share_latency as share_latency
+
+
+def refresh_config(*args):
+    """Render the configuration and publish it to the principal charm,
+    ignoring the fingerprint of the last published configuration.
+    """
+    if charm.openstack.manila_generic.principal_auth_data() is None:
+        hookenv.action_fail("The manila-plugin relation is not available")
+        return
+    with charms_openstack.charm.provide_charm_instance() as generic_charm:
+        generic_charm.publish_config_to_principal(force=True)
+    unitdata.kv().flush()
+    hookenv.action_set({'outcome': 'configuration published'})
+
+
+def profile_summary(*args):
+    """Summarise the hook profile records as percentiles per hook and per
+    stage.
+    """
+    summary = profiling.summarise(
+        profiling.read_records(),
+        revision=hookenv.action_get('revision') or None)
+    hookenv.action_set({'summary': json.dumps(summary, sort_keys=True)})
+
+
+def rotate_ssh_keys(*args):
+    """Generate a new generation of the SSH keys on the leader, install it and
+    publish the configuration that uses it.  The other units do the same when
+    the leader settings change.  The action fails if the configuration
+    couldn't be published, though the keys are still rotated.
+    """
+    if not hookenv.is_leader():
+        hookenv.action_fail("Only the leader can rotate the SSH keys")
+        return
+    with charms_openstack.charm.provide_charm_instance() as generic_charm:
+        if generic_charm.options.computed_define_ssh:
+            hookenv.action_fail("The SSH keys are set by config; change "
+                                "'driver-service-ssh-key' and "
+                                "'driver-service-ssh-key-public' instead")
+            return
+        keys = charm.openstack.manila_generic.rotate_ssh_keys(
+            prune=bool(hookenv.action_get('prune-previous')))
+        generic_charm.maybe_write_ssh_keys()
+        if charm.openstack.manila_generic.principal_auth_data() is None:
+            failure = ("The manila-plugin relation is not available to "
+                       "publish the configuration to")
+        elif not generic_charm.publish_config_to_principal():
+            failure = ("The configuration that uses the new SSH keys wasn't "
+                       "published to the principal charm")
+        else:
+            failure = None
+    unitdata.kv().flush()
+    hookenv.action_set({'generation': keys['current']})
+    if failure is not None:
+        hookenv.action_fail(failure)
+
+
+def share_server_latency(*args):
+    """Report the latency and failures of the generic driver's stages from
+    the manila-share log.
+    """
+    since, until = share_latency.window(
+        since=hookenv.action_get('since') or None,
+        until=hookenv.action_get('until') or None)
+    lines = share_latency.read_lines(share_latency.log_files(), since=since)
+    report = share_latency.measure(lines, since, until)
+    hookenv.action_set({'report': json.dumps(report, sort_keys=True)})
+
+
+# Actions to function mapping, to allow for illegal python action names that
+# can map to a python function.
+ACTIONS = {
+    'profile-summary': profile_summary,
+    'refresh-config': refresh_config,
+    'rotate-ssh-keys': rotate_ssh_keys,
+    'share-server-latency': share_server_latency,
+}
+
+
+def main(args):
+    action_name = os.path.basename(args[0])
+    try:
+        action = ACTIONS[action_name]
+    except KeyError:
+        return "Action {} undefined".format(action_name)
+    else:
+        try:
+            action(args)
+        except Exception as e:
+            hookenv.action_fail(str(e))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,106 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Writing the charm's files.  This only uses the standard library and
+# charmhelpers.core, so that the metrics can be written by the update-status
+# hook without loading the rest of the charm (see status.py).
+
+import grp
+import hashlib
+import os
+import pwd
+import stat
+import tempfile
+import textwrap
+
+import charmhelpers.core.hookenv as hookenv
+
+
+def remove_file(file):
+    """Remove the file, if it exists.
+
+    :param file: the file to remove.
+    :returns: boolean, True if the file was removed.
+    """
+    try:
+        os.remove(file)
+    except OSError:
+        return False
+    return True
+
+
+def write_file(contents, file, chown=0o600, owner=None, group=None):
+    """Write the contents to the file, unless the file already has those
+    contents, mode and ownership.
+
+    The file is replaced atomically: the contents are written to a temporary
+    file in the same directory, which is fsync'd and then renamed over the
+    file, so that the file is never seen partially written.
+
+    :param contents: the contents to write.  This will be dedented, and striped
+        to ensure that it is just a set of lines.
+    :param file: the file to write
+    :param chown: the mode for the file.
+    :param owner: the user to own the file; if None, the owner of the existing
+        file is kept (or, for a new file, the user writing it).
+    :param group: the group to own the file; as for owner.
+    :returns: boolean, True if the file was changed.
+    """
+    data = textwrap.dedent(contents).encode('utf-8')
+    try:
+        uid = pwd.getpwnam(owner).pw_uid if owner is not None else -1
+        gid = grp.getgrnam(group).gr_gid if group is not None else -1
+        try:
+            st = os.stat(file)
+            with open(file, 'rb') as f:
+                current = hashlib.sha256(f.read()).digest()
+        except FileNotFoundError:
+            pass
+        else:
+            if uid == -1:
+                uid = st.st_uid
+            if gid == -1:
+                gid = st.st_gid
+            if (current == hashlib.sha256(data).digest() and
+                    stat.S_IMODE(st.st_mode) == chown and
+                    (st.st_uid, st.st_gid) == (uid, gid)):
+                return False
+        directory = os.path.dirname(file) or '.'
+        fd, tmp = tempfile.mkstemp(
+            dir=directory, prefix='.{}.'.format(os.path.basename(file)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                os.fchmod(f.fileno(), chown)
+                if (uid, gid) != (-1, -1):
+                    os.fchown(f.fileno(), uid, gid)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, file)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        # Make the rename itself durable.
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except (OSError, KeyError) as e:
+        hookenv.log("Couldn't write file: {}".format(str(e)))
+        return False
+    return True
@@ -16,23 +16,343 @@
 # bare functions are provided to the reactive handlers to perform the functions
 # needed on the class.
 
+import collections
+import glob
+import hashlib
+import json
 import os
-import textwrap
+import tempfile
+import types
 
-import charmhelpers.contrib.openstack.templating as os_templating
 import charmhelpers.core.hookenv as hookenv
-import charmhelpers.core.templating
+import charmhelpers.core.unitdata as unitdata
 import charms_openstack.charm
 import charms_openstack.adapters
-import charms.reactive.relations as relations
+
+import charm.openstack.files as files
+import charm.openstack.metrics as metrics
+import charm.openstack.profiling as profiling
+import charm.openstack.status as status
+import charm.openstack.validation as validation
+
+# NOTE: jinja2, charmhelpers.contrib.openstack.templating and
+# charms.reactive.relations are only needed to render the configuration, and
+# so are imported where they are used.  charms.openstack imports them anyway,
+# so the update-status hook, which never renders anything, sets the saved
+# status without importing this module at all (see status.py).
 
 # There are no additional packages to install.
 PACKAGES = []
 MANILA_DIR = '/etc/manila/'
 MANILA_CONF = MANILA_DIR + "manila.conf"
 
+# The formats that the configuration may be sent to the principal charm in;
+# see principal_payload().
+PAYLOAD_FORMATS = ('string', 'structured', 'both')
+# The values of 'client-endpoint-type', the endpoint interfaces that manila's
+# nova, neutron and cinder clients may use; empty means manila's default.
+ENDPOINT_TYPES = ('', 'publicURL', 'internalURL', 'adminURL')
+# The key of the structured configuration in the relation payload, and the
+# version of its format.
+STRUCTURED_PAYLOAD_KEY = MANILA_CONF + ':sections'
+STRUCTURED_PAYLOAD_VERSION = 1
+# The sections of manila.conf that the backends are rendered alongside, which
+# a backend's section can't be named.
+RESERVED_SECTIONS = ('DEFAULT', 'nova', 'neutron', 'cinder')
+
 MANILA_SSH_KEY_PATH = '/etc/manila/ssh_image_key'
 MANILA_SSH_KEY_PATH_PUBLIC = '/etc/manila/ssh_image_key.pub'
+# If the driver uses SSH and the keys aren't set by config, the leader
+# generates them and shares them with the other units in this leader setting,
+# as JSON:
+#
+#     {"current": <generation>,
+#      "keys": {"<generation>": {"private": <key>, "public": <key>}, ...}}
+#
+# Each generation of the keys is installed at its own path, with the
+# generation appended, and is uploaded to nova as its own keypair.  manila
+# records the path of the private key with each share server it creates, so
+# the share servers created before the keys were rotated keep using the keys
+# they were created with.
+SSH_KEYS_LEADER_KEY = 'ssh-keys'
+GENERATED_SSH_KEY_PATH = '/etc/manila/ssh_image_key-{}'
+# The generated key files are owned by the user that manila-share runs as, so
+# that it can read them.
+GENERATED_SSH_KEY_OWNER = 'manila'
+
+TEMPLATES_DIR = 'templates/'
+# Directory, relative to the charm directory, for the compiled templates.
+TEMPLATE_CACHE_DIR = '.template-cache'
+# unitdata key holding the fingerprint of the last published configuration.
+PRINCIPAL_CONFIG_FINGERPRINT_KEY = 'principal-config-fingerprint'
+# unitdata key holding the hash of the last configuration set on the
+# relation.
+PRINCIPAL_CONFIG_PAYLOAD_KEY = 'principal-config-payload'
+# The manila-plugin relation data that the interface's endpoint publishes the
+# backend names on, as they are, and the configuration data on, JSON encoded
+# under 'data'; and that the principal sets its authentication data on,
+# encoded the same way.
+RELATION_NAME_KEY = '_name'
+RELATION_CONFIGURATION_DATA_KEY = '_configuration_data'
+RELATION_AUTHENTICATION_DATA_KEY = '_authentication_data'
+
+# The config options that each entry of the 'backends' option may override,
+# and their types.
+BACKEND_OPTIONS = {
+    'driver-handles-share-servers': bool,
+    'driver-service-image-name': str,
+    'driver-service-instance-flavor-id': int,
+    'driver-connect-share-server-to-tenant-network': bool,
+    'driver-service-network-cidr': str,
+    'driver-service-network-division-mask': int,
+    'driver-interface-driver': str,
+    'driver-admin-network-id': str,
+    'driver-admin-subnet-id': str,
+    'driver-service-instance-user': str,
+    'driver-auth-type': str,
+    'driver-service-instance-password': str,
+    'driver-keypair-name': str,
+    'driver-cinder-volume-type': str,
+    'driver-volume-name-template': str,
+    'driver-share-volume-fstype': str,
+    'driver-performance-profile': str,
+    'driver-max-time-to-build-instance': int,
+    'driver-max-time-to-create-volume': int,
+    'driver-max-time-to-attach': int,
+    'driver-ssh-conn-timeout': int,
+    'driver-ssh-min-pool-conn': int,
+    'driver-ssh-max-pool-conn': int,
+    'driver-max-shares-per-share-server': int,
+    'driver-max-share-server-size': int,
+    'driver-automatic-share-server-cleanup': bool,
+    'driver-unused-share-server-cleanup-interval': int,
+    'driver-reserved-share-percentage': int,
+    'driver-reserved-share-from-snapshot-percentage': int,
+    'driver-reserved-share-extend-percentage': int,
+    'driver-filter-function': str,
+    'driver-goodness-function': str,
+}
+
+# The generic driver's timeouts (in seconds) and SSH connection pool sizes,
+# and the range of values that each may be set to.
+PERFORMANCE_OPTIONS = {
+    'driver-max-time-to-build-instance': (60, 7200),
+    'driver-max-time-to-create-volume': (30, 3600),
+    'driver-max-time-to-attach': (30, 3600),
+    'driver-ssh-conn-timeout': (5, 600),
+    'driver-ssh-min-pool-conn': (1, 100),
+    'driver-ssh-max-pool-conn': (1, 100),
+}
+
+# Named sets of coherent values for the PERFORMANCE_OPTIONS; an option that
+# is set (non-zero) overrides the value from the profile.  'default' is the
+# generic driver's own defaults.
+PERFORMANCE_PROFILES = {
+    'default': {
+        'driver-max-time-to-build-instance': 300,
+        'driver-max-time-to-create-volume': 180,
+        'driver-max-time-to-attach': 120,
+        'driver-ssh-conn-timeout': 60,
+        'driver-ssh-min-pool-conn': 1,
+        'driver-ssh-max-pool-conn': 10,
+    },
+    # Bursts of share creation: allow for a busy nova and cinder, and for
+    # more concurrent SSH sessions to each service instance.
+    'burst': {
+        'driver-max-time-to-build-instance': 600,
+        'driver-max-time-to-create-volume': 360,
+        'driver-max-time-to-attach': 240,
+        'driver-ssh-conn-timeout': 120,
+        'driver-ssh-min-pool-conn': 5,
+        'driver-ssh-max-pool-conn': 30,
+    },
+    # Many share servers on a large cloud: long timeouts and large pools.
+    'large-fleet': {
+        'driver-max-time-to-build-instance': 900,
+        'driver-max-time-to-create-volume': 600,
+        'driver-max-time-to-attach': 300,
+        'driver-ssh-conn-timeout': 180,
+        'driver-ssh-min-pool-conn': 10,
+        'driver-ssh-max-pool-conn': 50,
+    },
+}
+
+# The BACKEND_OPTIONS and PERFORMANCE_OPTIONS, each with the name the config
+# adapter gives it, for parse_backends().
+_BACKEND_ATTRS = tuple((option, option.replace('-', '_'))
+                       for option in BACKEND_OPTIONS)
+_PERFORMANCE_ATTRS = tuple((option, option.replace('-', '_'))
+                           for option in PERFORMANCE_OPTIONS)
+
+# The backend capacity reservations, as a percentage of the backend.
+PERCENTAGE_OPTIONS = (
+    'driver-reserved-share-percentage',
+    'driver-reserved-share-from-snapshot-percentage',
+    'driver-reserved-share-extend-percentage',
+)
+
+# The config options that manila only supports from an OpenStack release on,
+# and that release.  They are rendered by the templates for that release (and
+# later), and setting them on an earlier release blocks the charm.
+RELEASE_OPTIONS = {
+    'driver-max-shares-per-share-server': 'wallaby',
+    'driver-max-share-server-size': 'wallaby',
+    'driver-reserved-share-from-snapshot-percentage': 'xena',
+    'driver-reserved-share-extend-percentage': 'zed',
+}
+
+# The range, in minutes, that manila allows for the time a share server is
+# unused before it is deleted.
+SHARE_SERVER_CLEANUP_INTERVAL = (10, 60)
+
+# The values of 'driver-interface-driver', and the interface drivers that
+# manila-share plugs the service instances' ports into the host with; empty
+# means manila's default (OVS).  The no-op driver is for a manila-share that
+# is already on the admin network.
+INTERFACE_DRIVERS = {
+    'ovs': 'manila.network.linux.interface.OVSInterfaceDriver',
+    'linuxbridge': 'manila.network.linux.interface.BridgeInterfaceDriver',
+    'noop': 'manila.network.linux.interface.NoopInterfaceDriver',
+}
+# The service network that manila carves the service instances' subnets out
+# of, if 'driver-service-network-cidr' isn't set.
+DEFAULT_SERVICE_NETWORK_CIDR = '10.254.0.0/16'
+
+# The filesystems that manila can make on the share volumes; empty means
+# manila's default (ext4).
+SHARE_VOLUME_FSTYPES = ('', 'ext4', 'ext3')
+
+# The log levels that the loggers may be set to.
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+# The names that 'log-levels' may use for the loggers of the parts of
+# manila-share that the generic driver uses; any other name is taken to be
+# that of a logger.
+LOG_SUBSYSTEMS = {
+    'generic': ('manila.share.drivers.generic',),
+    'service-instance': ('manila.share.drivers.service_instance',),
+    # The SSH pool is in manila.ssh_utils from Zed, manila.utils before.
+    'ssh': ('manila.ssh_utils', 'manila.utils', 'paramiko'),
+    'clients': ('novaclient', 'neutronclient', 'cinderclient',
+                'keystoneauth'),
+}
+# oslo.log's default_log_levels, which those set by 'log-levels' are added
+# to; manila-share would otherwise lose them.
+DEFAULT_LOG_LEVELS = (
+    'amqp=WARN', 'amqplib=WARN', 'boto=WARN', 'qpid=WARN', 'sqlalchemy=WARN',
+    'suds=INFO', 'oslo.messaging=INFO', 'oslo_messaging=INFO',
+    'iso8601=WARN', 'requests.packages.urllib3.connectionpool=WARN',
+    'urllib3.connectionpool=WARN', 'websocket=WARN',
+    'requests.packages.urllib3.util.retry=WARN', 'urllib3.util.retry=WARN',
+    'keystonemiddleware=WARN', 'routes.middleware=WARN', 'stevedore=WARN',
+    'taskflow=WARN', 'keystoneauth=WARN', 'oslo.cache=INFO',
+    'oslo_policy=INFO', 'dogpile.core.dogpile=INFO',
+)
+
+# The values of 'driver-auth-type'; empty means neither.
+AUTH_TYPES = ('', 'password', 'ssh', 'both')
+
+_HANDLES_SHARE_SERVERS = validation.is_set('driver-handles-share-servers')
+_VALID_PROFILE = validation.is_one_of('driver-performance-profile',
+                                      PERFORMANCE_PROFILES)
+
+
+def _uses_auth(*auth_types):
+    # The auth options are only rendered if the driver handles share servers.
+    return validation.all_of(
+        _HANDLES_SHARE_SERVERS,
+        validation.is_one_of('driver-auth-type', auth_types,
+                             ignore_case=True))
+
+
+# The rules for the charm-wide options, checked once.
+CONFIG_RULES = (
+    validation.one_of('relation-payload-format', PAYLOAD_FORMATS),
+    validation.together(('driver-service-ssh-key',
+                         'driver-service-ssh-key-public')),
+    validation.one_of('client-endpoint-type', ENDPOINT_TYPES),
+    validation.not_negative('client-timeout'),
+    validation.pairs('log-levels', LOG_LEVELS),
+    validation.together(('log-rate-limit-interval', 'log-rate-limit-burst')),
+    validation.not_negative('log-rate-limit-interval'),
+    validation.not_negative('log-rate-limit-burst'),
+    validation.one_of('log-rate-limit-except-level',
+                      ('',) + tuple(level.lower() for level in LOG_LEVELS),
+                      ignore_case=True),
+    validation.since_release('log-rate-limit-interval', 'pike'),
+    validation.since_release('share-service-inithost-offload', 'wallaby'),
+)
+
+# The rules for each backend.  The charm-wide options may be used too.  The
+# SSH keys aren't required by the backends that use them, as the leader
+# generates them if they aren't set.
+BACKEND_RULES = tuple(
+    [validation.section_name(
+        'name', RESERVED_SECTIONS,
+        message="The backend name must be letters, digits, '_', '.' or '-', "
+                "and not one of {}".format(', '.join(RESERVED_SECTIONS)))] +
+    [validation.required(option, when=_HANDLES_SHARE_SERVERS)
+     for option in ('driver-service-image-name',
+                    'driver-service-instance-user',
+                    'driver-service-instance-flavor-id')] +
+    [validation.any_of(
+        ('driver-service-instance-password', 'driver-keypair-name'),
+        "Need at least one of instance password or keypair name",
+        when=_HANDLES_SHARE_SERVERS),
+     validation.one_of('driver-auth-type', AUTH_TYPES, ignore_case=True),
+     validation.required(
+         'driver-service-instance-password',
+         when=_uses_auth('password', 'both'),
+         message="'driver-auth-type' password or both needs "
+                 "'driver-service-instance-password'")] +
+    [validation.network('driver-service-network-cidr'),
+     validation.divides_network('driver-service-network-division-mask',
+                                'driver-service-network-cidr',
+                                DEFAULT_SERVICE_NETWORK_CIDR),
+     validation.one_of('driver-interface-driver',
+                       ('',) + tuple(INTERFACE_DRIVERS)),
+     validation.since_release(
+         'driver-interface-driver', 'ussuri',
+         when=validation.is_one_of('driver-interface-driver', ('noop',)),
+         message="'driver-interface-driver' noop needs OpenStack ussuri or "
+                 "later"),
+     validation.together(('driver-admin-network-id',
+                          'driver-admin-subnet-id'))] +
+    [validation.uuid(option)
+     for option in ('driver-admin-network-id', 'driver-admin-subnet-id')] +
+    [validation.name_template('driver-volume-name-template'),
+     validation.one_of('driver-share-volume-fstype', SHARE_VOLUME_FSTYPES)] +
+    [validation.not_negative(option)
+     for option in ('driver-max-shares-per-share-server',
+                    'driver-max-share-server-size')] +
+    [validation.between('driver-unused-share-server-cleanup-interval',
+                        *SHARE_SERVER_CLEANUP_INTERVAL,
+                        when=validation.is_set(
+                            'driver-unused-share-server-cleanup-interval')),
+     validation.required(
+         'driver-automatic-share-server-cleanup',
+         when=validation.all_of(
+             _HANDLES_SHARE_SERVERS,
+             validation.is_set(
+                 'driver-unused-share-server-cleanup-interval')),
+         message="'driver-unused-share-server-cleanup-interval' needs "
+                 "'driver-automatic-share-server-cleanup'")] +
+    [validation.between(option, 0, 100) for option in PERCENTAGE_OPTIONS] +
+    [validation.not_more_than(
+        option, 'driver-reserved-share-percentage',
+        when=validation.all_of(
+            validation.is_set(option),
+            validation.is_set('driver-reserved-share-percentage')))
+     for option in PERCENTAGE_OPTIONS[1:]] +
+    [validation.one_line(option)
+     for option in ('driver-filter-function', 'driver-goodness-function')] +
+    [validation.since_release(option, min_release)
+     for option, min_release in sorted(RELEASE_OPTIONS.items())] +
+    [validation.one_of('driver-performance-profile', PERFORMANCE_PROFILES)] +
+    [validation.between(option, low, high, when=_VALID_PROFILE)
+     for option, (low, high) in sorted(PERFORMANCE_OPTIONS.items())] +
+    [validation.not_more_than('driver-ssh-min-pool-conn',
+                              'driver-ssh-max-pool-conn',
+                              when=_VALID_PROFILE)])
 
 # select the default release function and ssl feature
 charms_openstack.charm.use_defaults('charm.default-select-release')
@@ -69,6 +389,28 @@ def computed_define_ssh(config):
             bool(config.driver_service_ssh_key_public))
 
 
+@charms_openstack.adapters.config_property
+def computed_ssh_keys(config):
+    """Return the SSH keys for the generic driver to use: the key files and
+    the suffix for the keypair name.  These are the keys set by config, if
+    they are set, or else the current generation of the keys generated by the
+    leader.
+    :returns: dict of 'private', 'public' and 'keypair_suffix', or None if the
+        leader hasn't generated the keys yet.
+    """
+    if computed_define_ssh(config):
+        return {'private': MANILA_SSH_KEY_PATH,
+                'public': MANILA_SSH_KEY_PATH_PUBLIC,
+                'keypair_suffix': ''}
+    keys = generated_ssh_keys()
+    if keys is None:
+        return None
+    private, public = generated_ssh_key_paths(keys['current'])
+    return {'private': private,
+            'public': public,
+            'keypair_suffix': '-{}'.format(keys['current'])}
+
+
 @charms_openstack.adapters.config_property
 def computed_debug_level(config):
     """Return NONE, INFO, WARNING, DEBUG depending on the settings of
@@ -82,6 +424,44 @@ def computed_debug_level(config):
     return "WARNING"
 
 
+@charms_openstack.adapters.config_property
+def computed_default_log_levels(config):
+    """Return the default_log_levels for manila-share: oslo.log's defaults,
+    with the levels set by the 'log-levels' option (by logger, or by the
+    names in LOG_SUBSYSTEMS) in place of the defaults for the same loggers.
+
+    :returns: string, comma separated logger=LEVEL pairs, or None if
+        'log-levels' isn't set or isn't valid.
+    """
+    try:
+        pairs = validation.parse_pairs(config.log_levels)
+    except ValueError:
+        return None
+    if not pairs:
+        return None
+    levels = collections.OrderedDict(
+        level.split('=', 1) for level in DEFAULT_LOG_LEVELS)
+    for name, level in pairs:
+        for logger in LOG_SUBSYSTEMS.get(name, (name,)):
+            levels[logger] = level.upper()
+    return ','.join('{}={}'.format(logger, level)
+                    for logger, level in levels.items())
+
+
+@charms_openstack.adapters.config_property
+def computed_backends(config):
+    """Return the backends to configure, as described by parse_backends().
+    If the 'backends' option is invalid then there are no backends; the
+    problem is reported by the charm's custom_assess_status_check().
+
+    :returns: list of dicts
+    """
+    try:
+        return parse_backends(config)
+    except ValueError:
+        return []
+
+
 # Work-around charms.openstack non ability to expose a property on the
 # charms.reactive relation to the adapter.  it would work if it was a function,
 # but sadly not for a property.
@@ -137,41 +517,113 @@ class ManilaGenericCharm(charms_openstack.charm.OpenStackCharm):
     # TODO: remove this when the charms.openstack fix lands
     adapters_class = charms_openstack.adapters.OpenStackRelationAdapters
 
+    _template_release = None
+    _saving_status = False
+    # The results computed in this hook, by name: (key, result).
+    _memo = None
+
+    @property
+    def template_release(self):
+        """The OpenStack release to render the templates for, and to validate
+        the config against: that of the installed manila-common package, or
+        the charm's release if that can't be determined.
+
+        The templates for the closest release at or before it are used.
+
+        :returns: string, the OpenStack codename.
+        """
+        if self._template_release is None:
+            import charmhelpers.contrib.openstack.utils as os_utils
+            self._template_release = (
+                os_utils.get_os_codename_package(self.release_pkg,
+                                                 fatal=False) or
+                self.release)
+        return self._template_release
+
+    def assess_status(self):
+        """Assess the workload status as usual, and save the result at the
+        end of the hook so that update-status can set it again without
+        assessing it.
+        """
+        if not self._saving_status:
+            self._saving_status = True
+            # The atexit callbacks are run last registered first, so this runs
+            # after the assessment even if that is deferred to the end of the
+            # hook.
+            hookenv.atexit(status.save_status)
+        super().assess_status()
+
+    def _memoised(self, name, key, compute):
+        """Return compute(), or the result it returned for the same name and
+        key earlier in this hook.
+
+        The charm instance lives for the hook (provide_charm_instance() keeps
+        a single one per process), so however many handlers ask for a result,
+        it is computed at most once per hook for each key.  The key is what
+        may change within the hook: the config, the release and the relation
+        ids can't, but the leader may generate the SSH keys.
+
+        :param name: string, what is computed.
+        :param key: anything comparable, the inputs that may change.
+        :param compute: function returning the result.
+        :returns: the result.
+        """
+        if self._memo is None:
+            self._memo = {}
+        if name not in self._memo or self._memo[name][0] != key:
+            self._memo[name] = (key, compute())
+        return self._memo[name][1]
+
     def custom_assess_status_check(self):
         """Validate that the driver configuration is at least complete, and
         that it was valid when it used (either at configuration time or config
         changed time)
 
+        Every problem with the configuration is reported, not just the first.
+        The check is made at most once per hook, although both the render and
+        the status assessment ask for it.
+
         :returns (status: string, message: string): the status, and message if
             there is a problem. Or (None, None) if there are no issues.
         """
-        options = self.options
-        if not options.driver_handles_share_servers:
-            # Nothing to check if the driver doesn't handle share servers
-            # directly.
-            return None, None
-        if not options.driver_service_image_name:
-            return 'blocked', "Missing 'driver-service-image-name'"
-        if not options.driver_service_instance_user:
-            return 'blocked', "Missing 'driver-service-instance-user'"
-        if not options.driver_service_instance_flavor_id:
-            return ('blocked',
-                    "Missing 'driver-service-instance-flavor-id'")
-        # Need at least one of the password or the keypair
-        if not (bool(options.driver_service_instance_password) or
-                bool(options.driver_keypair_name)):
-            return ('blocked',
-                    "Need at least one of instance password or keypair name")
-        return None, None
+        return self._memoised('status-check', leader_get(SSH_KEYS_LEADER_KEY),
+                              self._check_config)
+
+    @profiling.stage('assess-check')
+    def _check_config(self):
+        # The check itself, for custom_assess_status_check().
+        backends, violations = self.validate_config()
+        if backends:
+            metrics.record_backends(backends)
+        state, message = None, None
+        if violations:
+            state, message = 'blocked', '; '.join(violations)
+        elif uses_ssh(backends) and self.options.computed_ssh_keys is None:
+            state, message = ('waiting',
+                              "Waiting for the leader to generate the SSH "
+                              "keys")
+        metrics.record_check(state, message)
+        return state, message
+
+    def validate_config(self):
+        """Validate the config for the release, as validate_config() does.
+
+        The config is validated at most once per hook, however often the
+        status is checked; neither the config nor the release can change
+        within the hook.
+
+        :returns: (backends, violations) as for validate_config()
+        """
+        return self._memoised(
+            'validation', None,
+            lambda: validate_config(self.options, self.template_release))
 
     def get_config_for_principal(self, auth_data):
         """Assuming that the configuration data is valid, return the
         configuration data for the principal charm.
 
-        The format of the complete returned data is:
-        {
-            "<config file>: <string>
-        }
+        The format of the complete returned data is as described by
+        principal_payload(), in the format set by 'relation-payload-format'.
 
         If the configuration is not complete, or we don't have auth data from
         the principal charm, then we return and emtpy dictionary {}
@@ -187,65 +639,604 @@ class ManilaGenericCharm(charms_openstack.charm.OpenStackCharm):
         state, message = self.custom_assess_status_check()
         if state:
             return {}
-        options = self.options  # tiny optimisation for less typing.
-
         # If there is no backend name, then we can't send the data yet as the
         # manila-charm won't know what to do with it.
-        if not options.share_backend_name:
+        if not backend_names(self.options):
             return {}
 
         # We have the auth data & the config is reasonably sensible.
-        # We can try and render the config file segment.
-        # TODO this is horrible, and we should have something in
-        # charms.openstack to do this, but we need a c.r relation to be able to
-        # add it to the adapters_instance
-        manila_plugin = relations.endpoint_from_flag('manila-plugin.available')
+        # We can try and render the config file segment, once per hook for
+        # the auth data and the SSH keys.
+        manila_plugin = self._memoised('manila-plugin', None,
+                                       self._add_manila_plugin)
+        manila_plugin.authentication_data = auth_data
+        rendered_configs = self._memoised(
+            'render',
+            json.dumps([auth_data, leader_get(SSH_KEYS_LEADER_KEY)],
+                       sort_keys=True, default=str),
+            self._render)
+
+        return principal_payload(rendered_configs,
+                                 self.options.relation_payload_format)
+
+    def _add_manila_plugin(self):
+        # The adapters need a relation to render manila_plugin from, but the
+        # charms.reactive endpoint only exists in a reactive hook; the
+        # templates only use the auth data, which is set on it per render.
+        manila_plugin = PrincipalRelation()
         self.adapters_instance.add_relation(manila_plugin)
-        rendered_configs = charmhelpers.core.templating.render(
-            source=os.path.basename(MANILA_CONF),
-            template_loader=os_templating.get_loader(
-                'templates/', self.release),
-            target=None,
-            context=self.adapters_instance)
-
-        return {
-            MANILA_CONF: rendered_configs
-        }
+        return manila_plugin
+
+    def _render(self):
+        # Render the configuration, for get_config_for_principal().
+        with profiling.stage('render'), metrics.render_timer():
+            return render_template(os.path.basename(MANILA_CONF),
+                                   self.template_release,
+                                   self.adapters_instance)
+
+    def principal_config_fingerprint(self, auth_data):
+        """Return a fingerprint of everything that feeds the configuration
+        sent to the principal charm.
 
+        The fingerprint covers the charm config, the auth data from the
+        principal, the manila-plugin relation ids, the SSH keys generated by
+        the leader, the template files, the OpenStack release and the charm
+        revision; if none of these change then neither does the rendered
+        configuration.
+
+        :param auth_data: the raw dictionary received from the principal charm
+        :returns: string, a hex digest.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(
+            {'config': dict(self.config),
+             'auth_data': auth_data,
+             'relation_ids': hookenv.relation_ids('manila-plugin'),
+             'ssh_keys': leader_get(SSH_KEYS_LEADER_KEY),
+             'release': self.template_release,
+             'revision': status.charm_revision()},
+            sort_keys=True, default=str).encode('utf-8'))
+        for path in template_files():
+            hasher.update(path.encode('utf-8'))
+            with open(path, 'rb') as f:
+                hasher.update(f.read())
+        return hasher.hexdigest()
+
+    def publish_config_to_principal(self, manila_plugin=None, force=False):
+        """Render the configuration for the principal charm and set it on the
+        manila-plugin relation, unless nothing that feeds it has changed since
+        it was last published.
+
+        The render and the relation writes are skipped when the fingerprint of
+        the inputs matches the one stored when the configuration was last
+        published; each relation write makes the principal run its hooks and
+        may restart manila-share.  The relation writes are also skipped if an
+        input changed but the configuration rendered from it didn't (e.g. a
+        change to an option that isn't rendered).
+
+        :param manila_plugin: the manila-plugin endpoint, or None to read the
+            auth data with relation-get and set the configuration with
+            relation-set (see set_principal_config()).  The endpoint only
+            exists in a reactive hook, and its data is only sent at the end of
+            one, so an action passes None.
+        :param force: if True, render and publish regardless of the stored
+            fingerprint.
+        :returns: boolean, True if the configuration was published.
+        """
+        if manila_plugin is None:
+            auth_data = principal_auth_data()
+        else:
+            auth_data = manila_plugin.authentication_data
+        with profiling.stage('fingerprint'):
+            fingerprint = self.principal_config_fingerprint(auth_data)
+        kv = unitdata.kv()
+        if (not force and
+                kv.get(PRINCIPAL_CONFIG_FINGERPRINT_KEY) == fingerprint):
+            hookenv.log("Configuration inputs are unchanged; skipping render "
+                        "and publish to the principal charm.")
+            metrics.record_published(False)
+            return False
+        configuration_data = self.get_config_for_principal(auth_data)
+        name = backend_names(self.options)
+        payload = hashlib.sha256(json.dumps(
+            {'name': name,
+             'configuration_data': configuration_data,
+             'relation_ids': hookenv.relation_ids('manila-plugin')},
+            sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        kv.set(PRINCIPAL_CONFIG_FINGERPRINT_KEY, fingerprint)
+        if not force and kv.get(PRINCIPAL_CONFIG_PAYLOAD_KEY) == payload:
+            hookenv.log("Rendered configuration is unchanged; skipping "
+                        "publish to the principal charm.")
+            metrics.record_published(False)
+            return False
+        with profiling.stage('relation-write'):
+            if manila_plugin is None:
+                set_principal_config(name, configuration_data)
+            else:
+                # set the name of the backend(s) using the configuration
+                manila_plugin.name = name
+                # Set the configuration data for the principal charm.
+                manila_plugin.configuration_data = configuration_data
+        kv.set(PRINCIPAL_CONFIG_PAYLOAD_KEY, payload)
+        metrics.record_published(True)
+        return True
+
+    @profiling.stage('ssh-keys')
     def maybe_write_ssh_keys(self):
         """Maybe write the ssh keys from the options to the key files where
         manila will be able to find them.  The function only writes them if the
         configuration is to use the SSH config.  If they are not to be written
         and they exist then they are deleted.
+
+        The keys generated by the leader are written too, every generation of
+        them, whether or not they are in use now: share servers created with
+        them keep using them.  The files of the generations that the leader
+        pruned are deleted.  If the driver needs the generated keys and there
+        are none yet, the leader generates them.
+
+        Only the files whose contents changed are written (see
+        files.write_file()).
         """
-        if (self.options.computed_use_ssh and
-                self.options.computed_define_ssh):
-            write_file(self.options.driver_service_ssh_key,
-                       MANILA_SSH_KEY_PATH)
-            write_file(self.options.driver_service_ssh_key_public,
-                       MANILA_SSH_KEY_PATH_PUBLIC, 0o644)
+        use_ssh = uses_ssh(self.options.computed_backends)
+        if use_ssh and self.options.computed_define_ssh:
+            files.write_file(self.options.driver_service_ssh_key,
+                             MANILA_SSH_KEY_PATH)
+            files.write_file(self.options.driver_service_ssh_key_public,
+                             MANILA_SSH_KEY_PATH_PUBLIC, 0o644)
         else:
             for f in (MANILA_SSH_KEY_PATH, MANILA_SSH_KEY_PATH_PUBLIC):
-                try:
-                    os.remove(f)
-                except OSError:
-                    pass
+                files.remove_file(f)
+        keys = generated_ssh_keys()
+        if (keys is None and use_ssh and
+                not self.options.computed_define_ssh and hookenv.is_leader()):
+            keys = rotate_ssh_keys()
+        if keys is None:
+            return
+        installed = set()
+        for generation, pair in sorted(keys['keys'].items()):
+            private, public = generated_ssh_key_paths(generation)
+            files.write_file(pair['private'], private,
+                             owner=GENERATED_SSH_KEY_OWNER,
+                             group=GENERATED_SSH_KEY_OWNER)
+            files.write_file(pair['public'], public, 0o644,
+                             owner=GENERATED_SSH_KEY_OWNER,
+                             group=GENERATED_SSH_KEY_OWNER)
+            installed.update((private, public))
+        for f in sorted(glob.glob(GENERATED_SSH_KEY_PATH.format('*'))):
+            if f not in installed:
+                files.remove_file(f)
+
+
+def parse_backends(config):
+    """Return the generic backends to configure.
+
+    If the 'backends' option is empty, there is a single backend named by the
+    'share-backend-name' option and configured by the 'driver-*' options.
+    Otherwise 'backends' is a YAML list of backends, each a mapping with a
+    'name' and any of the BACKEND_OPTIONS that differ from the charm-wide
+    value, e.g.
+
+        - name: fast
+          driver-service-instance-flavor-id: 200
+        - name: bulk
+          driver-auth-type: ssh
+
+    Each backend is returned as a dict of the 'name' and the BACKEND_OPTIONS,
+    named as the config adapter names them (e.g. 'driver_auth_type'), along
+    with its 'computed_use_password', 'computed_use_ssh' and
+    'computed_interface_driver' (the class of the interface driver, or None
+    for manila's default).
+
+    :param config: the config adapter (i.e. the charm's options).
+    :raises ValueError: if the 'backends' option is not valid.
+    :returns: list of dicts described above.
+    """
+    entries = [{'name': config.share_backend_name}]
+    if config.backends:
+        import yaml
+        try:
+            # libyaml's loader, if PyYAML was built with it, is an order of
+            # magnitude faster; this is parsed on every status check.
+            entries = yaml.load(config.backends,
+                                Loader=getattr(yaml, 'CSafeLoader',
+                                               yaml.SafeLoader))
+        except yaml.YAMLError:
+            raise ValueError("not valid YAML")
+        if not isinstance(entries, list) or not entries:
+            raise ValueError("must be a list of backends")
+        names = set()
+        for entry in entries:
+            if not isinstance(entry, dict) or not entry.get('name'):
+                raise ValueError("each backend must have a 'name'")
+            name = entry['name']
+            if not isinstance(name, str) or name in names:
+                raise ValueError(
+                    "backend names must be unique strings")
+            names.add(name)
+            for option, value in entry.items():
+                if option == 'name':
+                    continue
+                if option not in BACKEND_OPTIONS:
+                    raise ValueError(
+                        "{}: unknown option '{}'".format(name, option))
+                _type = BACKEND_OPTIONS[option]
+                if (not isinstance(value, _type) or
+                        (_type is int and isinstance(value, bool))):
+                    raise ValueError(
+                        "{}: '{}' must be {}".format(
+                            name, option, _type.__name__))
+    backends = []
+    for entry in entries:
+        backend = {'name': entry['name']}
+        for option, attr in _BACKEND_ATTRS:
+            backend[attr] = entry.get(option, getattr(config, attr))
+        # Fill in the performance options that aren't set from the profile.
+        profile = PERFORMANCE_PROFILES.get(
+            backend['driver_performance_profile'], {})
+        for option, attr in _PERFORMANCE_ATTRS:
+            if not backend[attr]:
+                backend[attr] = profile.get(option)
+        backend_config = types.SimpleNamespace(**backend)
+        backend['computed_use_password'] = computed_use_password(
+            backend_config)
+        backend['computed_use_ssh'] = computed_use_ssh(backend_config)
+        backend['computed_interface_driver'] = INTERFACE_DRIVERS.get(
+            backend['driver_interface_driver'])
+        backends.append(backend)
+    return backends
+
+
+def backend_names(config):
+    """Return the names of the configured backends, as the comma separated
+    list that the principal charm passes to manila as its
+    'enabled_share_backends'.
+
+    :param config: the config adapter (i.e. the charm's options).
+    :returns: string, empty if there are no (valid) backends.
+    """
+    return ','.join(backend['name'] or ''
+                    for backend in config.computed_backends)
+
 
+def uses_ssh(backends):
+    """Return True if any of the backends uses SSH to reach its service
+    instances.
+
+    :param backends: the backends, as returned by parse_backends().
+    :returns: boolean
+    """
+    return any(backend['computed_use_ssh'] for backend in backends)
+
+
+# The leader settings read in this hook, so that each is read (with a
+# leader-get) at most once per hook.
+_leader_settings = {}
+
+
+def leader_get(attribute):
+    """Return a leader setting, as hookenv.leader_get() does; it is read at
+    most once per hook.
+
+    :param attribute: the name of the setting.
+    :returns: string, or None if it isn't set.
+    """
+    try:
+        return _leader_settings[attribute]
+    except KeyError:
+        pass
+    value = _leader_settings[attribute] = hookenv.leader_get(attribute)
+    return value
+
+
+def generated_ssh_keys():
+    """Return the SSH keys generated by the leader, as described for
+    SSH_KEYS_LEADER_KEY.
+
+    :returns: dict, or None if the leader hasn't generated any.
+    """
+    keys = leader_get(SSH_KEYS_LEADER_KEY)
+    if not keys:
+        return None
+    return json.loads(keys)
+
+
+def generated_ssh_key_paths(generation):
+    """Return the paths of the key files of a generation of the generated SSH
+    keys.
+
+    :param generation: the generation, as an int or string.
+    :returns: (private, public) paths.
+    """
+    private = GENERATED_SSH_KEY_PATH.format(generation)
+    return private, private + '.pub'
+
+
+def generate_ssh_keypair():
+    """Generate an SSH keypair with ssh-keygen: an RSA key in the PEM format,
+    which the generic driver's SSH client can read on every release.
+
+    :returns: (private, public) strings, the keys.
+    """
+    import subprocess
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'key')
+        subprocess.check_call(['ssh-keygen', '-q', '-t', 'rsa', '-b', '4096',
+                               '-m', 'PEM', '-N', '', '-C', 'manila-service',
+                               '-f', path])
+        with open(path) as f:
+            private = f.read()
+        with open(path + '.pub') as f:
+            public = f.read()
+    return private, public
 
-def write_file(contents, file, chown=0o600):
-    """Write the contents to the file.
 
-    :param contents: the contents to write.  This will be dedented, and striped
-        to ensure that it is just a set of lines.
-    :param file: the file to write
-    :param chown: the ownership for the file.
-    :raises OSError: If the file couldn't be written.
-    :returns None:
+def rotate_ssh_keys(prune=False):
+    """Generate a new generation of the SSH keys, make it the current one and
+    share it with the other units through the leader settings.  Only the
+    leader can do this.
+
+    The share servers created from now on use the new keys; those created
+    before keep using the keys they were created with, unless they are
+    pruned.
+
+    :param prune: if True, the earlier generations of the keys are dropped,
+        and their key files removed from every unit.  The share servers
+        created with them can no longer be reached.
+    :returns: dict, the keys, as described for SSH_KEYS_LEADER_KEY.
+    """
+    keys = generated_ssh_keys() or {'current': 0, 'keys': {}}
+    generation = keys['current'] + 1
+    private, public = generate_ssh_keypair()
+    if prune:
+        keys['keys'] = {}
+    keys['keys'][str(generation)] = {'private': private, 'public': public}
+    keys['current'] = generation
+    value = json.dumps(keys, sort_keys=True)
+    hookenv.leader_set({SSH_KEYS_LEADER_KEY: value})
+    _leader_settings[SSH_KEYS_LEADER_KEY] = value
+    hookenv.log("Generated the SSH keys, generation {}".format(generation))
+    return keys
+
+
+def _getter(config, backend=None):
+    """Return a function that returns the value of an option, by the name the
+    config adapter gives it, from the backend or, if it isn't a backend
+    option, from the config.
+    """
+    if backend is None:
+        return lambda attr: getattr(config, attr)
+
+    def get(attr):
+        try:
+            return backend[attr]
+        except KeyError:
+            return getattr(config, attr)
+    return get
+
+
+def check_backend(backend, release, config):
+    """Validate that the configuration of a backend is complete, that its
+    performance options are in range and that the options it sets are
+    supported by the release, against the BACKEND_RULES.
+
+    :param backend: a backend, as returned by parse_backends()
+    :param release: the OpenStack release that manila is running.
+    :param config: the config adapter, for the charm-wide options.
+    :returns: list of strings, the problems; empty if there are no issues.
+    """
+    return validation.evaluate(BACKEND_RULES, _getter(config, backend),
+                               release)
+
+
+def validate_config(config, release):
+    """Validate the charm's config against the CONFIG_RULES and each backend
+    against the BACKEND_RULES, reporting every violation.
+
+    :param config: the config adapter (i.e. the charm's options).
+    :param release: the OpenStack release that manila is running.
+    :returns: (backends, violations): the backends, as returned by
+        parse_backends() or empty if the 'backends' option is invalid, and a
+        tuple of strings, the problems.  A backend's problems are prefixed
+        with its name if there is more than one backend to choose from.
     """
+    violations = validation.evaluate(CONFIG_RULES, _getter(config), release)
     try:
-        with os.fdopen(os.open(file,
-                               os.O_WRONLY | os.O_CREAT,
-                               chown), 'w') as f:
-            f.write(textwrap.dedent(contents))
-    except OSError as e:
-        hookenv.log("Couldn't write file: {}".format(str(e)))
+        backends = parse_backends(config)
+    except ValueError as e:
+        violations.append("Invalid 'backends': {}".format(str(e)))
+        return [], tuple(violations)
+    for backend in backends:
+        for message in check_backend(backend, release, config):
+            if config.backends:
+                message = "{}: {}".format(backend['name'], message)
+            violations.append(message)
+    return backends, tuple(violations)
+
+
+def principal_payload(rendered, payload_format):
+    """Return the configuration data for the principal charm.
+
+    In the 'string' format this is the rendered manila.conf:
+
+        {
+            "<config file>": <string>
+        }
+
+    In the 'structured' format it is the configuration, as returned by
+    structured_config(), under STRUCTURED_PAYLOAD_KEY; 'both' sends both.
+
+    :param rendered: string, the rendered manila.conf.
+    :param payload_format: one of PAYLOAD_FORMATS.
+    :returns: dict described above.
+    """
+    payload = {}
+    if payload_format in ('string', 'both'):
+        payload[MANILA_CONF] = rendered
+    if payload_format in ('structured', 'both'):
+        payload[STRUCTURED_PAYLOAD_KEY] = structured_config(rendered)
+    return payload
+
+
+def _content_hash(data):
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def structured_config(rendered):
+    """Return the rendered configuration as its sections and options, so
+    that the principal charm can merge it without parsing it, and tell which
+    sections changed from their hashes.
+
+    The format is:
+
+        {
+            "version": STRUCTURED_PAYLOAD_VERSION,
+            "hash": <hash of the sections' hashes>,
+            "sections": {
+                "<section>": {
+                    "hash": <hash of the section's options>,
+                    "options": {"<key>": <string>, ...}
+                },
+                "<section>": {
+                    "hash": <hash>,
+                    "same-as": "<section>"
+                },
+                ...
+            }
+        }
+
+    The sections and options are sorted by name.  A section that is identical
+    to an earlier one (e.g. the [nova], [neutron] and [cinder] credentials)
+    names that section rather than repeating its options.
+
+    :param rendered: string, the rendered manila.conf.
+    :returns: dict described above.
+    """
+    import configparser
+    # No interpolation and no default section: the options are sent exactly
+    # as rendered, and keep their case.
+    parser = configparser.ConfigParser(interpolation=None,
+                                       default_section=None)
+    parser.optionxform = str
+    parser.read_string(rendered)
+    sections = {}
+    by_hash = {}
+    for name in sorted(parser.sections()):
+        options = dict(sorted(parser.items(name)))
+        digest = _content_hash(options)
+        if digest in by_hash:
+            sections[name] = {'hash': digest, 'same-as': by_hash[digest]}
+        else:
+            by_hash[digest] = name
+            sections[name] = {'hash': digest, 'options': options}
+    return {
+        'version': STRUCTURED_PAYLOAD_VERSION,
+        'hash': _content_hash({name: section['hash']
+                               for name, section in sections.items()}),
+        'sections': sections,
+    }
+
+
+# The template environments, by release, so that each template is loaded at
+# most once per hook.
+_template_environments = {}
+
+
+def template_environment(release):
+    """Return the jinja2 environment that loads the templates for the
+    release.
+
+    Compiled templates are cached in TEMPLATE_CACHE_DIR, keyed on the template
+    name and checked against a hash of its source, so that a template is only
+    parsed and compiled when it changes rather than on every hook.
+
+    :param release: the OpenStack release to load the templates for.
+    :returns: jinja2.Environment
+    """
+    try:
+        return _template_environments[release]
+    except KeyError:
+        pass
+    import jinja2
+    import charmhelpers.contrib.openstack.templating as os_templating
+    cache_dir = os.path.join(hookenv.charm_dir(), TEMPLATE_CACHE_DIR)
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    # The templates don't change during a hook, so there is no need for jinja2
+    # to check whether they're up to date each time one is used.
+    environment = jinja2.Environment(
+        loader=os_templating.get_loader(TEMPLATES_DIR, release),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir),
+        auto_reload=False)
+    _template_environments[release] = environment
+    return environment
+
+
+def render_template(source, release, context):
+    """Render the template for the release with the context.
+
+    :param source: the name of the template to render.
+    :param release: the OpenStack release to render the template for.
+    :param context: the context (e.g. the adapters instance) for the template.
+    :returns: string, the rendered template.
+    """
+    template = template_environment(release).get_template(source)
+    return template.render(context)
+
+
+def template_files():
+    """Return the template files that may be rendered into manila.conf.
+
+    :returns: sorted list of paths, relative to the charm directory.
+    """
+    paths = []
+    for root, _, names in os.walk(TEMPLATES_DIR):
+        paths.extend(os.path.join(root, name) for name in names)
+    return sorted(paths)
+
+
+class PrincipalRelation(object):
+    """The manila-plugin relation as the adapters and the templates use it:
+    the principal's authentication data, without the charms.reactive
+    endpoint.
+
+    :param authentication_data: the principal's authentication data, as
+        described for authentication_data().
+    """
+
+    endpoint_name = relation_name = 'manila-plugin'
+
+    def __init__(self, authentication_data=None):
+        self.authentication_data = authentication_data
+
+
+def principal_auth_data():
+    """Return the authentication data that the principal charm set on the
+    manila-plugin relation, read with relation-get as the endpoint reads it.
+
+    :returns: dict, as described for authentication_data(), or None if the
+        principal hasn't set it.
+    """
+    for relation_id in hookenv.relation_ids('manila-plugin'):
+        for unit in hookenv.related_units(relation_id):
+            data = hookenv.relation_get(RELATION_AUTHENTICATION_DATA_KEY,
+                                        unit=unit, rid=relation_id)
+            if data:
+                return json.loads(data)['data']
+    return None
+
+
+def set_principal_config(name, configuration_data):
+    """Set the backend names and the configuration data on every
+    manila-plugin relation with relation-set, as the endpoint publishes them.
+
+    :param name: string, the backend names.
+    :param configuration_data: the configuration data for the principal.
+    """
+    settings = {
+        RELATION_NAME_KEY: name,
+        RELATION_CONFIGURATION_DATA_KEY: json.dumps(
+            {'data': configuration_data}, sort_keys=True),
+    }
+    for relation_id in hookenv.relation_ids('manila-plugin'):
+        hookenv.relation_set(relation_id=relation_id,
+                             relation_settings=settings)
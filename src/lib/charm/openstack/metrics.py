@@ -0,0 +1,302 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Metrics of the charm and its backends, written at the end of each hook as a
+# Prometheus textfile for node-exporter's textfile collector, when the
+# 'prometheus-textfile-dir' config option is set.  What the hook measured is
+# merged into the metrics saved by the earlier hooks, so that each hook
+# writes them all; a hook that doesn't render or check the config (e.g.
+# update-status) writes the values from the last one that did.
+
+import contextlib
+import os
+import time
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.unitdata as unitdata
+
+import charm.openstack.files as files
+
+TEXTFILE_NAME = 'manila-generic.prom'
+PREFIX = 'manila_generic_'
+
+# unitdata key holding the metrics saved by the earlier hooks.
+METRICS_KEY = 'prometheus-metrics'
+
+# The options of each backend exported as its settings, and the names of the
+# settings.
+BACKEND_SETTINGS = (
+    ('driver_service_instance_flavor_id', 'service_instance_flavor_id'),
+    ('driver_max_time_to_build_instance', 'max_time_to_build_instance'),
+    ('driver_max_time_to_create_volume', 'max_time_to_create_volume'),
+    ('driver_max_time_to_attach', 'max_time_to_attach'),
+    ('driver_ssh_conn_timeout', 'ssh_conn_timeout'),
+    ('driver_ssh_min_pool_conn', 'ssh_min_pool_conn'),
+    ('driver_ssh_max_pool_conn', 'ssh_max_pool_conn'),
+    ('driver_max_shares_per_share_server', 'max_shares_per_share_server'),
+    ('driver_max_share_server_size', 'max_share_server_size'),
+    ('driver_unused_share_server_cleanup_interval',
+     'unused_share_server_cleanup_interval'),
+    ('driver_reserved_share_percentage', 'reserved_share_percentage'),
+    ('driver_reserved_share_from_snapshot_percentage',
+     'reserved_share_from_snapshot_percentage'),
+    ('driver_reserved_share_extend_percentage',
+     'reserved_share_extend_percentage'),
+)
+
+# The work counted in each hook: the renders of the configuration and the
+# checks of the config for the status.
+HOOK_WORK = ('renders', 'status_checks')
+
+# When the charm's handlers were loaded, which the hook is timed from.
+_started = None
+# What the current hook measured.
+_current = {}
+
+
+def textfile_dir():
+    """Return the directory to write the textfile to, or None if the metrics
+    aren't to be written.
+
+    :returns: string or None
+    """
+    return hookenv.config('prometheus-textfile-dir') or None
+
+
+def register():
+    """Time the hook from now, and write the metrics at the end of it.
+
+    This is called as the charm's handlers are loaded, so that the metrics
+    are written after everything else the hook does at exit.
+    """
+    global _started
+    _started = time.perf_counter()
+    hookenv.atexit(write_textfile)
+
+
+@contextlib.contextmanager
+def render_timer():
+    """Context manager that times the render of the configuration."""
+    start = time.perf_counter()
+    _count('renders')
+    try:
+        yield
+    finally:
+        _current['render_seconds'] = time.perf_counter() - start
+
+
+def _count(name):
+    # Count the work the current hook did, by what it was.
+    _current[name] = _current.get(name, 0) + 1
+
+
+def hook_work():
+    """Return the work the current hook has done so far.
+
+    :returns: dict of each of HOOK_WORK to the times it was done.
+    """
+    return {name: _current.get(name, 0) for name in HOOK_WORK}
+
+
+def record_published(changed):
+    """Record whether the configuration sent to the principal changed.
+
+    :param changed: boolean
+    """
+    _current['published'] = bool(changed)
+
+
+def record_check(state, message):
+    """Record the result of the charm's config check.
+
+    :param state: the workload state, or None if the config is valid.
+    :param message: the message for the state.
+    """
+    _count('status_checks')
+    _current['check'] = {'state': state or 'ok', 'message': message or ''}
+
+
+def record_backends(backends):
+    """Record the backends' settings in effect.
+
+    :param backends: the backends, as returned by parse_backends()
+    """
+    _current['backends'] = [
+        {
+            'name': backend['name'],
+            'driver_handles_share_servers': bool(
+                backend['driver_handles_share_servers']),
+            'auth_type': str(backend['driver_auth_type'] or '').lower(),
+            'performance_profile': backend['driver_performance_profile'],
+            'settings': {name: backend[option]
+                         for option, name in BACKEND_SETTINGS
+                         if backend[option] is not None},
+        }
+        for backend in backends]
+
+
+def _merge(saved, hook, duration, now):
+    """Merge what the current hook measured into the saved metrics.
+
+    :returns: dict, the merged metrics.
+    """
+    metrics = dict(saved or {})
+    hooks = dict(metrics.get('hooks', {}))
+    stats = dict(hooks.get(hook, {'count': 0, 'sum': 0.0}))
+    stats['count'] += 1
+    stats['sum'] += duration
+    stats['last'] = duration
+    # What the last run of the hook did, which should be at most once each.
+    stats.update(hook_work())
+    hooks[hook] = stats
+    metrics['hooks'] = hooks
+    for key in ('render_seconds', 'check', 'backends'):
+        if key in _current:
+            metrics[key] = _current[key]
+    published = _current.get('published', False)
+    metrics['published'] = published
+    if published:
+        metrics['published_total'] = metrics.get('published_total', 0) + 1
+        metrics['published_timestamp'] = now
+    return metrics
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _sample(name, value, labels=None):
+    if labels:
+        label_text = '{{{}}}'.format(','.join(
+            '{}="{}"'.format(k, _escape(v)) for k, v in labels))
+    else:
+        label_text = ''
+    return '{}{}{} {}'.format(PREFIX, name, label_text, value)
+
+
+def _family(name, metric_type, help_text, samples):
+    lines = ['# HELP {}{} {}'.format(PREFIX, name, help_text),
+             '# TYPE {}{} {}'.format(PREFIX, name, metric_type)]
+    lines.extend(samples)
+    return lines
+
+
+def format_metrics(metrics):
+    """Format the metrics in the Prometheus text exposition format.
+
+    :param metrics: dict, as saved in METRICS_KEY.
+    :returns: string
+    """
+    lines = []
+    hooks = sorted(metrics.get('hooks', {}).items())
+    lines += _family(
+        'hook_duration_seconds', 'summary',
+        "The duration of the charm's hooks.",
+        [_sample('hook_duration_seconds_sum', round(stats['sum'], 6),
+                 [('hook', hook)]) for hook, stats in hooks] +
+        [_sample('hook_duration_seconds_count', stats['count'],
+                 [('hook', hook)]) for hook, stats in hooks])
+    lines += _family(
+        'hook_last_duration_seconds', 'gauge',
+        "The duration of the last run of each of the charm's hooks.",
+        [_sample('hook_last_duration_seconds', round(stats['last'], 6),
+                 [('hook', hook)]) for hook, stats in hooks])
+    lines += _family(
+        'hook_renders', 'gauge',
+        "The number of times the last run of each of the charm's hooks "
+        "rendered the configuration.",
+        [_sample('hook_renders', stats.get('renders', 0),
+                 [('hook', hook)]) for hook, stats in hooks])
+    lines += _family(
+        'hook_status_checks', 'gauge',
+        "The number of times the last run of each of the charm's hooks "
+        "checked the config for the workload status.",
+        [_sample('hook_status_checks', stats.get('status_checks', 0),
+                 [('hook', hook)]) for hook, stats in hooks])
+    if 'render_seconds' in metrics:
+        lines += _family(
+            'render_duration_seconds', 'gauge',
+            "The duration of the last render of the configuration.",
+            [_sample('render_duration_seconds',
+                     round(metrics['render_seconds'], 6))])
+    lines += _family(
+        'config_published', 'gauge',
+        "1 if the last hook sent a changed configuration to the principal.",
+        [_sample('config_published', int(metrics.get('published', False)))])
+    lines += _family(
+        'config_published_total', 'counter',
+        "The number of times a changed configuration was sent to the "
+        "principal.",
+        [_sample('config_published_total',
+                 metrics.get('published_total', 0))])
+    if 'published_timestamp' in metrics:
+        lines += _family(
+            'config_published_timestamp_seconds', 'gauge',
+            "When a changed configuration was last sent to the principal.",
+            [_sample('config_published_timestamp_seconds',
+                     round(metrics['published_timestamp'], 3))])
+    if 'check' in metrics:
+        lines += _family(
+            'config_check', 'gauge',
+            "The result of the last check of the charm's config; the state "
+            "is 'ok' if the config is valid.",
+            [_sample('config_check', 1,
+                     [('state', metrics['check']['state']),
+                      ('message', metrics['check']['message'])])])
+    backends = metrics.get('backends', [])
+    if backends:
+        lines += _family(
+            'backend_info', 'gauge',
+            "The generic backends configured, and their modes.",
+            [_sample('backend_info', 1, [
+                ('backend', backend['name']),
+                ('driver_handles_share_servers',
+                 str(backend['driver_handles_share_servers']).lower()),
+                ('auth_type', backend['auth_type']),
+                ('performance_profile', backend['performance_profile'])])
+             for backend in backends])
+        lines += _family(
+            'backend_setting', 'gauge',
+            "The generic driver settings in effect for each backend.",
+            [_sample('backend_setting', value,
+                     [('backend', backend['name']), ('setting', name)])
+             for backend in backends
+             for name, value in sorted(backend['settings'].items())])
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(started=None):
+    """Merge the current hook's metrics into those saved, and write them to
+    the textfile, if it is configured.
+
+    The file is replaced atomically, so node-exporter never reads it
+    partially written.
+
+    :param started: float, the time.perf_counter() the hook started at;
+        otherwise it is timed from when register() was called.
+    """
+    directory = textfile_dir()
+    if directory is None:
+        return
+    started = _started if started is None else started
+    duration = time.perf_counter() - (started or time.perf_counter())
+    kv = unitdata.kv()
+    metrics = _merge(kv.get(METRICS_KEY), hookenv.hook_name(), duration,
+                     time.time())
+    kv.set(METRICS_KEY, metrics)
+    kv.flush()
+    files.write_file(format_metrics(metrics),
+                     os.path.join(directory, TEXTFILE_NAME),
+                     0o644)
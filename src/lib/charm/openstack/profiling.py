@@ -0,0 +1,226 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Opt-in profiling of the stages of a hook.  When the 'profile-hooks' config
+# option is set, each stage is timed, the peak memory is traced and one JSON
+# record per hook is appended to PROFILE_LOG.
+
+import collections
+import contextlib
+import json
+import math
+import os
+import time
+import tracemalloc
+
+import charmhelpers.core.hookenv as hookenv
+
+import charm.openstack.status as status
+
+PROFILE_LOG = '/var/log/manila-generic/hook-profile.log'
+PROFILE_LOG_MAX_BYTES = 1024 * 1024
+PROFILE_LOG_BACKUP_COUNT = 5
+
+PERCENTILES = (50, 90, 99)
+
+# The record of the current hook, or None if nothing has been profiled yet.
+_record = None
+
+
+def enabled():
+    """Return True if the hooks should be profiled.
+
+    :returns: boolean
+    """
+    return bool(hookenv.config('profile-hooks'))
+
+
+def register():
+    """Start the record for the hook (and the memory tracing) now, if
+    profiling is enabled, and write it at the end of the hook.
+
+    This is called as the charm's handlers are loaded, so that the record
+    covers the dispatch of the handlers as well as their stages.
+    """
+    if enabled():
+        _current_record()
+
+
+def _current_record():
+    """Return the record for the current hook, starting it (and the memory
+    tracing) if it wasn't started when the handlers were loaded (e.g. in an
+    action).
+
+    :returns: dict
+    """
+    global _record
+    if _record is None:
+        tracemalloc.start()
+        _record = {
+            'hook': hookenv.hook_name(),
+            'timestamp': time.time(),
+            'start': time.perf_counter(),
+            'stages': collections.OrderedDict(),
+        }
+        hookenv.atexit(write_record)
+    return _record
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Context manager (or decorator) that times the stage 'name' of the
+    hook, if profiling is enabled.  The time of a stage that runs more than
+    once in a hook is accumulated; stages may be nested.
+
+    :param name: the name of the stage.
+    """
+    if not enabled():
+        yield
+        return
+    record = _current_record()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        record['stages'][name] = record['stages'].get(name, 0.0) + elapsed
+
+
+def _logger():
+    """Return the logger that appends records to PROFILE_LOG, rotating the
+    file when it reaches PROFILE_LOG_MAX_BYTES.
+
+    :returns: logging.Logger
+    """
+    import logging.handlers
+    logger = logging.getLogger('manila-generic.profile')
+    if not logger.handlers:
+        os.makedirs(os.path.dirname(PROFILE_LOG), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            PROFILE_LOG,
+            maxBytes=PROFILE_LOG_MAX_BYTES,
+            backupCount=PROFILE_LOG_BACKUP_COUNT)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def write_record():
+    """Finish the record for the current hook and append it to PROFILE_LOG.
+
+    This is registered to run at the end of the hook when the record is
+    started.
+    """
+    global _record
+    if _record is None:
+        return
+    record, _record = _record, None
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    entry = {
+        'hook': record['hook'],
+        'timestamp': record['timestamp'],
+        'revision': status.charm_revision().get('version'),
+        'duration': time.perf_counter() - record['start'],
+        'peak_memory': peak,
+        'stages': record['stages'],
+    }
+    try:
+        _logger().info(json.dumps(entry))
+    except OSError as e:
+        hookenv.log("Couldn't write the hook profile: {}".format(str(e)),
+                    level=hookenv.WARNING)
+
+
+def read_records(path=PROFILE_LOG):
+    """Yield the records from the profile log and its rotated files, oldest
+    first.  Lines that can't be parsed are skipped.
+
+    :param path: the profile log.
+    :returns: iterator of dicts.
+    """
+    paths = ['{}.{}'.format(path, i)
+             for i in range(PROFILE_LOG_BACKUP_COUNT, 0, -1)]
+    paths.append(path)
+    for p in paths:
+        try:
+            with open(p) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except OSError:
+            continue
+
+
+def percentile(values, pct):
+    """Return the pct percentile of the sorted values, by nearest rank.
+
+    :param values: a sorted, non-empty list of numbers.
+    :param pct: the percentile, 0 - 100.
+    :returns: number
+    """
+    rank = max(int(math.ceil(pct / 100.0 * len(values))) - 1, 0)
+    return values[rank]
+
+
+def _stats(values):
+    values = sorted(values)
+    stats = {'count': len(values), 'max': values[-1]}
+    for pct in PERCENTILES:
+        stats['p{}'.format(pct)] = percentile(values, pct)
+    return stats
+
+
+def summarise(records, revision=None):
+    """Summarise the records as percentiles per hook and per stage.
+
+    The summary format is:
+    {
+        '<hook>': {
+            'duration': {'count': n, 'p50': s, 'p90': s, 'p99': s, 'max': s},
+            'peak-memory': {...},
+            'stages': {'<stage>': {...}, ...},
+        },
+        ...
+    }
+
+    :param records: iterable of the profile records.
+    :param revision: if not None, only summarise the records for the charm
+        revision.
+    :returns: dict described above.
+    """
+    hooks = collections.defaultdict(
+        lambda: {'duration': [],
+                 'peak-memory': [],
+                 'stages': collections.defaultdict(list)})
+    for record in records:
+        if revision is not None and record.get('revision') != revision:
+            continue
+        hook = hooks[record['hook']]
+        hook['duration'].append(record['duration'])
+        hook['peak-memory'].append(record['peak_memory'])
+        for name, elapsed in record['stages'].items():
+            hook['stages'][name].append(elapsed)
+    return {
+        name: {
+            'duration': _stats(hook['duration']),
+            'peak-memory': _stats(hook['peak-memory']),
+            'stages': {stage_name: _stats(values)
+                       for stage_name, values in hook['stages'].items()},
+        }
+        for name, hook in hooks.items()}
@@ -0,0 +1,213 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Opt-in recording of the hooks, to replay them offline (see
+# unit_tests/replay.py).  When the 'record-hooks' config option is set, one
+# JSON record per hook is appended to TRACE_LOG: the hook's name, the config,
+# the flags and the leader settings as the hook started, and the
+# manila-plugin relation data (the principal's authentication data and what
+# the charm published).  The secrets in them are redacted.
+#
+# The trace is only appended to, never rotated, so that a replay has every
+# hook since the recording was started; it should only be left on for as
+# long as the hooks are wanted.
+
+import json
+import os
+import re
+import time
+
+import charmhelpers.core.hookenv as hookenv
+
+import charm.openstack.status as status
+
+TRACE_LOG = '/var/log/manila-generic/hook-trace.log'
+
+REDACTED = 'REDACTED'
+# The keys (of the config, the leader settings, the relation data and the
+# rendered configuration) whose values are secrets.
+SECRET_KEY = re.compile(r'password|secret|token|private|ssh[-_]key$',
+                        re.IGNORECASE)
+# An option, in a rendered ini file, whose value is a secret.
+SECRET_LINE = re.compile(
+    r'^(\s*[\w.-]*(?:password|secret|token)[\w.-]*\s*=\s*).*$',
+    re.IGNORECASE | re.MULTILINE)
+# The config options whose values are YAML; the secrets in them are redacted
+# as those of the config are.
+YAML_KEYS = ('backends',)
+# An option, in YAML that doesn't parse, whose value is a secret.
+SECRET_YAML_LINE = re.compile(
+    r'^(\s*(?:-\s+)?(?:[\w.-]*(?:password|secret|token|private)[\w.-]*|'
+    r'[\w.-]*ssh[-_]key)\s*:[ \t]*)\S.*$',
+    re.IGNORECASE | re.MULTILINE)
+# The keys of the structured configuration (see
+# manila_generic.structured_config()) beside which a 'hash' is an unsalted
+# hash of the options, secrets included, so could be used to guess them.
+HASHED_KEYS = ('sections', 'options', 'same-as')
+
+# What the current hook started with, or None if it isn't being recorded.
+_started = None
+
+
+def enabled():
+    """Return True if the hooks should be recorded.
+
+    :returns: boolean
+    """
+    return bool(hookenv.config('record-hooks'))
+
+
+def redact(value):
+    """Return the value with the secrets in it replaced by REDACTED.
+
+    The values of the keys that name secrets are redacted wherever they are,
+    including in JSON strings (e.g. the leader's SSH keys), in the YAML of the
+    YAML_KEYS options (e.g. 'backends') and in the options of rendered ini
+    files.  An empty secret is left empty, so that a replay
+    validates the config as the hook did.  The hashes of the structured
+    configuration are dropped, as they are hashes of its secrets too.
+
+    :param value: anything that can be encoded as JSON.
+    :returns: the redacted value.
+    """
+    if isinstance(value, dict):
+        hashed = any(k in value for k in HASHED_KEYS)
+        return {k: _redact_item(k, value[k])
+                for k in value
+                if not (hashed and k == 'hash')}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        if value[:1] in ('{', '['):
+            try:
+                return json.dumps(redact(json.loads(value)), sort_keys=True)
+            except ValueError:
+                pass
+        return SECRET_LINE.sub(r'\g<1>' + REDACTED, value)
+    return value
+
+
+def _redact_item(key, value):
+    # Redact the value of a key of a dict.
+    if value and SECRET_KEY.search(str(key)):
+        return REDACTED
+    if key in YAML_KEYS and value and isinstance(value, str):
+        return _redact_yaml(value)
+    return redact(value)
+
+
+def _redact_yaml(value):
+    # Redact the secrets in a YAML string; it is only dumped again if there
+    # were any, so that it is otherwise recorded as it was set.
+    import yaml
+    try:
+        loaded = yaml.safe_load(value)
+    except yaml.YAMLError:
+        # The hook blocks on it; the secrets are still redacted, line by line.
+        return SECRET_YAML_LINE.sub(r'\g<1>' + REDACTED, value)
+    redacted = redact(loaded)
+    if redacted == loaded:
+        return value
+    return yaml.safe_dump(redacted, default_flow_style=False, sort_keys=False)
+
+
+def register():
+    """Record the hook, if recording is enabled: note what it starts with
+    now, and write the record at the end of it.
+
+    This is called as the charm's handlers are loaded, before they run.
+    """
+    global _started
+    if not enabled():
+        return
+    # Imported here so that update-status can check enabled() without it.
+    import charms.reactive
+    _started = {
+        'timestamp': time.time(),
+        'start': time.perf_counter(),
+        'flags': sorted(charms.reactive.get_flags()),
+        'leader_settings': redact(hookenv.leader_get() or {}),
+    }
+    hookenv.atexit(write_record)
+
+
+def _manila_plugin():
+    """Return the manila-plugin relation data: the principal's
+    authentication data, and the name and configuration data the charm
+    published, or None if the relation isn't connected.
+
+    :returns: dict or None
+    """
+    import charms.reactive.relations as relations
+    endpoint = relations.endpoint_from_flag('manila-plugin.connected')
+    if endpoint is None:
+        return None
+    return redact({
+        'authentication_data': getattr(endpoint, 'authentication_data', None),
+        'published': {
+            'name': getattr(endpoint, 'name', None),
+            'configuration_data': getattr(endpoint, 'configuration_data',
+                                          None),
+        },
+    })
+
+
+def write_record():
+    """Finish the record for the current hook and append it to TRACE_LOG.
+
+    This is registered to run at the end of the hook by register().
+    """
+    global _started
+    if _started is None:
+        return
+    started, _started = _started, None
+    entry = {
+        'hook': hookenv.hook_name(),
+        'timestamp': started['timestamp'],
+        'revision': status.charm_revision().get('version'),
+        'duration': time.perf_counter() - started['start'],
+        'leader': bool(hookenv.is_leader()),
+        'config': redact(dict(hookenv.config())),
+        'flags': started['flags'],
+        'leader_settings': started['leader_settings'],
+        'manila_plugin': _manila_plugin(),
+    }
+    try:
+        os.makedirs(os.path.dirname(TRACE_LOG), exist_ok=True)
+        # Only root may read it, whatever the umask: even redacted, the
+        # records describe the deployment.
+        fd = os.open(TRACE_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o600)
+        with os.fdopen(fd, 'a') as f:
+            os.fchmod(fd, 0o600)
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+    except (OSError, TypeError, ValueError) as e:
+        hookenv.log("Couldn't record the hook: {}".format(str(e)),
+                    level=hookenv.WARNING)
+
+
+def read_records(path=TRACE_LOG):
+    """Yield the records from the trace, oldest first.  Lines that can't be
+    parsed (e.g. the last one, if a hook was killed as it wrote it) are
+    skipped.
+
+    :param path: the trace.
+    :returns: iterator of dicts.
+    """
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
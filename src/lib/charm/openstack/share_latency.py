@@ -0,0 +1,364 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The latency of the generic driver's stages (building the service instance,
+# waiting for it to be reachable by SSH, and creating and attaching the
+# share's cinder volume), measured from the manila-share log.  The log, which
+# may be several GB with its rotated files, is read as a stream and the
+# latencies are kept in fixed size histograms, so the memory used is constant.
+#
+# Most of the lines matched are logged at debug level, so manila needs to run
+# with debug logging for the latencies to be measured.
+
+import collections
+import datetime
+import glob
+import gzip
+import math
+import os
+import re
+
+SHARE_LOG = '/var/log/manila/manila-share.log'
+
+PERCENTILES = (50, 90, 99)
+
+# The window that is reported, if no start is given.
+DEFAULT_WINDOW = datetime.timedelta(hours=24)
+
+# The formats accepted for the start and end of the window; the log's
+# timestamps are local time, so these are as well.
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+# The format of the log's timestamps, to the second; these sort as strings,
+# so most lines are placed in the window without being parsed.
+LOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# The histogram buckets: the first holds latencies up to HISTOGRAM_MIN
+# seconds, and each bucket is HISTOGRAM_RATIO times wider than the one before,
+# so a percentile is accurate to within 10%.
+HISTOGRAM_MIN = 0.01
+HISTOGRAM_RATIO = 1.1
+HISTOGRAM_BUCKETS = 200
+
+# A stage that hasn't ended after this time (longer than the longest timeout
+# that the generic driver can be configured with), or beyond this many stages
+# in progress, is forgotten.
+MAX_PENDING_AGE = datetime.timedelta(hours=4)
+MAX_PENDING = 10000
+
+# A stage of the generic driver: the name reported, and the patterns of the
+# messages that start, end and fail the stage.  The start and end are paired
+# by the request id of the lines.  If 'within' is set the stage is only timed
+# while that stage is in progress in the same request.
+Stage = collections.namedtuple(
+    'Stage', ['name', 'start', 'end', 'failure', 'within'])
+
+STAGES = (
+    Stage(name='service-instance',
+          start=r"Creating share server '",
+          end=r"Share server created successfully",
+          failure=r"failed to reach active state",
+          within=None),
+    # Only timed while building a service instance; the driver also checks
+    # that existing service instances are reachable.
+    Stage(name='ssh-ready',
+          start=r"Checking server availability\.",
+          end=r"is available via SSH\.",
+          failure=r"connection has not been established to \S+ in",
+          within='service-instance'),
+    # The volume is created once the share server is provided, and the
+    # attach starts once the volume is available.
+    Stage(name='volume-create',
+          start=(r'Lock "share_manager_[^"]*" "?released"? by '
+                 r'"[^"]*_wrapped_provide_share_server_for_share"'),
+          end=r'Acquiring lock "generic_driver_attach_detach_',
+          failure=r"Volume has not been created in|Failed to create volume",
+          within=None),
+    Stage(name='volume-attach',
+          start=r'Lock "generic_driver_attach_detach_[^"]*" acquired by',
+          end=r'Lock "generic_driver_attach_detach_[^"]*" "?released"? by',
+          failure=(r"Volume \S+ has not been attached in|"
+                   r"Failed to attach volume|"
+                   r"Volume \S+ is already attached to another instance"),
+          within=None),
+)
+
+# Every pattern in STAGES (and each alternative in it) contains one of these
+# literally.  Most lines contain none, and are skipped without running any
+# pattern; the others are only matched against the patterns that contain the
+# keywords that they do.
+KEYWORDS = ('hare server', 'availab', 'active state', 'established to',
+            'ock "share_manager_', 'ock "generic_driver_attach_detach_',
+            'olume')
+
+# The start of an oslo.log line: the timestamp, the pid, the level and the
+# logger, then the request context (which the lines of a traceback don't
+# have).
+LOG_LINE = re.compile(
+    r'(?P<timestamp>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?) \d+ [A-Z]+ '
+    r'\S+(?: \[(?P<context>[^\]]*)\])?')
+# The local request id is the last in the context, after any global one.
+REQUEST_ID = re.compile(r'req-[0-9a-f-]+')
+
+
+def _markers():
+    """Return the patterns of the stages' messages, by the keyword that they
+    contain.
+
+    :returns: list of (keyword, [(stage: Stage, kind: string, compiled regular
+        expression), ...]), where kind is one of 'start', 'end' or 'failure'.
+    """
+    markers = []
+    for keyword in KEYWORDS:
+        patterns = []
+        for stage in STAGES:
+            for kind in ('start', 'end', 'failure'):
+                pattern = getattr(stage, kind)
+                if keyword in pattern:
+                    patterns.append((stage, kind, re.compile(pattern)))
+        markers.append((keyword, patterns))
+    return markers
+
+
+class Histogram(object):
+    """Latencies, in seconds, counted in buckets of exponentially increasing
+    width, so that the memory used doesn't depend on how many are added.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= HISTOGRAM_MIN:
+            index = 0
+        else:
+            index = min(
+                int(math.ceil(math.log(seconds / HISTOGRAM_MIN,
+                                       HISTOGRAM_RATIO))),
+                HISTOGRAM_BUCKETS - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, pct):
+        """Return the upper bound of the bucket holding the pct percentile,
+        by nearest rank.
+
+        :param pct: the percentile, 0 - 100.
+        :returns: float, or None if there are no latencies.
+        """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(pct / 100.0 * self.count)), 1)
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                break
+        return min(HISTOGRAM_MIN * HISTOGRAM_RATIO ** index, self.max)
+
+
+def parse_time(value):
+    """Parse the start or end of the window.
+
+    :param value: string in one of the TIME_FORMATS.
+    :returns: datetime.datetime
+    :raises ValueError: if value isn't in one of the formats.
+    """
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError(
+        "Invalid time '{}': expected 'YYYY-MM-DD[ HH:MM[:SS]]'".format(value))
+
+
+def window(since=None, until=None, now=None):
+    """Return the window to report on.
+
+    :param since: the start, as a string for parse_time(), or None for
+        DEFAULT_WINDOW before the end.
+    :param until: the end, as a string for parse_time(), or None for now.
+    :param now: the current time, for testing.
+    :returns: (since: datetime.datetime, until: datetime.datetime)
+    :raises ValueError: if either time is invalid, or the window is empty.
+    """
+    until = parse_time(until) if until else (now or datetime.datetime.now())
+    since = parse_time(since) if since else until - DEFAULT_WINDOW
+    if since >= until:
+        raise ValueError("The start of the window must be before its end")
+    return since, until
+
+
+def log_files(path=SHARE_LOG):
+    """Return the log and its rotated files (e.g. path.1, path.2.gz), oldest
+    first.
+
+    :param path: the log.
+    :returns: list of paths that exist.
+    """
+    rotated = []
+    for p in glob.glob(path + '.*'):
+        number = p[len(path) + 1:].split('.', 1)[0]
+        if number.isdigit():
+            rotated.append((int(number), p))
+    paths = [p for _, p in sorted(rotated, reverse=True)]
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def read_lines(paths, since=None):
+    """Yield the lines of the files, which are decompressed if their name
+    ends in '.gz'.
+
+    :param paths: the files, in order.
+    :param since: if not None, skip the files that were last written before
+        this datetime, as none of their lines are in the window.
+    :returns: iterator of strings.
+    """
+    for path in paths:
+        try:
+            if (since is not None and
+                    datetime.datetime.fromtimestamp(
+                        os.path.getmtime(path)) < since):
+                continue
+            if path.endswith('.gz'):
+                f = gzip.open(path, 'rt', errors='replace')
+            else:
+                f = open(path, errors='replace')
+            with f:
+                for line in f:
+                    yield line
+        except (OSError, EOFError):
+            continue
+
+
+def _log_time(timestamp):
+    """Parse an oslo.log timestamp, e.g. '2024-05-01 10:00:00.123'."""
+    seconds, _, fraction = timestamp.partition('.')
+    when = datetime.datetime.strptime(seconds, LOG_TIME_FORMAT)
+    if fraction:
+        when += datetime.timedelta(seconds=float('0.' + fraction))
+    return when
+
+
+def _forget_stale(pending, when):
+    """Forget the oldest entries of the ordered dict pending (whose values are
+    the times they were added), while they are too old or too many.
+    """
+    while pending and (len(pending) > MAX_PENDING or
+                       when - next(iter(pending.values())) >
+                       MAX_PENDING_AGE):
+        pending.popitem(last=False)
+
+
+def _match_marker(markers, line):
+    """Return the (stage, kind) of the first pattern that matches the line,
+    or None.
+    """
+    for keyword, patterns in markers:
+        if keyword in line:
+            for stage, kind, pattern in patterns:
+                if pattern.search(line):
+                    return stage, kind
+    return None
+
+
+def measure(lines, since, until):
+    """Measure the latency of each of the STAGES from the log lines.
+
+    The format of the report is:
+    {
+        'since': '<YYYY-MM-DD HH:MM:SS>',
+        'until': '<YYYY-MM-DD HH:MM:SS>',
+        'stages': {
+            '<stage>': {'count': n, 'failures': n,
+                        'p50': s, 'p90': s, 'p99': s, 'max': s},
+            ...
+        },
+    }
+
+    where count is the number of times the stage was timed and failures the
+    number of requests in which it failed; the percentiles are only reported
+    if count isn't 0.
+
+    :param lines: iterable of the log lines, oldest first.
+    :param since: datetime, the start of the window.
+    :param until: datetime, the end of the window.
+    :returns: dict described above.
+    """
+    since_s = since.strftime(LOG_TIME_FORMAT)
+    until_s = until.strftime(LOG_TIME_FORMAT)
+    markers = _markers()
+    histograms = collections.OrderedDict(
+        (stage.name, Histogram()) for stage in STAGES)
+    failures = dict.fromkeys(histograms, 0)
+    # (request id, stage) -> the start time of stages in progress, and the
+    # failure time of stages that have failed (whose failure may be logged
+    # more than once).
+    pending = collections.OrderedDict()
+    failed = collections.OrderedDict()
+    for line in lines:
+        if line[:19] < since_s:
+            continue
+        marker = _match_marker(markers, line)
+        if marker is None:
+            continue
+        stage, kind = marker
+        match = LOG_LINE.match(line)
+        if match is None:
+            continue
+        timestamp = match.group('timestamp')
+        if timestamp[:19] >= until_s:
+            break
+        when = _log_time(timestamp)
+        request_ids = REQUEST_ID.findall(match.group('context') or '')
+        request_id = request_ids[-1] if request_ids else None
+        key = (request_id, stage.name)
+        if kind == 'failure':
+            pending.pop(key, None)
+            if stage.within is not None:
+                pending.pop((request_id, stage.within), None)
+            # The failure is often only in the lines of a traceback, which
+            # all have the timestamp of the record.
+            if request_id is None:
+                key = (timestamp, stage.name)
+            if key not in failed:
+                failed[key] = when
+                failures[stage.name] += 1
+            _forget_stale(failed, when)
+        elif kind == 'start':
+            if (stage.within is None or
+                    (request_id, stage.within) in pending):
+                # The start of some stages is logged repeatedly while it
+                # waits; it is timed from the first.
+                pending.setdefault(key, when)
+                _forget_stale(pending, when)
+        else:
+            start = pending.pop(key, None)
+            if start is not None:
+                histograms[stage.name].add((when - start).total_seconds())
+    stages = {}
+    for name, histogram in histograms.items():
+        stats = {'count': histogram.count, 'failures': failures[name]}
+        if histogram.count:
+            stats['max'] = round(histogram.max, 3)
+            for pct in PERCENTILES:
+                stats['p{}'.format(pct)] = round(
+                    histogram.percentile(pct), 3)
+        stages[name] = stats
+    return {'since': since_s, 'until': until_s, 'stages': stages}
@@ -0,0 +1,144 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The saved workload status, which update-status sets again when nothing it
+# was assessed from has changed.  This module only uses charmhelpers.core, so
+# that the update-status hook (see hooks/update-status) can do that without
+# loading charms.reactive, charms.openstack or the templating (and jinja2)
+# that they import.
+
+import hashlib
+import json
+import os
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.unitdata as unitdata
+
+# Files written into the charm by the build that identify the charm revision.
+CHARM_REVISION_FILES = ('version', 'revision', 'repo-info')
+# unitdata key holding the last assessed workload status and the fingerprint
+# of what it was assessed from.
+ASSESSED_STATUS_KEY = 'assessed-status'
+# The flags that the status of the required relation is assessed from.
+STATUS_FLAGS = ('manila-plugin.connected', 'manila-plugin.available')
+# The leader settings that the status is assessed from: the SSH keys that the
+# leader generates (manila_generic.SSH_KEYS_LEADER_KEY), which the driver
+# waits for.
+STATUS_LEADER_SETTINGS = ('ssh-keys',)
+# The prefix of the unitdata keys that charms.reactive keeps the flags in.
+FLAG_KEY_PREFIX = 'reactive.states.'
+# Changed by dpkg whenever a package is installed, upgraded or removed.
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+
+def charm_revision():
+    """Return the contents of the files the charm build writes to identify
+    the revision of the charm.
+
+    :returns: dict of file name to contents, for the files that exist.
+    """
+    revision = {}
+    for name in CHARM_REVISION_FILES:
+        try:
+            with open(os.path.join(hookenv.charm_dir(), name)) as f:
+                revision[name] = f.read()
+        except OSError:
+            pass
+    return revision
+
+
+def is_flag_set(flag):
+    """Return True if the charms.reactive flag is set, reading it from the
+    unitdata as charms.reactive does, without importing charms.reactive.
+
+    :param flag: the name of the flag.
+    :returns: boolean
+    """
+    return flag in (unitdata.kv().getrange(FLAG_KEY_PREFIX, strip=True) or
+                    {})
+
+
+def status_fingerprint():
+    """Return a fingerprint of everything the workload status is assessed
+    from: the config, the state of the manila-plugin relation, the leader
+    settings, the installed packages (which give the OpenStack release) and
+    the charm revision.
+
+    This has to be cheap; it is computed on every update-status.
+
+    :returns: string, the hex digest.
+    """
+    try:
+        packages = os.stat(DPKG_STATUS).st_mtime
+    except OSError:
+        packages = None
+    inputs = {
+        'config': dict(hookenv.config()),
+        'flags': [f for f in STATUS_FLAGS if is_flag_set(f)],
+        'leader_settings': {key: hookenv.leader_get(key)
+                            for key in STATUS_LEADER_SETTINGS},
+        'packages': packages,
+        'revision': charm_revision(),
+    }
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def save_status():
+    """Save the current workload status along with the fingerprint of what
+    it was assessed from.
+    """
+    state, message = hookenv.status_get()
+    kv = unitdata.kv()
+    kv.set(ASSESSED_STATUS_KEY, {
+        'fingerprint': status_fingerprint(),
+        'status': [state, message],
+    })
+    kv.flush()
+
+
+def restore_status():
+    """Set the saved workload status again, if nothing it was assessed from
+    has changed since.
+
+    :returns: boolean, True if the status was set; otherwise it needs to be
+        assessed.
+    """
+    saved = unitdata.kv().get(ASSESSED_STATUS_KEY)
+    if not saved or saved['fingerprint'] != status_fingerprint():
+        return False
+    hookenv.status_set(*saved['status'])
+    return True
+
+
+def update_status(started=None):
+    """Run the update-status hook without the reactive framework, if all it
+    has to do is set the saved status again.  The metrics are still written,
+    as the reactive handlers would at exit; a hook that is profiled or
+    recorded needs the framework, so is left to it.
+
+    :param started: float, the time.perf_counter() the hook started at.
+    :returns: boolean, True if the hook is done; otherwise the reactive
+        handlers need to run it.
+    """
+    import charm.openstack.metrics as metrics
+    import charm.openstack.profiling as profiling
+    import charm.openstack.recording as recording
+    if profiling.enabled() or recording.enabled():
+        return False
+    if not restore_status():
+        return False
+    metrics.write_textfile(started)
+    unitdata.kv().flush()
+    return True
@@ -0,0 +1,283 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A small declarative validation engine for the charm's config.  The config
+# is described by a list of rules, each built by one of the functions below;
+# evaluate() checks every rule that applies and returns all the violations,
+# so that an operator sees every problem at once rather than one per hook.
+#
+# The rules are given the config.yaml names of the options (e.g.
+# 'driver-auth-type'), which their messages use, and look the options up
+# through a 'get' function that takes the name the config adapter gives the
+# option (e.g. 'driver_auth_type') and returns its value.
+
+import collections
+import re
+
+# check(get, release) returns True if the rule holds; when(get) returns True
+# if the rule applies, or when is None if it always applies.
+Rule = collections.namedtuple('Rule', ['check', 'message', 'when'])
+
+
+def _attr(option):
+    return option.replace('-', '_')
+
+
+def _network(value):
+    # The IP network in CIDR notation, or None if the value isn't one.
+    import ipaddress
+    try:
+        return ipaddress.ip_network(value)
+    except ValueError:
+        return None
+
+
+def _normalise(value, ignore_case):
+    # An unset string option may be None rather than empty.
+    if value is None:
+        return ''
+    if ignore_case and isinstance(value, str):
+        return value.lower()
+    return value
+
+
+###
+# Conditions, for the 'when' of the rules.
+
+def is_set(option):
+    """The option is set (i.e. true, non-empty or non-zero)."""
+    attr = _attr(option)
+    return lambda get: bool(get(attr))
+
+
+def is_one_of(option, choices, ignore_case=False):
+    """The option is one of the choices."""
+    attr = _attr(option)
+    return lambda get: _normalise(get(attr), ignore_case) in choices
+
+
+def all_of(*conditions):
+    """All the conditions hold."""
+    return lambda get: all(condition(get) for condition in conditions)
+
+
+###
+# Rules
+
+def required(option, when=None, message=None):
+    """The option must be set."""
+    attr = _attr(option)
+    return Rule(lambda get, release: bool(get(attr)),
+                message or "Missing '{}'".format(option),
+                when)
+
+
+def any_of(options, message, when=None):
+    """At least one of the options must be set."""
+    attrs = [_attr(option) for option in options]
+    return Rule(lambda get, release: any(get(attr) for attr in attrs),
+                message,
+                when)
+
+
+def together(options, when=None):
+    """The options must be set together, or not at all."""
+    attrs = [_attr(option) for option in options]
+    return Rule(
+        lambda get, release: len({bool(get(attr)) for attr in attrs}) == 1,
+        "{} must be set together".format(
+            ' and '.join("'{}'".format(option) for option in options)),
+        when)
+
+
+def one_of(option, choices, ignore_case=False, when=None):
+    """The option must be one of the choices.  An empty choice is allowed,
+    but not listed in the message."""
+    attr = _attr(option)
+    return Rule(
+        lambda get, release: _normalise(get(attr), ignore_case) in choices,
+        "'{}' must be one of {}".format(
+            option, ', '.join(sorted(c for c in choices if c))),
+        when)
+
+
+def between(option, low, high, when=None):
+    """The option must be between low and high, inclusive."""
+    attr = _attr(option)
+    return Rule(lambda get, release: low <= get(attr) <= high,
+                "'{}' must be between {} and {}".format(option, low, high),
+                when)
+
+
+def not_negative(option, when=None):
+    """The option must not be negative."""
+    attr = _attr(option)
+    return Rule(lambda get, release: get(attr) >= 0,
+                "'{}' must not be negative".format(option),
+                when)
+
+
+def not_more_than(option, other, when=None):
+    """The option must not be more than the other option."""
+    attr, other_attr = _attr(option), _attr(other)
+    return Rule(lambda get, release: get(attr) <= get(other_attr),
+                "'{}' must not be more than '{}'".format(option, other),
+                when)
+
+
+def network(option, when=None):
+    """The option must be an IP network, in CIDR notation."""
+    attr = _attr(option)
+    return Rule(lambda get, release: _network(get(attr)) is not None,
+                "'{}' must be a network in CIDR notation".format(option),
+                when or is_set(option))
+
+
+def divides_network(option, network_option, default_network, when=None):
+    """The option, a prefix length, must divide the network (that of the
+    network option, or the default network if it isn't set) into subnets of
+    at least 4 addresses.  An invalid network is left to the network rule."""
+    attr, network_attr = _attr(option), _attr(network_option)
+
+    def check(get, release):
+        net = _network(get(network_attr) or default_network)
+        return (net is None or
+                net.prefixlen < get(attr) <= net.max_prefixlen - 2)
+    return Rule(check,
+                "'{}' must be longer than the prefix of '{}', leaving at "
+                "least 4 addresses in each subnet".format(option,
+                                                          network_option),
+                when or is_set(option))
+
+
+def name_template(option, when=None):
+    """The option must be a template for a name, with a single '%s' that is
+    replaced by an ID (as manila does with its name templates)."""
+    attr = _attr(option)
+
+    def check(get, release):
+        value = get(attr)
+        try:
+            value % ('',)
+        except (TypeError, ValueError):
+            return False
+        return '%s' in value
+    return Rule(check,
+                "'{}' must contain '%s' once, for the ID".format(option),
+                when or is_set(option))
+
+
+def uuid(option, when=None):
+    """The option must be a UUID (e.g. the ID of a neutron network)."""
+    attr = _attr(option)
+
+    def check(get, release):
+        import uuid as _uuid
+        try:
+            _uuid.UUID(get(attr))
+        except ValueError:
+            return False
+        return True
+    return Rule(check,
+                "'{}' must be a UUID".format(option),
+                when or is_set(option))
+
+
+def pairs(option, values, when=None):
+    """The option must be whitespace or comma separated name=value pairs,
+    each value one of the values (ignoring case)."""
+    attr = _attr(option)
+
+    def check(get, release):
+        try:
+            return all(value.upper() in values
+                       for _, value in parse_pairs(get(attr)))
+        except ValueError:
+            return False
+    return Rule(check,
+                "'{}' must be name=value pairs, with values one of {}".format(
+                    option, ', '.join(values)),
+                when or is_set(option))
+
+
+def parse_pairs(value):
+    """Parse whitespace or comma separated name=value pairs.
+
+    :raises ValueError: if an item isn't a name=value pair.
+    :returns: list of (name, value) tuples, in order.
+    """
+    result = []
+    for item in (value or '').replace(',', ' ').split():
+        name, sep, item_value = item.partition('=')
+        if not (name and sep and item_value):
+            raise ValueError(item)
+        result.append((name, item_value))
+    return result
+
+
+def one_line(option, when=None):
+    """The option must be on one line, as it is rendered as the value of an
+    option in an ini file."""
+    attr = _attr(option)
+    return Rule(lambda get, release: '\n' not in get(attr).strip(),
+                "'{}' must be on one line".format(option),
+                when or is_set(option))
+
+
+# The characters allowed in the name of an ini file section.
+_SECTION_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+def section_name(option, reserved, when=None, message=None):
+    """The option must be usable as the name of a section of an ini file:
+    letters, digits, '_', '.' or '-' only, and not one of the reserved
+    sections (ignoring case)."""
+    attr = _attr(option)
+    reserved_names = {name.lower() for name in reserved}
+
+    def check(get, release):
+        value = get(attr)
+        return (isinstance(value, str) and
+                _SECTION_NAME.fullmatch(value) is not None and
+                value.lower() not in reserved_names)
+    default_message = (
+        "'{}' must be letters, digits, '_', '.' or '-', and not one of "
+        "{}".format(option, ', '.join(reserved)))
+    return Rule(check, message or default_message, when)
+
+
+def since_release(option, min_release, when=None, message=None):
+    """The option may only be set (or, given when, take some value) from the
+    OpenStack release on."""
+    def check(get, release):
+        import charmhelpers.contrib.openstack.utils as os_utils
+        return os_utils.CompareOpenStackReleases(release) >= min_release
+    return Rule(check,
+                message or "'{}' needs OpenStack {} or later".format(
+                    option, min_release),
+                when or is_set(option))
+
+
+def evaluate(rules, get, release):
+    """Evaluate every rule that applies.
+
+    :param rules: the rules, in the order to report their violations.
+    :param get: function returning the value of an option, by the name the
+        config adapter gives it.
+    :param release: the OpenStack release that manila is running.
+    :returns: list of strings, the messages of the rules that don't hold.
+    """
+    return [rule.message for rule in rules
+            if (rule.when is None or rule.when(get)) and
+            not rule.check(get, release)]
@@ -14,18 +14,44 @@
 
 # this is just for the reactive handlers and calls into the charm.
 
+import charmhelpers.core.hookenv as hookenv
 import charms.reactive
 import charms_openstack.charm
 
 # This charm's library contains all of the handler code associated with
 # manila -- we need to import it to get the definitions for the charm.
 import charm.openstack.manila_generic  # noqa
+import charm.openstack.metrics as metrics
+import charm.openstack.profiling as profiling
+import charm.openstack.recording as recording
+import charm.openstack.status as status
 
 
+# Set when the leader settings change, until the SSH keys in them are
+# installed and the configuration that uses them is published.
+LEADER_SETTINGS_CHANGED = 'manila-generic.leader-settings.changed'
+
 # Use the charms.openstack defaults for common states and hooks
-charms_openstack.charm.use_defaults(
-    'charm.installed',
-    'update-status')
+charms_openstack.charm.use_defaults('charm.installed')
+
+# Time every hook, and write the metrics at the end of it if they are enabled.
+metrics.register()
+# Profile every hook from here, if profiling is enabled.
+profiling.register()
+# Record every hook, if recording is enabled, from the state it starts with.
+recording.register()
+
+
+@charms.reactive.hook('update-status')
+def update_status():
+    """Set the status again from the last assessment if nothing it depends
+    on has changed; this avoids building the charm instance and its adapters
+    on every update-status.  Otherwise assess the status as usual."""
+    if status.restore_status():
+        return
+    with charms_openstack.charm.provide_charm_instance() as generic_charm:
+        hookenv.application_version_set(generic_charm.application_version)
+        generic_charm.assess_status()
 
 
 @charms.reactive.when('manila-plugin.changed')
@@ -34,15 +60,18 @@ charms_openstack.charm.use_defaults(
 def send_config(manila_plugin):
     """Send the configuration over to the prinicpal charm"""
     with charms_openstack.charm.provide_charm_instance() as generic_charm:
-        # set the name of the backend using the configuration option
-        manila_plugin.name = generic_charm.options.share_backend_name
-        # Set the configuration data for the principal charm.
-        manila_plugin.configuration_data = (
-            generic_charm.get_config_for_principal(
-                manila_plugin.authentication_data))
+        with profiling.stage('options'):
+            # The options and adapters are built on first use; do it here so
+            # that they are timed on their own.
+            generic_charm.options
+        # The leader generates the SSH keys, if they are needed, before the
+        # configuration that uses them is rendered.
         generic_charm.maybe_write_ssh_keys()
-        generic_charm.assess_status()
+        generic_charm.publish_config_to_principal(manila_plugin)
+        with profiling.stage('assess-status'):
+            generic_charm.assess_status()
         manila_plugin.clear_changed()
+        charms.reactive.clear_flag(LEADER_SETTINGS_CHANGED)
 
 
 @charms.reactive.when('manila-plugin.available',
@@ -50,3 +79,19 @@ def send_config(manila_plugin):
 @charms.reactive.when_not('update-status')
 def update_config(manila_plugin):
     send_config(manila_plugin)
+
+
+@charms.reactive.hook('leader-settings-changed')
+def leader_settings_changed():
+    """The leader may have generated or rotated the SSH keys."""
+    charms.reactive.set_flag(LEADER_SETTINGS_CHANGED)
+
+
+@charms.reactive.when('manila-plugin.available',
+                      LEADER_SETTINGS_CHANGED)
+@charms.reactive.when_not('config.changed',
+                          'update-status')
+def update_ssh_keys(manila_plugin):
+    """Install the SSH keys shared by the leader and publish the
+    configuration that uses them."""
+    send_config(manila_plugin)
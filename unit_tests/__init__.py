@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import sys
+from unittest import mock
 
 sys.path.append('src')
 sys.path.append('src/lib')
@@ -20,3 +21,6 @@ sys.path.append('src/lib')
 # Mock out charmhelpers so that we can test without it.
 import charms_openstack.test_mocks  # noqa
 charms_openstack.test_mocks.mock_charmhelpers()
+
+# Mock out the layer:basic bootstrap that the actions run at import time.
+sys.modules['charms.layer'] = mock.MagicMock()
@@ -0,0 +1,177 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run the benchmarks, from the root of the repository:
+#
+#     python -m unit_tests.benchmarks [--save-baseline] [--threshold 0.25]
+#
+# Each benchmark is run for each scenario, and its latency distribution and
+# throughput are reported.  A calibration workload that doesn't depend on the
+# charm is timed before and after them, and each benchmark's median is
+# divided by the calibration's: the baseline stores these ratios, not times,
+# so that it holds on any machine.  The run fails if the ratio of any
+# benchmark is more than the threshold above the baseline's.
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import timeit
+
+import unit_tests.benchmarks.scenarios as scenarios
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_ROUNDS = 30
+# Each round runs a benchmark for at least this long, to make timer overhead
+# negligible for the fast ones.
+MIN_ROUND_TIME = 0.01
+
+
+def percentile(values, pct):
+    """Return the pct percentile of the sorted values, by nearest rank."""
+    rank = max(-(-len(values) * pct // 100) - 1, 0)
+    return values[int(rank)]
+
+
+def measure(run, rounds):
+    """Time the callable, returning the latency distribution of one call
+    across the rounds.
+
+    :returns: dict of statistic to seconds, and 'ops' for calls per second.
+    """
+    timer = timeit.Timer(run)
+    # warm up, and find the number of calls that fills a round.
+    number = 1
+    while True:
+        if timer.timeit(number) >= MIN_ROUND_TIME:
+            break
+        number *= 2
+    samples = sorted(t / number for t in timer.repeat(rounds, number))
+    median = statistics.median(samples)
+    return {
+        'min': samples[0],
+        'median': median,
+        'mean': statistics.mean(samples),
+        'stddev': statistics.pstdev(samples),
+        'p90': percentile(samples, 90),
+        'p99': percentile(samples, 99),
+        'max': samples[-1],
+        'ops': 1.0 / median,
+    }
+
+
+def calibrate(rounds):
+    """Return the median latency of the calibration workload."""
+    return measure(scenarios.calibration(), rounds)['median']
+
+
+def run_benchmarks(rounds, selected=None):
+    """Run the benchmarks, and the calibration before and after them.
+
+    :returns: dict of benchmark name to its statistics, as measure() returns
+        them, and 'ratio', its median relative to the calibration's.
+    """
+    before = calibrate(rounds)
+    results = {}
+    for scenario_name in sorted(scenarios.CONFIGS):
+        with scenarios.Scenario(scenario_name) as scenario:
+            for bench in scenarios.BENCHMARKS:
+                name = '{}[{}]'.format(bench.__name__, scenario_name)
+                if selected and not any(s in name for s in selected):
+                    continue
+                results[name] = measure(bench(scenario), rounds)
+    # The mean of the two, as the machine may have slowed down or sped up.
+    calibration = (before + calibrate(rounds)) / 2
+    for stats in results.values():
+        stats['ratio'] = stats['median'] / calibration
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return the benchmarks whose ratio to the calibration is more than
+    threshold above the baseline's, as a list of (name, baseline ratio,
+    ratio).
+    """
+    regressions = []
+    for name, stats in sorted(results.items()):
+        try:
+            base = baseline[name]
+        except KeyError:
+            continue
+        if stats['ratio'] > base * (1.0 + threshold):
+            regressions.append((name, base, stats['ratio']))
+    return regressions
+
+
+def report(results, baseline):
+    row = "{:<60} {:>10} {:>10} {:>10} {:>10} {:>12} {:>8} {:>8}"
+    print(row.format('benchmark', 'min (us)', 'median', 'p90', 'p99',
+                     'ops/s', 'ratio', 'vs base'))
+    for name, stats in sorted(results.items()):
+        try:
+            change = "{:+.0%}".format(stats['ratio'] / baseline[name] - 1.0)
+        except KeyError:
+            change = '-'
+        print(row.format(
+            name,
+            *("{:.1f}".format(stats[k] * 1e6)
+              for k in ('min', 'median', 'p90', 'p99')),
+            "{:.0f}".format(stats['ops']),
+            "{:.2f}".format(stats['ratio']),
+            change))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog='python -m unit_tests.benchmarks')
+    parser.add_argument('benchmarks', nargs='*',
+                        help="only run benchmarks whose name contains one of "
+                             "these")
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="the fraction a ratio may be above the "
+                             "baseline's before the run fails")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="save the results as the new baseline")
+    parser.add_argument('--json', help="also write the results to this file")
+    options = parser.parse_args(args)
+
+    results = run_benchmarks(options.rounds, options.benchmarks)
+    try:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {}
+    report(results, baseline)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.save_baseline:
+        baseline.update((name, float('{:.3g}'.format(stats['ratio'])))
+                        for name, stats in results.items())
+        with open(options.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return 0
+    regressions = compare(results, baseline, options.threshold)
+    for name, base, ratio in regressions:
+        print("REGRESSION {}: {:.2f}x the calibration, baseline "
+              "{:.2f}x".format(name, ratio, base))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
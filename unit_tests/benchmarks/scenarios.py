@@ -0,0 +1,259 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The benchmarked code paths, each run against a set of realistic charm
+# configurations and authentication data from the principal charm.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import types
+from unittest import mock
+
+
+# Sets up the paths and the charmhelpers mocks, as for the unit tests.
+import unit_tests  # noqa
+
+import charm.openstack.manila_generic as manila_generic
+import charm.openstack.profiling as profiling
+
+from unit_tests.helpers import (
+    CompareOpenStackReleases,
+    RELEASE,
+    TEMPLATES_DIR,
+    default_config,
+    get_loader,
+)
+
+# Placeholders of the size of an ed25519 key pair; the charm only writes
+# the keys to files, so they needn't be real.
+SSH_KEY = '\n'.join(['placeholder private key'] + ['x' * 70] * 3)
+SSH_KEY_PUBLIC = 'placeholder-public-key ' + 'x' * 68 + ' manila@share'
+
+AUTH_DATA = {
+    'username': 'manila',
+    'password': 'Zk3pXr9bT2qLwY7cVn4s',
+    'project_domain_name': 'service_domain',
+    'project_name': 'services',
+    'user_domain_name': 'service_domain',
+    'auth_uri': 'https://keystone.internal.example.com:5000/v3',
+    'auth_url': 'https://keystone.internal.example.com:35357/v3',
+    'auth_type': 'password',
+}
+
+# The configurations, as changes to the config.yaml defaults.
+CONFIGS = {
+    'password': {
+        'driver-service-instance-flavor-id': 100,
+        'driver-auth-type': 'password',
+        'driver-service-instance-password': 'manila-service-password',
+    },
+    'ssh': {
+        'driver-service-instance-flavor-id': 100,
+        'driver-auth-type': 'ssh',
+        'driver-service-ssh-key': SSH_KEY,
+        'driver-service-ssh-key-public': SSH_KEY_PUBLIC,
+    },
+    'both': {
+        'driver-service-instance-flavor-id': 100,
+        'driver-auth-type': 'both',
+        'driver-service-instance-password': 'manila-service-password',
+        'driver-service-ssh-key': SSH_KEY,
+        'driver-service-ssh-key-public': SSH_KEY_PUBLIC,
+    },
+    'dhss-off': {
+        'driver-handles-share-servers': False,
+    },
+    'backends': {
+        'driver-service-instance-flavor-id': 100,
+        'driver-auth-type': 'password',
+        'driver-service-instance-password': 'manila-service-password',
+        'backends': """
+            - name: fast
+              driver-service-instance-flavor-id: 200
+            - name: bulk
+            - name: simple
+              driver-handles-share-servers: false
+            """,
+    },
+}
+
+
+class Scenario(object):
+    """A charm configuration with the hookenv and the template loader patched
+    to use it, so that the real charm code can be run offline.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.config = default_config()
+        self.config.update(CONFIGS[name])
+        self.charm_dir = tempfile.mkdtemp()
+        self._patches = []
+
+    def __enter__(self):
+        config = self.config
+
+        def _config(key=None):
+            if key is not None:
+                return config.get(key)
+            return config
+
+        for patcher in (
+                mock.patch.object(manila_generic.hookenv, 'config',
+                                  side_effect=_config),
+                mock.patch.object(manila_generic.hookenv, 'charm_dir',
+                                  return_value=self.charm_dir),
+                mock.patch.object(manila_generic.hookenv, 'relation_ids',
+                                  return_value=['manila-plugin:12']),
+                # No SSH keys have been generated by the leader.
+                mock.patch.object(manila_generic.hookenv, 'leader_get',
+                                  return_value=None),
+                mock.patch.object(manila_generic, 'TEMPLATES_DIR',
+                                  new=TEMPLATES_DIR),
+                mock.patch(
+                    'charmhelpers.contrib.openstack.templating.get_loader',
+                    side_effect=get_loader),
+                mock.patch(
+                    'charmhelpers.contrib.openstack.utils'
+                    '.get_os_codename_package',
+                    return_value=RELEASE),
+                mock.patch(
+                    'charmhelpers.contrib.openstack.utils'
+                    '.CompareOpenStackReleases',
+                    new=CompareOpenStackReleases),
+                mock.patch.object(profiling, 'enabled', return_value=False)):
+            patcher.start()
+            self._patches.append(patcher)
+        manila_generic._template_environments.clear()
+        return self
+
+    def __exit__(self, *args):
+        for patcher in reversed(self._patches):
+            patcher.stop()
+        manila_generic._template_environments.clear()
+        shutil.rmtree(self.charm_dir, ignore_errors=True)
+
+    def charm(self):
+        return manila_generic.ManilaGenericCharm()
+
+    def context(self, charm):
+        return {
+            'options': charm.options,
+            'manila_plugin': types.SimpleNamespace(
+                authentication_data=AUTH_DATA),
+        }
+
+    def clear_template_caches(self):
+        manila_generic._template_environments.clear()
+        shutil.rmtree(
+            os.path.join(self.charm_dir, manila_generic.TEMPLATE_CACHE_DIR),
+            ignore_errors=True)
+
+
+def bench_render_cached(scenario):
+    """Render manila.conf with the compiled templates cached."""
+    charm = scenario.charm()
+    context = scenario.context(charm)
+
+    def run():
+        manila_generic.render_template(
+            'manila.conf', charm.template_release, context)
+    return run
+
+
+def bench_render_compiled_cache(scenario):
+    """Render manila.conf as the first render of a hook, with the templates
+    loaded from the compiled template cache."""
+    charm = scenario.charm()
+    context = scenario.context(charm)
+
+    def run():
+        manila_generic._template_environments.clear()
+        manila_generic.render_template(
+            'manila.conf', charm.template_release, context)
+    return run
+
+
+def bench_render_cold(scenario):
+    """Render manila.conf as the first render on a unit, compiling the
+    templates from source."""
+    charm = scenario.charm()
+    context = scenario.context(charm)
+
+    def run():
+        scenario.clear_template_caches()
+        manila_generic.render_template(
+            'manila.conf', charm.template_release, context)
+    return run
+
+
+def bench_custom_assess_status_check(scenario):
+    """Validate the configuration, as the first check of a hook."""
+    charm = scenario.charm()
+
+    def run():
+        charm._memo = None
+        charm.custom_assess_status_check()
+    return run
+
+
+def bench_computed_properties(scenario):
+    """Evaluate the computed_* config properties."""
+    options = scenario.charm().options
+    properties = (manila_generic.computed_use_password,
+                  manila_generic.computed_use_ssh,
+                  manila_generic.computed_define_ssh,
+                  manila_generic.computed_debug_level)
+
+    def run():
+        for p in properties:
+            p(options)
+    return run
+
+
+def bench_principal_config_fingerprint(scenario):
+    """Fingerprint the inputs of the principal's configuration."""
+    charm = scenario.charm()
+
+    def run():
+        charm.principal_config_fingerprint(AUTH_DATA)
+    return run
+
+
+def calibration():
+    """A fixed workload of the kind the benchmarked code does (formatting
+    lines, and encoding and hashing a dict of strings) that doesn't depend on
+    the charm.  The benchmarks' baselines are relative to it, so that they
+    hold on any machine."""
+    data = {'option-{}'.format(i): 'value {} '.format(i) * 4
+            for i in range(50)}
+
+    def run():
+        '\n'.join('{} = {}'.format(k, v) for k, v in sorted(data.items()))
+        hashlib.sha256(
+            json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    return run
+
+
+BENCHMARKS = (
+    bench_render_cached,
+    bench_render_compiled_cache,
+    bench_render_cold,
+    bench_custom_assess_status_check,
+    bench_computed_properties,
+    bench_principal_config_fingerprint,
+)
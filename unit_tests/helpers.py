@@ -0,0 +1,77 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Stand-ins and fixtures shared by the unit tests, the simulator and the
+# benchmarks, which all run the charm's code offline from the root of the
+# repository.
+
+import json
+import os
+
+import jinja2
+import yaml
+
+# The OpenStack releases, in order, as charmhelpers knows them.
+RELEASES = ('mitaka', 'newton', 'ocata', 'pike', 'queens', 'rocky', 'stein',
+            'train', 'ussuri', 'victoria', 'wallaby', 'xena', 'yoga', 'zed',
+            'antelope', 'bobcat', 'caracal')
+# The release of the installed manila-common package.
+RELEASE = 'caracal'
+
+CONFIG_YAML = os.path.join('src', 'config.yaml')
+# The charm's templates, for manila_generic.TEMPLATES_DIR.
+TEMPLATES_DIR = os.path.join('src', 'templates/')
+
+
+class CompareOpenStackReleases(object):
+    """Stand-in for charmhelpers' CompareOpenStackReleases."""
+
+    def __init__(self, release):
+        self.index = RELEASES.index(release)
+
+    def __lt__(self, other):
+        return self.index < RELEASES.index(other)
+
+    def __ge__(self, other):
+        return self.index >= RELEASES.index(other)
+
+
+def get_loader(templates_dir, release):
+    """Stand-in for charmhelpers' templating.get_loader(): the templates for
+    the release and the earlier releases, newest first, then the base
+    templates."""
+    releases = RELEASES[:RELEASES.index(release) + 1]
+    return jinja2.FileSystemLoader(
+        [os.path.join(templates_dir, r) for r in reversed(releases)] +
+        [templates_dir])
+
+
+def default_config():
+    """Return the charm config defaults from config.yaml.
+
+    :returns: dict of option name to default value.
+    """
+    with open(CONFIG_YAML) as f:
+        options = yaml.safe_load(f)['options']
+    return {name: option.get('default') for name, option in options.items()}
+
+
+def generated_keys(*generations):
+    """Return the leader setting of the generated SSH keys, with the
+    generations given and the last one current."""
+    return json.dumps({
+        'current': generations[-1],
+        'keys': {str(g): {'private': 'private key {}'.format(g),
+                          'public': 'public key {}'.format(g)}
+                 for g in generations}})
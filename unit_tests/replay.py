@@ -0,0 +1,194 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Replay a trace of real hooks, recorded by charm.openstack.recording, on the
+# simulator's in-memory unit, from the root of the repository:
+#
+#     python -m unit_tests.replay TRACE [--save REPORT] [--baseline REPORT]
+#
+# Each recorded hook is run with the config, flags, leader settings and
+# principal's data that it started with, and its latency, renders and status
+# checks are reported along with whether it published the same configuration
+# as the recorded hook did.  To compare two revisions of the charm, replay
+# the trace on one with --save, then on the other with --baseline: the
+# latencies are compared and the payloads diffed against the baseline's
+# instead of the recording's.
+#
+# The unit starts without the unitdata of the recorded one, so the first
+# hooks may render and publish where the recorded ones didn't need to.
+
+import argparse
+import collections
+import difflib
+import json
+import sys
+import time
+
+import charm.openstack.metrics as metrics
+import charm.openstack.recording as recording
+
+from unit_tests import helpers
+from unit_tests import simulator
+
+# What a replayed hook did; 'published' is the redacted relation data it
+# left, and 'diff' its differences from the expected relation data (a list
+# of lines, empty if there are none).
+HookResult = collections.namedtuple(
+    'HookResult', ['hook', 'seconds', 'renders', 'status_checks',
+                   'relation_writes', 'published', 'diff'])
+
+
+def _published(data):
+    # The relation data, as the recorder records it.
+    return recording.redact({'name': data.get('name'),
+                             'configuration_data':
+                                 data.get('configuration_data')})
+
+
+def _lines(published):
+    # The relation data as lines, with each rendered file's lines its own.
+    lines = ['name: {}'.format(published.get('name'))]
+    for path, value in sorted(
+            (published.get('configuration_data') or {}).items()):
+        lines.append('== {}'.format(path))
+        if not isinstance(value, str):
+            value = json.dumps(value, indent=1, sort_keys=True)
+        lines.extend(value.splitlines())
+    return lines
+
+
+def _diff(expected, published):
+    if expected is None or expected == published:
+        return []
+    return list(difflib.unified_diff(_lines(expected), _lines(published),
+                                     'expected', 'replayed', lineterm=''))
+
+
+def replay(records, release=helpers.RELEASE, baseline=None):
+    """Replay the recorded hooks, in order, on a new unit.
+
+    :param records: iterable of the trace's records.
+    :param release: the OpenStack release of the installed packages.
+    :param baseline: the results of an earlier replay of the same trace, to
+        diff the payloads against instead of the recorded ones.
+    :returns: list of HookResult
+    """
+    results = []
+    with simulator.Simulation(release=release) as unit:
+        for index, record in enumerate(records):
+            unit.config = helpers.default_config()
+            unit.config.update(record['config'])
+            unit.flags.clear()
+            unit.flags.update(record['flags'])
+            unit.leader = record['leader']
+            unit.leader_settings = dict(record['leader_settings'])
+            plugin = record['manila_plugin'] or {}
+            auth_data = plugin.get('authentication_data')
+            # As the interface does during the hook, which is after the
+            # flags were recorded.
+            if auth_data != unit.endpoint.authentication_data:
+                unit.flags.add(simulator.CHANGED)
+            unit.endpoint.authentication_data = auth_data
+            if simulator.CONNECTED in unit.flags:
+                unit._relation_id = unit._relation_id or 1
+            start = time.perf_counter()
+            counted = unit.dispatch_hook(record['hook'])
+            seconds = time.perf_counter() - start
+            published = _published(unit.endpoint.data)
+            if baseline is not None:
+                expected = baseline[index].published
+            else:
+                expected = plugin.get('published')
+            results.append(HookResult(
+                hook=record['hook'],
+                seconds=seconds,
+                renders=counted['renders'],
+                status_checks=metrics.hook_work()['status_checks'],
+                relation_writes=counted['relation_writes'],
+                published=published,
+                diff=_diff(expected, published)))
+    return results
+
+
+def load_results(path):
+    """Return the results saved by save_results().
+
+    :returns: list of HookResult
+    """
+    with open(path) as f:
+        return [HookResult(**result) for result in json.load(f)]
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump([result._asdict() for result in results], f, indent=1,
+                  sort_keys=True)
+
+
+def format_results(results, baseline=None):
+    """Format the results as a table of the hooks, followed by the diffs of
+    the payloads that differ.
+
+    :returns: string
+    """
+    lines = ['{:>4}  {:<36} {:>10} {:>8} {:>7} {:>7}  {}'.format(
+        '#', 'hook', 'ms', 'change', 'renders', 'checks', 'payload')]
+    diffs = []
+    for index, result in enumerate(results):
+        change = ''
+        if baseline is not None and baseline[index].seconds:
+            change = '{:+.0%}'.format(
+                result.seconds / baseline[index].seconds - 1)
+        lines.append('{:>4}  {:<36} {:>10.2f} {:>8} {:>7} {:>7}  {}'.format(
+            index, result.hook, result.seconds * 1000, change,
+            result.renders, result.status_checks,
+            'DIFFERS' if result.diff else 'same'))
+        if result.diff:
+            diffs.append('#{} {}'.format(index, result.hook))
+            diffs.extend(result.diff)
+    total = sum(result.seconds for result in results)
+    lines.append('{} hooks in {:.2f} ms, {} renders; {} payloads '
+                 'differ'.format(len(results), total * 1000,
+                                 sum(result.renders for result in results),
+                                 sum(1 for result in results if result.diff)))
+    return '\n'.join(lines + diffs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m unit_tests.replay',
+        description="Replay a trace of the charm's hooks.")
+    parser.add_argument('trace', help="the trace, as recorded with the "
+                                      "'record-hooks' config option")
+    parser.add_argument('--release', default=helpers.RELEASE,
+                        help="the OpenStack release of the manila packages")
+    parser.add_argument('--save', metavar='REPORT',
+                        help="save the results, to be the baseline of "
+                             "another replay")
+    parser.add_argument('--baseline', metavar='REPORT',
+                        help="compare with the results of an earlier replay")
+    args = parser.parse_args(argv)
+    baseline = load_results(args.baseline) if args.baseline else None
+    records = list(recording.read_records(args.trace))
+    if baseline is not None and len(baseline) != len(records):
+        parser.error("the baseline is of a different trace")
+    results = replay(records, args.release, baseline)
+    print(format_results(results, baseline))
+    if args.save:
+        save_results(results, args.save)
+    return 1 if any(result.diff for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
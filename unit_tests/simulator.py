@@ -0,0 +1,692 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# An offline simulator of sequences of hooks.  It drives the charm's real
+# reactive handlers, dispatched on the flags as charms.reactive would, against
+# an in-memory unit: the config, the flags, the unitdata, the leader settings,
+# its /etc/manila (in a temporary directory) and a stand-in for the
+# manila-plugin endpoint.  Each hook is run as a fresh
+# process would run it, so nothing is cached from one hook to the next.
+#
+# A simulation counts the hooks, renders, relation writes and key file writes
+# of a sequence of events, then runs update-status until the unit is
+# quiescent: the hook renders and writes nothing, and no relation change is
+# left unhandled.  Its report flags a sequence that never gets there, that
+# settles on a different configuration than a unit deployed with the final
+# config would publish, that writes something without changing it, or whose
+# hooks render the configuration or check the config more than once each.
+
+import collections
+import contextlib
+import glob
+import grp
+import importlib
+import os
+import pwd
+import random
+import shutil
+import tempfile
+from unittest import mock
+
+
+import charms.reactive
+import charms_openstack.charm
+
+import charm.openstack.files as files
+import charm.openstack.manila_generic as manila_generic
+import charm.openstack.metrics as metrics
+import charm.openstack.profiling as profiling
+import charm.openstack.recording as recording
+import charm.openstack.status as status
+import reactive.manila_generic_handlers as handlers
+
+from unit_tests.helpers import (
+    CompareOpenStackReleases,
+    RELEASE,
+    TEMPLATES_DIR,
+    default_config,
+    get_loader,
+)
+
+# The update-status hooks run after a sequence before it is deemed to never
+# converge.
+MAX_SETTLE_HOOKS = 5
+
+# The flags of the manila-plugin endpoint.
+CONNECTED = 'manila-plugin.connected'
+AVAILABLE = 'manila-plugin.available'
+CHANGED = 'manila-plugin.changed'
+
+AUTH_DATA = {
+    'username': 'manila',
+    'password': 'pass',
+    'project_domain_name': 'service_domain',
+    'project_name': 'services',
+    'user_domain_name': 'service_domain',
+    'auth_uri': 'https://keystone.example.com:5000/v3',
+    'auth_url': 'https://keystone.example.com:35357/v3',
+    'auth_type': 'password',
+}
+
+# A config that the charm accepts, as changes to the config.yaml defaults.
+VALID_CONFIG = {
+    'driver-service-instance-flavor-id': 100,
+    'driver-auth-type': 'password',
+    'driver-service-instance-password': 'secret',
+}
+
+# The changes that random sequences make to the config.  Some block the
+# charm, and some don't change the configuration sent to manila.
+CONFIG_CHANGES = (
+    {'driver-service-instance-flavor-id': 200},
+    {'driver-service-instance-flavor-id': 0},
+    {'driver-auth-type': 'ssh',
+     'driver-service-ssh-key': 'private key',
+     'driver-service-ssh-key-public': 'public key'},
+    {'driver-auth-type': 'password'},
+    {'driver-service-ssh-key': '', 'driver-service-ssh-key-public': ''},
+    {'driver-performance-profile': 'burst'},
+    {'driver-performance-profile': 'default'},
+    {'relation-payload-format': 'structured'},
+    {'relation-payload-format': 'string'},
+    {'backends': '- name: fast\n- name: bulk\n'
+                 '  driver-handles-share-servers: false\n'},
+    {'backends': ''},
+    {'debug': True},
+    {'debug': False},
+)
+
+# The authentication data that random sequences set on the relation.
+AUTH_CHANGES = (
+    AUTH_DATA,
+    dict(AUTH_DATA, password='rotated'),
+    None,
+)
+
+# A hook to run; 'config' is the changes to the config (for config-changed),
+# 'auth_data' the principal's data (for manila-plugin-relation-changed) and
+# 'leader_settings' the changes to the leader settings (for
+# leader-settings-changed).
+Event = collections.namedtuple(
+    'Event', ['hook', 'config', 'auth_data', 'leader_settings'],
+    defaults=(None,))
+
+# A reactive handler, and the hooks and flags it is registered for.
+Handler = collections.namedtuple(
+    'Handler', ['function', 'hooks', 'when', 'when_not'])
+
+
+def install():
+    return Event('install', None, None)
+
+
+def config_changed(changes):
+    return Event('config-changed', changes, None)
+
+
+def relation_joined():
+    return Event('manila-plugin-relation-joined', None, None)
+
+
+def relation_changed(auth_data=AUTH_DATA):
+    return Event('manila-plugin-relation-changed', None, auth_data)
+
+
+def relation_departed():
+    return Event('manila-plugin-relation-departed', None, None)
+
+
+def update_status():
+    return Event('update-status', None, None)
+
+
+def leader_settings_changed(changes):
+    return Event('leader-settings-changed', None, None, changes)
+
+
+def random_events(rng, count):
+    """Return a random, but possible, sequence of events: the relation is
+    only changed or departed once it is joined.
+
+    :param rng: random.Random
+    :param count: the number of events after the install.
+    :returns: list of Event
+    """
+    events = [install()]
+    joined = False
+    for _ in range(count):
+        choice = rng.choice(('config', 'config', 'relation', 'relation',
+                             'departed', 'update-status'))
+        if choice == 'config':
+            events.append(config_changed(rng.choice(CONFIG_CHANGES)))
+        elif choice == 'update-status':
+            events.append(update_status())
+        elif not joined:
+            # relation-changed always follows relation-joined, whether or not
+            # the principal has set its data yet.
+            events.append(relation_joined())
+            events.append(relation_changed(rng.choice(AUTH_CHANGES)))
+            joined = True
+        elif choice == 'relation':
+            events.append(relation_changed(rng.choice(AUTH_CHANGES)))
+        else:
+            events.append(relation_departed())
+            joined = False
+    return events
+
+
+# The handlers, as loaded by load_handlers().
+_handlers = None
+
+
+def load_handlers():
+    """Return the charm's reactive handlers, in the order that they are
+    registered, by importing the handlers module again with the decorators
+    recording what each handler is registered for.  This is done once.
+
+    :returns: list of Handler
+    """
+    global _handlers
+    if _handlers is not None:
+        return _handlers
+    registered = collections.OrderedDict()
+
+    def recorder(kind):
+        def decorator(*args):
+            def register(function):
+                entry = registered.setdefault(
+                    function.__name__,
+                    {'hook': (), 'when': (), 'when_not': ()})
+                entry[kind] += args
+                return function
+            return register
+        return decorator
+
+    with mock.patch.object(charms.reactive, 'hook', new=recorder('hook')), \
+            mock.patch.object(charms.reactive, 'when', new=recorder('when')), \
+            mock.patch.object(charms.reactive, 'when_not',
+                              new=recorder('when_not')), \
+            mock.patch.object(charms_openstack.charm, 'use_defaults'), \
+            mock.patch.object(metrics, 'register'), \
+            mock.patch.object(profiling, 'register'), \
+            mock.patch.object(recording, 'register'):
+        importlib.reload(handlers)
+    # The handlers are the module's functions, as the reload replaced them.
+    _handlers = [Handler(getattr(handlers, name), entry['hook'],
+                         entry['when'], entry['when_not'])
+                 for name, entry in registered.items()]
+    return _handlers
+
+
+class KeyValueStore(dict):
+    """An in-memory stand-in for unitdata.kv()."""
+
+    def set(self, key, value):
+        self[key] = value
+
+    def unset(self, key):
+        self.pop(key, None)
+
+    def flush(self):
+        pass
+
+
+class ManilaPluginEndpoint(object):
+    """An in-memory stand-in for the manila-plugin endpoint, recording what
+    the charm sets on the relation."""
+
+    endpoint_name = relation_name = 'manila-plugin'
+
+    def __init__(self, unit):
+        self._unit = unit
+        self.authentication_data = None
+        self.data = {}
+        # the relation for the charms.openstack adapter.
+        self.relation = self
+
+    def _set(self, key, value):
+        self._unit._relation_set = True
+        self.data[key] = value
+
+    @property
+    def name(self):
+        return self.data.get('name')
+
+    @name.setter
+    def name(self, value):
+        self._set('name', value)
+
+    @property
+    def configuration_data(self):
+        return self.data.get('configuration_data')
+
+    @configuration_data.setter
+    def configuration_data(self, value):
+        self._set('configuration_data', value)
+
+    def clear_changed(self):
+        self._unit.flags.discard(CHANGED)
+
+
+# What a simulation counted, whether the unit converged, and the problems.
+Report = collections.namedtuple(
+    'Report', ['hooks', 'renders', 'relation_writes', 'key_writes',
+               'excess_writes', 'settle_hooks', 'converged', 'status',
+               'relation_data', 'problems'])
+
+
+class Simulation(object):
+    """A unit of the charm, on which hooks can be run.
+
+    :param config: changes to the config.yaml defaults to start from.
+    :param release: the OpenStack release of the installed packages.
+    :param leader: whether the unit is the leader.
+    :param leader_settings: the leader settings to start from.
+    """
+
+    def __init__(self, config=None, release=RELEASE, leader=True,
+                 leader_settings=None):
+        self.config = default_config()
+        self.config.update(config or {})
+        self.release = release
+        self.leader = leader
+        self.leader_settings = dict(leader_settings or {})
+        self.handlers = load_handlers()
+        self.flags = set()
+        self.kv = KeyValueStore()
+        self.endpoint = ManilaPluginEndpoint(self)
+        self.status = ('maintenance', '')
+        self.counts = collections.Counter()
+        self._hook_config = None
+        self._relation_id = 0
+        self._keypairs = 0
+        self._charm_dir = tempfile.mkdtemp()
+        self._manila_dir = os.path.join(self._charm_dir, 'etc-manila')
+        os.mkdir(self._manila_dir)
+
+    def close(self):
+        shutil.rmtree(self._charm_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ###
+    # The stand-ins for the framework, used while a hook runs.
+
+    def _hookenv_config(self, key=None):
+        if key is not None:
+            return self.config.get(key)
+        return self.config
+
+    @contextlib.contextmanager
+    def _provide_charm_instance(self):
+        # As charms.openstack, there is one instance per hook.
+        if self._charm is None:
+            self._charm = manila_generic.ManilaGenericCharm()
+        yield self._charm
+
+    def _assess_status(self, charm):
+        # As charms.openstack, the status is assessed at the end of the hook,
+        # after the required relation.
+        def assess():
+            self.counts['status_checks'] += 1
+            if CONNECTED not in self.flags:
+                status = ('blocked', 'Missing relations: manila-plugin')
+            elif AVAILABLE not in self.flags:
+                status = ('waiting', 'Incomplete relations: manila-plugin')
+            else:
+                state, message = charm.custom_assess_status_check()
+                status = (state or 'active', message or 'Unit is ready')
+            self._status_set(*status)
+        self._atexit.append(assess)
+
+    def _status_set(self, state, message):
+        self.status = (state, message)
+
+    def _leader_get(self, attribute=None):
+        if attribute is None:
+            return dict(self.leader_settings)
+        return self.leader_settings.get(attribute)
+
+    def _leader_set(self, settings=None, **kwargs):
+        # As juju, only the leader may set them; the other units would then
+        # run leader-settings-changed.
+        assert self.leader, "leader_set on a unit that isn't the leader"
+        self.leader_settings.update(settings or {}, **kwargs)
+
+    def _generate_ssh_keypair(self):
+        self._keypairs += 1
+        return ('private key {}'.format(self._keypairs),
+                'public key {}'.format(self._keypairs))
+
+    def _unit_path(self, path):
+        # The unit's /etc/manila is a directory of its own.
+        if path.startswith(manila_generic.MANILA_DIR):
+            return os.path.join(self._manila_dir,
+                                path[len(manila_generic.MANILA_DIR):])
+        return path
+
+    def _glob(self, pattern):
+        return [manila_generic.MANILA_DIR + os.path.basename(path)
+                for path in glob.iglob(self._unit_path(pattern))]
+
+    def _counted(self, name, function):
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def _key_file_state(self):
+        state = {}
+        for name in os.listdir(self._manila_dir):
+            path = os.path.join(self._manila_dir, name)
+            with open(path, 'rb') as f:
+                state[name] = (f.read(), os.stat(path).st_mode)
+        return state
+
+    def _file_change(self, function, path_arg):
+        # A key file write that reports a change but leaves the file as it
+        # was is an excess write.  The files are owned by the user running
+        # the simulation, as manila's user doesn't exist here.
+        user = pwd.getpwuid(os.getuid()).pw_name
+        group = grp.getgrgid(os.getgid()).gr_name
+
+        def changed(*args, **kwargs):
+            args = list(args)
+            args[path_arg] = self._unit_path(args[path_arg])
+            for key, name in (('owner', user), ('group', group)):
+                if kwargs.get(key) is not None:
+                    kwargs[key] = name
+            before = self._key_file_state()
+            result = function(*args, **kwargs)
+            if result:
+                self.counts['key_writes'] += 1
+                if self._key_file_state() == before:
+                    self.counts['excess_key_writes'] += 1
+            return result
+        return changed
+
+    def _patches(self, hook):
+        hookenv = manila_generic.hookenv
+        return (
+            mock.patch.object(hookenv, 'config',
+                              side_effect=self._hookenv_config),
+            mock.patch.object(hookenv, 'charm_dir',
+                              return_value=self._charm_dir),
+            mock.patch.object(
+                hookenv, 'relation_ids',
+                side_effect=lambda name: (
+                    ['manila-plugin:{}'.format(self._relation_id)]
+                    if CONNECTED in self.flags else [])),
+            mock.patch.object(hookenv, 'hook_name', return_value=hook),
+            mock.patch.object(hookenv, 'atexit',
+                              side_effect=self._atexit.append),
+            mock.patch.object(hookenv, 'status_set',
+                              side_effect=self._status_set),
+            mock.patch.object(hookenv, 'status_get',
+                              side_effect=lambda: self.status),
+            mock.patch.object(hookenv, 'application_version_set'),
+            mock.patch.object(hookenv, 'is_leader',
+                              side_effect=lambda: self.leader),
+            mock.patch.object(hookenv, 'leader_get',
+                              side_effect=self._leader_get),
+            mock.patch.object(hookenv, 'leader_set',
+                              side_effect=self._leader_set),
+            mock.patch.object(manila_generic.unitdata, 'kv',
+                              return_value=self.kv),
+            mock.patch.object(charms.reactive, 'is_flag_set',
+                              side_effect=self.flags.__contains__),
+            mock.patch.object(status, 'is_flag_set',
+                              side_effect=self.flags.__contains__),
+            mock.patch.object(charms.reactive, 'set_flag',
+                              side_effect=self.flags.add),
+            mock.patch.object(charms.reactive, 'clear_flag',
+                              side_effect=self.flags.discard),
+            mock.patch('charms.reactive.relations.endpoint_from_flag',
+                       return_value=self.endpoint, create=True),
+            mock.patch('charmhelpers.contrib.openstack.templating.get_loader',
+                       side_effect=get_loader),
+            mock.patch('charmhelpers.contrib.openstack.utils'
+                       '.get_os_codename_package',
+                       return_value=self.release),
+            mock.patch('charmhelpers.contrib.openstack.utils'
+                       '.CompareOpenStackReleases',
+                       new=CompareOpenStackReleases),
+            mock.patch.object(charms_openstack.charm,
+                              'provide_charm_instance',
+                              new=self._provide_charm_instance),
+            mock.patch.object(charms_openstack.charm.OpenStackCharm,
+                              'assess_status', autospec=True,
+                              side_effect=self._assess_status),
+            mock.patch.object(manila_generic.ManilaGenericCharm,
+                              'application_version', new='18.0.0',
+                              create=True),
+            mock.patch.object(manila_generic, 'TEMPLATES_DIR',
+                              new=TEMPLATES_DIR),
+            mock.patch.object(manila_generic, 'generate_ssh_keypair',
+                              new=self._generate_ssh_keypair),
+            mock.patch.object(manila_generic.glob, 'glob', new=self._glob),
+            mock.patch.object(
+                manila_generic, 'render_template',
+                new=self._counted('renders', manila_generic.render_template)),
+            mock.patch.object(
+                files, 'write_file',
+                new=self._file_change(files.write_file, 1)),
+            mock.patch.object(
+                files, 'remove_file',
+                new=self._file_change(files.remove_file, 0)),
+            mock.patch.object(profiling, 'enabled', return_value=False),
+        )
+
+    ###
+    # Running hooks
+
+    def _apply(self, event):
+        """Apply the event to the unit, and set the flags that the framework
+        and the manila-plugin endpoint would set."""
+        if event.hook == 'config-changed':
+            self.config.update(event.config)
+        elif event.hook == 'manila-plugin-relation-joined':
+            # each relation gets a new id.
+            self._relation_id += 1
+            self.flags.add(CONNECTED)
+        elif event.hook == 'manila-plugin-relation-changed':
+            if event.auth_data != self.endpoint.authentication_data:
+                self.endpoint.authentication_data = event.auth_data
+                self.flags.add(CHANGED)
+            if event.auth_data:
+                self.flags.add(AVAILABLE)
+            else:
+                self.flags.discard(AVAILABLE)
+        elif event.hook == 'manila-plugin-relation-departed':
+            self.flags.difference_update((CONNECTED, AVAILABLE, CHANGED))
+            self.endpoint.authentication_data = None
+            self.endpoint.data = {}
+        elif event.hook == 'leader-settings-changed':
+            self.leader_settings.update(event.leader_settings)
+        # As layer:basic and layer:openstack, for this hook.
+        if self.config != self._hook_config:
+            self.flags.add('config.changed')
+        if event.hook == 'update-status':
+            self.flags.add('update-status')
+
+    def _dispatch(self, hook):
+        """Run the handlers as charms.reactive would: those for the hook,
+        then, until none is left to run, the first whose flags match.  Each
+        handler runs at most once per hook."""
+        ran = set()
+        for index, handler in enumerate(self.handlers):
+            if hook in handler.hooks:
+                handler.function()
+                ran.add(index)
+        while True:
+            for index, handler in enumerate(self.handlers):
+                if (index in ran or handler.hooks or
+                        not all(f in self.flags for f in handler.when) or
+                        any(f in self.flags for f in handler.when_not)):
+                    continue
+                ran.add(index)
+                if any(f.startswith('manila-plugin.') for f in handler.when):
+                    handler.function(self.endpoint)
+                else:
+                    handler.function()
+                break
+            else:
+                return
+
+    def run_hook(self, event):
+        """Run the hook for the event, as a fresh process.
+
+        :param event: Event
+        :returns: collections.Counter, what the hook counted.
+        """
+        self._apply(event)
+        return self.dispatch_hook(event.hook)
+
+    def dispatch_hook(self, hook):
+        """Run the hook on the unit as it is, as a fresh process.  No event
+        is applied, so the flags, the config and the relation data must be
+        set already (e.g. as a replayed hook sets them).
+
+        :param hook: the name of the hook.
+        :returns: collections.Counter, what the hook counted.
+        """
+        before = collections.Counter(self.counts)
+        relation_data = dict(self.endpoint.data)
+        self.counts['hooks'] += 1
+        self._charm = None
+        self._atexit = []
+        self._relation_set = False
+        manila_generic._template_environments.clear()
+        manila_generic._leader_settings.clear()
+        metrics._current.clear()
+        with contextlib.ExitStack() as stack:
+            for patcher in self._patches(hook):
+                stack.enter_context(patcher)
+            metrics.register()
+            self._dispatch(hook)
+            for callback in reversed(self._atexit):
+                callback()
+        # As the metrics count them.
+        if any(count > 1 for count in metrics.hook_work().values()):
+            self.counts['repeated_work'] += 1
+        if self._relation_set:
+            self.counts['relation_writes'] += 1
+            if self.endpoint.data == relation_data:
+                self.counts['excess_relation_writes'] += 1
+        self.flags.difference_update(('config.changed', 'update-status'))
+        self._hook_config = dict(self.config)
+        return self.counts - before
+
+    def _quiescent(self, counted):
+        return (not any(counted[name] for name in
+                        ('renders', 'relation_writes', 'key_writes')) and
+                CHANGED not in self.flags)
+
+    def run(self, events):
+        """Run the hooks for the events, then update-status until the unit is
+        quiescent.
+
+        :param events: list of Event
+        :returns: Report
+        """
+        for event in events:
+            self.run_hook(event)
+        settle_hooks = 0
+        quiescent = False
+        while settle_hooks < MAX_SETTLE_HOOKS:
+            settle_hooks += 1
+            if self._quiescent(self.run_hook(update_status())):
+                quiescent = True
+                break
+        problems = []
+        if not quiescent:
+            problems.append(
+                "not quiescent after {} update-status hooks".format(
+                    MAX_SETTLE_HOOKS))
+        expected = self.expected_relation_data()
+        if published(self.endpoint.data) != published(expected):
+            problems.append(
+                "published {!r}, but a new unit with the same config and "
+                "relation publishes {!r}".format(self.endpoint.data,
+                                                 expected))
+        excess = (self.counts['excess_relation_writes'] +
+                  self.counts['excess_key_writes'])
+        if excess:
+            problems.append("{} writes changed nothing".format(excess))
+        if self.counts['repeated_work']:
+            problems.append(
+                "{} hooks rendered or checked the config more than "
+                "once".format(self.counts['repeated_work']))
+        return Report(
+            hooks=self.counts['hooks'],
+            renders=self.counts['renders'],
+            relation_writes=self.counts['relation_writes'],
+            key_writes=self.counts['key_writes'],
+            excess_writes=excess,
+            settle_hooks=settle_hooks,
+            converged=quiescent and not problems,
+            status=self.status,
+            relation_data=self.endpoint.data,
+            problems=problems)
+
+    def expected_relation_data(self):
+        """Return what a new unit, deployed with this unit's config and
+        leader settings and related to the same principal, publishes.
+
+        :returns: dict, the relation data.
+        """
+        if CONNECTED not in self.flags:
+            return {}
+        events = [install(), relation_joined()]
+        if self.endpoint.authentication_data is not None:
+            events.append(
+                relation_changed(self.endpoint.authentication_data))
+        with Simulation(self.config, self.release, self.leader,
+                        self.leader_settings) as fresh:
+            for event in events:
+                fresh.run_hook(event)
+            return fresh.endpoint.data
+
+
+def published(relation_data):
+    """Return what the principal charm is given by the relation data: nothing
+    if there is no configuration, whatever the backends are named.
+
+    :returns: dict
+    """
+    if not relation_data.get('configuration_data'):
+        return {}
+    return relation_data
+
+
+def simulate(events, config=None, release=RELEASE, leader=True):
+    """Run the events on a new unit.
+
+    :returns: Report
+    """
+    with Simulation(config, release, leader) as simulation:
+        return simulation.run(events)
+
+
+def simulate_random(seed, count=20, config=None, release=RELEASE):
+    """Run a random sequence of events on a new unit.
+
+    :returns: (events, Report)
+    """
+    events = random_events(random.Random(seed), count)
+    return events, simulate(events, config, release)
@@ -0,0 +1,191 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+from unittest import mock
+
+import actions.actions as actions
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestActions(test_utils.PatchHelper):
+
+    def _patch_provide_charm_instance(self):
+        manila_generic_charm = mock.MagicMock()
+        self.patch('charms_openstack.charm.provide_charm_instance',
+                   name='provide_charm_instance',
+                   new=mock.MagicMock())
+        self.provide_charm_instance().__enter__.return_value = \
+            manila_generic_charm
+        self.provide_charm_instance().__exit__.return_value = None
+        return manila_generic_charm
+
+    def _patch_relation(self, auth_data):
+        # The manila-plugin relation data, as relation-get reads it.
+        data = {'manila-plugin:1': {'manila/0': {}}}
+        if auth_data is not None:
+            data['manila-plugin:1']['manila/0']['_authentication_data'] = \
+                json.dumps({'data': auth_data})
+        hookenv = actions.hookenv
+        self.patch_object(hookenv, 'relation_ids',
+                          side_effect=lambda name: sorted(data))
+        self.patch_object(hookenv, 'related_units',
+                          side_effect=lambda rid: sorted(data[rid]))
+        self.patch_object(
+            hookenv, 'relation_get',
+            side_effect=lambda key, unit, rid: data[rid][unit].get(key))
+        self.patch_object(hookenv, 'relation_set')
+
+    def test_refresh_config(self):
+        manila_generic = actions.charm.openstack.manila_generic
+        self.patch_release(manila_generic.ManilaGenericCharm.release)
+        generic = manila_generic.ManilaGenericCharm()
+        self.patch_object(generic, 'principal_config_fingerprint',
+                          return_value='fp')
+        self.patch_object(generic, 'get_config_for_principal',
+                          return_value={'file': 'contents'})
+        self.patch_object(manila_generic, 'backend_names',
+                          return_value='generic')
+        self.patch_object(manila_generic.metrics, 'record_published')
+        self.patch('charms_openstack.charm.provide_charm_instance',
+                   name='provide_charm_instance', new=mock.MagicMock())
+        self.provide_charm_instance().__enter__.return_value = generic
+        self.provide_charm_instance().__exit__.return_value = None
+        self.patch_object(actions.hookenv, 'action_fail')
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.unitdata, 'kv')
+        self.kv.return_value.get.return_value = 'fp'
+        # the principal hasn't set its auth data yet.
+        self._patch_relation(None)
+        actions.refresh_config()
+        self.action_fail.assert_called_once_with(
+            "The manila-plugin relation is not available")
+        self.relation_set.assert_not_called()
+        # the configuration is rendered from the auth data on the relation
+        # and set on it with relation-set, as there is no endpoint in an
+        # action, even though the fingerprint is unchanged.
+        self._patch_relation({'username': 'manila'})
+        actions.refresh_config()
+        self.get_config_for_principal.assert_called_once_with(
+            {'username': 'manila'})
+        self.relation_set.assert_called_once_with(
+            relation_id='manila-plugin:1',
+            relation_settings={
+                '_name': 'generic',
+                '_configuration_data': '{"data": {"file": "contents"}}',
+            })
+        self.kv.return_value.flush.assert_called_once_with()
+        self.action_set.assert_called_once_with(
+            {'outcome': 'configuration published'})
+
+    def test_rotate_ssh_keys(self):
+        generic = self._patch_provide_charm_instance()
+        generic.options.computed_define_ssh = False
+        generic.publish_config_to_principal.return_value = True
+        self.patch_object(actions.hookenv, 'is_leader', return_value=False)
+        self.patch_object(actions.hookenv, 'action_get', return_value=True)
+        self.patch_object(actions.hookenv, 'action_fail')
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.unitdata, 'kv')
+        self.patch_object(actions.charm.openstack.manila_generic,
+                          'rotate_ssh_keys', return_value={'current': 2})
+        self._patch_relation({'username': 'manila'})
+        actions.rotate_ssh_keys()
+        self.action_fail.assert_called_once_with(
+            "Only the leader can rotate the SSH keys")
+        self.rotate_ssh_keys.assert_not_called()
+        self.action_fail.reset_mock()
+        self.is_leader.return_value = True
+        actions.rotate_ssh_keys()
+        self.rotate_ssh_keys.assert_called_once_with(prune=True)
+        generic.maybe_write_ssh_keys.assert_called_once_with()
+        # published without the endpoint, which an action doesn't have.
+        generic.publish_config_to_principal.assert_called_once_with()
+        self.kv.return_value.flush.assert_called_once_with()
+        self.action_set.assert_called_once_with({'generation': 2})
+        self.action_fail.assert_not_called()
+        # the keys are rotated, but the action fails if the configuration
+        # that uses them can't be published.
+        generic.publish_config_to_principal.return_value = False
+        actions.rotate_ssh_keys()
+        self.action_set.assert_called_with({'generation': 2})
+        self.action_fail.assert_called_once_with(
+            "The configuration that uses the new SSH keys wasn't published "
+            "to the principal charm")
+        self.action_fail.reset_mock()
+        generic.publish_config_to_principal.reset_mock()
+        self._patch_relation(None)
+        actions.rotate_ssh_keys()
+        generic.publish_config_to_principal.assert_not_called()
+        self.action_fail.assert_called_once_with(
+            "The manila-plugin relation is not available to publish the "
+            "configuration to")
+        # the keys set by config aren't rotated.
+        self.action_fail.reset_mock()
+        self.rotate_ssh_keys.reset_mock()
+        generic.options.computed_define_ssh = True
+        actions.rotate_ssh_keys()
+        self.rotate_ssh_keys.assert_not_called()
+        self.assertEqual(self.action_fail.call_count, 1)
+
+    def test_profile_summary(self):
+        self.patch_object(actions.profiling, 'read_records',
+                          return_value=['records'])
+        self.patch_object(actions.profiling, 'summarise',
+                          return_value={'update-status': {}})
+        self.patch_object(actions.hookenv, 'action_get', return_value='')
+        self.patch_object(actions.hookenv, 'action_set')
+        actions.profile_summary()
+        self.summarise.assert_called_once_with(['records'], revision=None)
+        self.action_set.assert_called_once_with(
+            {'summary': '{"update-status": {}}'})
+        self.action_get.return_value = 'abc'
+        actions.profile_summary()
+        self.summarise.assert_called_with(['records'], revision='abc')
+
+    def test_share_server_latency(self):
+        params = {'since': '', 'until': '2024-05-02'}
+        self.patch_object(actions.hookenv, 'action_get',
+                          side_effect=params.get)
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.share_latency, 'log_files',
+                          return_value=['manila-share.log'])
+        self.patch_object(actions.share_latency, 'read_lines',
+                          return_value=['line'])
+        self.patch_object(actions.share_latency, 'measure',
+                          return_value={'stages': {}})
+        actions.share_server_latency()
+        since = datetime.datetime(2024, 5, 1)
+        until = datetime.datetime(2024, 5, 2)
+        self.read_lines.assert_called_once_with(['manila-share.log'],
+                                                since=since)
+        self.measure.assert_called_once_with(['line'], since, until)
+        self.action_set.assert_called_once_with(
+            {'report': '{"stages": {}}'})
+
+    def test_main(self):
+        self.patch_object(actions.hookenv, 'action_fail')
+        refresh_config = mock.MagicMock()
+        with mock.patch.dict(actions.ACTIONS,
+                             {'refresh-config': refresh_config}):
+            actions.main(['/some/path/refresh-config'])
+            refresh_config.assert_called_once_with(
+                ['/some/path/refresh-config'])
+            self.assertEqual(actions.main(['unknown']),
+                             "Action unknown undefined")
+            refresh_config.side_effect = Exception('boom')
+            actions.main(['refresh-config'])
+            self.action_fail.assert_called_once_with('boom')
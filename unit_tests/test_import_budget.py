@@ -0,0 +1,154 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# These run in a fresh interpreter, with the real charmhelpers,
+# charms.reactive and charms.openstack (as installed by tox) rather than the
+# mocks of the other tests, so that the imports are cold and what they pull
+# in is what a hook would.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# The budget for each hook type: the cold import of what it loads and the
+# time it takes to start, and the peak RSS of the process.  Most hooks load
+# the reactive handlers; an update-status that only sets the saved status
+# again loads charm.openstack.status, and writes the metrics.  These are
+# deliberately generous so that the test only fails on a real regression,
+# e.g. an expensive import being added at module level.
+HOOK_BUDGETS = {
+    'config-changed': (2.0, 80 * 1024),
+    'update-status': (0.5, 40 * 1024),
+}
+
+# The modules that an update-status that only sets the saved status again
+# must not import.
+RENDERING_MODULES = (
+    'charms.reactive',
+    'charms.reactive.relations',
+    'charms_openstack.charm',
+    'charm.openstack.manila_generic',
+    'charmhelpers.contrib.openstack.templating',
+    'jinja2',
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The config-get, leader-get, status-get and status-set hook tools aren't
+# available.
+PRELUDE = """
+import json
+import resource
+import sys
+import time
+
+sys.path[:0] = ['src', 'src/lib']
+
+import charmhelpers.core.hookenv as hookenv
+
+config = {}
+status = []
+hookenv.config = lambda key=None: config if key is None else config.get(key)
+hookenv.leader_get = lambda attribute=None: None
+hookenv.status_get = lambda: ('active', 'Unit is ready')
+hookenv.status_set = lambda *args: status.append(list(args))
+"""
+
+SAVE_STATUS = PRELUDE + """
+config.update(json.loads(sys.argv[1]))
+
+import charm.openstack.status
+
+charm.openstack.status.save_status()
+"""
+
+# Run as the hook named by JUJU_HOOK_NAME would, with the config passed as
+# the first argument; the rest are the modules to report if imported.
+MEASURE_HOOK = PRELUDE + """
+config.update(json.loads(sys.argv[1]))
+
+start = time.perf_counter()
+if hookenv.hook_name() == 'update-status':
+    import charm.openstack.status
+    done = charm.openstack.status.update_status(start)
+else:
+    import reactive.manila_generic_handlers  # noqa
+    done = False
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'seconds': elapsed,
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'done': done,
+    'status': status,
+    'modules': sorted(m for m in sys.argv[2:] if m in sys.modules),
+}))
+"""
+
+
+class TestImportBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.env = dict(os.environ,
+                        JUJU_CHARM_DIR=self.tmpdir.name,
+                        UNIT_STATE_DB=os.path.join(self.tmpdir.name,
+                                                   '.unit-state.db'))
+        try:
+            self._run("import charmhelpers.core.hookenv, charms.reactive, "
+                      "charms_openstack.charm")
+        except subprocess.CalledProcessError:
+            self.skipTest("needs charmhelpers, charms.reactive and "
+                          "charms.openstack installed")
+
+    def _run(self, script, *args):
+        output = subprocess.check_output(
+            [sys.executable, '-c', script] + list(args), cwd=ROOT,
+            env=self.env,
+            stderr=subprocess.DEVNULL)
+        return output.decode('utf-8').splitlines()
+
+    def _measure(self, hook, config=None):
+        config = json.dumps(config or {})
+        self.env['JUJU_HOOK_NAME'] = hook
+        if hook == 'update-status':
+            self._run(SAVE_STATUS, config)
+        return json.loads(
+            self._run(MEASURE_HOOK, config, *RENDERING_MODULES)[-1])
+
+    def test_import_budget(self):
+        for hook, (seconds, peak_rss_kb) in sorted(HOOK_BUDGETS.items()):
+            with self.subTest(hook=hook):
+                measured = self._measure(hook)
+                self.assertLess(measured['seconds'], seconds)
+                self.assertLess(measured['peak_rss_kb'], peak_rss_kb)
+
+    def test_update_status_imports(self):
+        result = self._measure('update-status')
+        self.assertTrue(result['done'])
+        self.assertEqual(result['status'], [['active', 'Unit is ready']])
+        self.assertEqual(result['modules'], [])
+
+    def test_update_status_metrics_imports(self):
+        textfile_dir = os.path.join(self.tmpdir.name, 'textfile')
+        os.mkdir(textfile_dir)
+        result = self._measure('update-status',
+                               {'prometheus-textfile-dir': textfile_dir})
+        self.assertTrue(result['done'])
+        self.assertEqual(result['modules'], [])
+        self.assertEqual(os.listdir(textfile_dir),
+                         ['manila-generic.prom'])
@@ -0,0 +1,94 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import charm.openstack.files as files
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestFiles(test_utils.PatchHelper):
+
+    def _tmpfile(self, name):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        return os.path.join(tmpdir, name)
+
+    def test_write_file(self):
+        path = self._tmpfile('file1')
+        text = """
+            This
+            One"""
+        # strip the first new line off when passing the test string through
+        # this is to test dedenting strings
+        self.assertTrue(files.write_file(text[1:], path))
+        with open(path) as f:
+            self.assertEqual(f.read(), "This\nOne")
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        # nothing in the directory but the file; no temporary files left.
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['file1'])
+
+    def test_write_file_private(self):
+        path = self._tmpfile('file1')
+        text = """
+            This
+            Two"""
+        # strip the first new line off when passing the test string through
+        # this is to test dedenting strings
+        self.assertTrue(
+            files.write_file(text[1:], path, chown=0o644))
+        with open(path) as f:
+            self.assertEqual(f.read(), "This\nTwo")
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
+    def test_write_file_unchanged(self):
+        path = self._tmpfile('file1')
+        self.assertTrue(files.write_file('contents', path))
+        inode = os.stat(path).st_ino
+        self.patch_object(files.os, 'fsync')
+        self.assertFalse(files.write_file('contents', path))
+        # the file wasn't replaced, or even synced.
+        self.assertEqual(os.stat(path).st_ino, inode)
+        self.fsync.assert_not_called()
+        # a change of mode is a change.
+        self.assertTrue(
+            files.write_file('contents', path, chown=0o644))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
+    def test_write_file_replaces(self):
+        path = self._tmpfile('file1')
+        self.assertTrue(files.write_file('a longer contents', path))
+        inode = os.stat(path).st_ino
+        self.assertTrue(files.write_file('short', path))
+        # the file was replaced, so there are no stale trailing bytes.
+        with open(path) as f:
+            self.assertEqual(f.read(), 'short')
+        self.assertNotEqual(os.stat(path).st_ino, inode)
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['file1'])
+
+    def test_write_file_fails(self):
+        path = self._tmpfile('file1')
+        self.patch_object(files.hookenv, 'log')
+        self.patch_object(files.os, 'rename',
+                          side_effect=OSError('failed'))
+        self.assertFalse(files.write_file('contents', path))
+        self.log.assert_called_once_with("Couldn't write file: failed")
+        # the temporary file is cleaned up.
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+        self.rename.side_effect = None
+        self.assertFalse(files.write_file(
+            'contents', path, owner='no-such-user-for-the-test'))
@@ -12,18 +12,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import shutil
+import tempfile
+import types
 from unittest import mock
 
+import jinja2
+
 import charm.openstack.manila_generic as manila_generic
+import charm.openstack.profiling as profiling
 
 import charms_openstack.test_utils as test_utils
 
+from unit_tests.helpers import (
+    CompareOpenStackReleases,
+    TEMPLATES_DIR,
+    default_config,
+    generated_keys,
+    get_loader,
+)
+
 
 class Helper(test_utils.PatchHelper):
 
     def setUp(self):
         super().setUp()
         self.patch_release(manila_generic.ManilaGenericCharm.release)
+        self.patch_object(profiling, 'enabled', return_value=False)
+        self.patch('charmhelpers.contrib.openstack.utils'
+                   '.get_os_codename_package',
+                   name='get_os_codename_package', return_value=None)
+        self.patch('charmhelpers.contrib.openstack.utils'
+                   '.CompareOpenStackReleases',
+                   name='CompareOpenStackReleases',
+                   new=CompareOpenStackReleases)
+        # The leader settings, as read in the hook; none are set.
+        self.leader_settings = {}
+        self.patch_object(manila_generic, '_leader_settings',
+                          new=self.leader_settings)
+        self.patch_object(manila_generic.hookenv, 'leader_get',
+                          return_value=None)
 
 
 class TestManilaGenericCharmConfigProperties(Helper):
@@ -80,6 +110,23 @@ class TestManilaGenericCharmConfigProperties(Helper):
         config.driver_service_ssh_key_public = "ssh public key"
         self.assertTrue(manila_generic.computed_define_ssh(config))
 
+    def test_computed_ssh_keys(self):
+        config = mock.MagicMock()
+        config.driver_service_ssh_key = "ssh key"
+        config.driver_service_ssh_key_public = "ssh public key"
+        self.assertEqual(manila_generic.computed_ssh_keys(config), {
+            'private': manila_generic.MANILA_SSH_KEY_PATH,
+            'public': manila_generic.MANILA_SSH_KEY_PATH_PUBLIC,
+            'keypair_suffix': ''})
+        # without the keys from config, the leader's are used.
+        config.driver_service_ssh_key = ''
+        self.assertIsNone(manila_generic.computed_ssh_keys(config))
+        self.leader_settings['ssh-keys'] = generated_keys(1, 2)
+        self.assertEqual(manila_generic.computed_ssh_keys(config), {
+            'private': '/etc/manila/ssh_image_key-2',
+            'public': '/etc/manila/ssh_image_key-2.pub',
+            'keypair_suffix': '-2'})
+
     def test_computed_debug_level(self):
         config = mock.MagicMock()
         config.debug = False
@@ -94,6 +141,24 @@ class TestManilaGenericCharmConfigProperties(Helper):
         config.verbose = True
         self.assertEqual(manila_generic.computed_debug_level(config), "DEBUG")
 
+    def test_computed_default_log_levels(self):
+        config = mock.MagicMock()
+        config.log_levels = ''
+        self.assertIsNone(manila_generic.computed_default_log_levels(config))
+        config.log_levels = 'generic'
+        self.assertIsNone(manila_generic.computed_default_log_levels(config))
+        config.log_levels = 'generic=debug, ssh=INFO keystoneauth=ERROR'
+        levels = manila_generic.computed_default_log_levels(config).split(',')
+        # oslo.log's defaults are kept, unless they are overridden.
+        self.assertEqual(levels[:3], ['amqp=WARN', 'amqplib=WARN',
+                                      'boto=WARN'])
+        self.assertIn('keystoneauth=ERROR', levels)
+        self.assertNotIn('keystoneauth=WARN', levels)
+        self.assertEqual(levels[-4:], ['manila.share.drivers.generic=DEBUG',
+                                       'manila.ssh_utils=INFO',
+                                       'manila.utils=INFO',
+                                       'paramiko=INFO'])
+
 
 class TestManilaGenericCharmManilaPluginProperties(Helper):
 
@@ -103,16 +168,40 @@ class TestManilaGenericCharmManilaPluginProperties(Helper):
         self.assertEqual(manila_generic.authentication_data(manila_plugin),
                          'test data')
 
+    def test_principal_auth_data(self):
+        data = {
+            'manila-plugin:1': {'manila/0': {}},
+            'manila-plugin:2': {
+                'manila/1': {'_authentication_data':
+                             '{"data": {"username": "manila"}}'}},
+        }
+        hookenv = manila_generic.hookenv
+        self.patch_object(hookenv, 'relation_ids',
+                          side_effect=lambda name: sorted(data))
+        self.patch_object(hookenv, 'related_units',
+                          side_effect=lambda rid: sorted(data[rid]))
+        self.patch_object(
+            hookenv, 'relation_get',
+            side_effect=lambda key, unit, rid: data[rid][unit].get(key))
+        self.assertEqual(manila_generic.principal_auth_data(),
+                         {'username': 'manila'})
+        self.relation_ids.assert_called_once_with('manila-plugin')
+        del data['manila-plugin:2']
+        self.assertIsNone(manila_generic.principal_auth_data())
+
 
 class TestManilaGenericCharm(Helper):
 
     def _patch_config_and_charm(self, config):
         self.patch('charmhelpers.core.hookenv.config', name='config')
 
+        # the config is the defaults, overridden by the test's config.
         def cf(key=None):
+            full_config = default_config()
+            full_config.update(config)
             if key is not None:
-                return config[key]
-            return config
+                return full_config.get(key)
+            return full_config
 
         self.config.side_effect = cf
 
@@ -128,19 +217,18 @@ class TestManilaGenericCharm(Helper):
         self._patch_config_and_charm(config)
         c = manila_generic.ManilaGenericCharm()
         self.assertEqual(c.custom_assess_status_check(), (None, None))
+        # every problem is reported at once.
         config['driver-handles-share-servers'] = True
         c = manila_generic.ManilaGenericCharm()
-        self.assertEqual(c.custom_assess_status_check(),
-                         ('blocked', "Missing 'driver-service-image-name'"))
-        config['driver-service-image-name'] = 'image-name'
-        c = manila_generic.ManilaGenericCharm()
-        self.assertEqual(c.custom_assess_status_check(),
-                         ('blocked', "Missing 'driver-service-instance-user'"))
-        config['driver-service-instance-user'] = 'manila'
-        c = manila_generic.ManilaGenericCharm()
         self.assertEqual(
             c.custom_assess_status_check(),
-            ('blocked', "Missing 'driver-service-instance-flavor-id'"))
+            ('blocked',
+             "Missing 'driver-service-image-name'; "
+             "Missing 'driver-service-instance-user'; "
+             "Missing 'driver-service-instance-flavor-id'; "
+             "Need at least one of instance password or keypair name"))
+        config['driver-service-image-name'] = 'image-name'
+        config['driver-service-instance-user'] = 'manila'
         config['driver-service-instance-flavor-id'] = '100'
         c = manila_generic.ManilaGenericCharm()
         self.assertEqual(
@@ -159,6 +247,121 @@ class TestManilaGenericCharm(Helper):
         c = manila_generic.ManilaGenericCharm()
         self.assertEqual(c.custom_assess_status_check(), (None, None))
 
+    def test_template_release(self):
+        c = manila_generic.ManilaGenericCharm()
+        self.assertEqual(c.template_release, 'mitaka')
+        self.get_os_codename_package.assert_called_once_with(
+            'manila-common', fatal=False)
+        self.get_os_codename_package.return_value = 'caracal'
+        # the release is only looked up once
+        self.assertEqual(c.template_release, 'mitaka')
+        c = manila_generic.ManilaGenericCharm()
+        self.assertEqual(c.template_release, 'caracal')
+
+    def test_custom_assess_status_check_backends(self):
+        config = {
+            'driver-service-instance-flavor-id': 100,
+            'backends': 'not: [valid',
+        }
+        self._patch_config_and_charm(config)
+        c = manila_generic.ManilaGenericCharm()
+        self.assertEqual(c.custom_assess_status_check(),
+                         ('blocked', "Invalid 'backends': not valid YAML"))
+        config['backends'] = """
+            - name: fast
+            - name: bulk
+              driver-service-instance-flavor-id: 0
+            """
+        c = manila_generic.ManilaGenericCharm()
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked',
+             "bulk: Missing 'driver-service-instance-flavor-id'"))
+        config['backends'] = """
+            - name: fast
+            - name: bulk
+              driver-service-instance-flavor-id: 200
+            """
+        c = manila_generic.ManilaGenericCharm()
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+
+    def test_custom_assess_status_check_ssh_keys(self):
+        config = {
+            'driver-service-instance-flavor-id': 100,
+            'driver-auth-type': 'ssh',
+        }
+        self._patch_config_and_charm(config)
+        c = manila_generic.ManilaGenericCharm()
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('waiting', "Waiting for the leader to generate the SSH keys"))
+        self.leader_settings['ssh-keys'] = generated_keys(1)
+        c = manila_generic.ManilaGenericCharm()
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+
+    def test_validate_config_memoised(self):
+        config = {'driver-service-instance-flavor-id': 100}
+        self._patch_config_and_charm(config)
+        self.patch_object(manila_generic, 'validate_config',
+                          wraps=manila_generic.validate_config)
+        c = manila_generic.ManilaGenericCharm()
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        # the check is made again when the leader generates the SSH keys,
+        # but the config isn't validated again.
+        self.leader_settings['ssh-keys'] = generated_keys(1)
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        self.assertEqual(self.validate_config.call_count, 1)
+        # the next hook validates the config it has.
+        config['driver-service-instance-flavor-id'] = 0
+        c = manila_generic.ManilaGenericCharm()
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "Missing 'driver-service-instance-flavor-id'"))
+        self.assertEqual(self.validate_config.call_count, 2)
+
+    def test_custom_assess_status_check_memoised(self):
+        config = {
+            'driver-service-instance-flavor-id': 100,
+            'driver-auth-type': 'ssh',
+        }
+        self._patch_config_and_charm(config)
+        self.patch_object(manila_generic.metrics, 'record_check')
+        c = manila_generic.ManilaGenericCharm()
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('waiting', "Waiting for the leader to generate the SSH keys"))
+        c.custom_assess_status_check()
+        self.record_check.assert_called_once_with(
+            'waiting', "Waiting for the leader to generate the SSH keys")
+        # the leader generating the keys during the hook is seen.
+        self.leader_settings['ssh-keys'] = generated_keys(1)
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        self.assertEqual(self.record_check.call_count, 2)
+
+    def test_get_config_for_principal_memoised(self):
+        self._patch_config_and_charm(
+            {'driver-service-instance-flavor-id': 100})
+        self.patch_object(manila_generic, 'render_template',
+                          return_value='[generic]\n')
+        auth_data = {'username': 'user'}
+        c = manila_generic.ManilaGenericCharm()
+        self.patch_object(c.adapters_instance, 'add_relation')
+        payload = c.get_config_for_principal(auth_data)
+        self.assertEqual(c.get_config_for_principal(auth_data), payload)
+        self.render_template.assert_called_once_with(
+            'manila.conf', c.template_release, c.adapters_instance)
+        # different auth data is rendered, but the relation is only added to
+        # the adapters once.
+        c.get_config_for_principal({'username': 'other'})
+        self.assertEqual(self.render_template.call_count, 2)
+        manila_plugin, = self.add_relation.call_args[0]
+        self.add_relation.assert_called_once_with(manila_plugin)
+        # it needs no endpoint, so the config can be rendered in an action.
+        self.assertIsInstance(manila_plugin, manila_generic.PrincipalRelation)
+        self.assertEqual(manila_plugin.authentication_data,
+                         {'username': 'other'})
+
     def test_get_config_for_principal(self):
         # note that this indirectly tests 'process_lines' as well.
         c = manila_generic.ManilaGenericCharm()
@@ -201,8 +404,123 @@ class TestManilaGenericCharm(Helper):
         c = manila_generic.ManilaGenericCharm()
         self.assertEqual(c.get_config_for_principal(auth_data), {})
 
-        # can't currently test that the outputted template is accurate in tests
-        # as we mock out the templating logic from charmhelpers.
+        # the rendering of the templates is tested in TestRenderTemplate.
+
+    def test_principal_config_fingerprint(self):
+        config = {'share-backend-name': 'generic'}
+        self._patch_config_and_charm(config)
+        self.patch_object(manila_generic.hookenv, 'relation_ids',
+                          return_value=['manila-plugin:1'])
+        self.patch_object(manila_generic.status, 'charm_revision',
+                          return_value={'version': 'abc'})
+        self.patch_object(manila_generic, 'template_files',
+                          return_value=[])
+        c = manila_generic.ManilaGenericCharm()
+        fingerprint = c.principal_config_fingerprint({'username': 'user'})
+        # the same inputs give the same fingerprint
+        self.assertEqual(
+            c.principal_config_fingerprint({'username': 'user'}), fingerprint)
+        # and each input changes it.
+        self.assertNotEqual(
+            c.principal_config_fingerprint({'username': 'other'}),
+            fingerprint)
+        self.relation_ids.return_value = ['manila-plugin:2']
+        self.assertNotEqual(
+            c.principal_config_fingerprint({'username': 'user'}), fingerprint)
+        self.relation_ids.return_value = ['manila-plugin:1']
+        self.leader_settings['ssh-keys'] = generated_keys(1)
+        self.assertNotEqual(
+            c.principal_config_fingerprint({'username': 'user'}), fingerprint)
+        del self.leader_settings['ssh-keys']
+        self.charm_revision.return_value = {'version': 'def'}
+        self.assertNotEqual(
+            c.principal_config_fingerprint({'username': 'user'}), fingerprint)
+        self.charm_revision.return_value = {'version': 'abc'}
+        config['share-backend-name'] = 'other'
+        c = manila_generic.ManilaGenericCharm()
+        self.assertNotEqual(
+            c.principal_config_fingerprint({'username': 'user'}), fingerprint)
+
+    def test_publish_config_to_principal(self):
+        config = {'share-backend-name': 'generic'}
+        self._patch_config_and_charm(config)
+        kv = {}
+        self.patch_object(manila_generic.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = kv.get
+        self.kv.return_value.set.side_effect = kv.__setitem__
+        self.patch_object(manila_generic.metrics, 'record_published')
+        self.patch_object(manila_generic.hookenv, 'relation_ids',
+                          return_value=['manila-plugin:1'])
+        c = manila_generic.ManilaGenericCharm()
+        self.patch_object(c, 'principal_config_fingerprint',
+                          return_value='fp1')
+        self.patch_object(c, 'get_config_for_principal',
+                          return_value={'file': 'contents'})
+        manila_plugin = mock.MagicMock()
+        manila_plugin.authentication_data = 'auth data'
+        self.assertTrue(c.publish_config_to_principal(manila_plugin))
+        self.get_config_for_principal.assert_called_once_with('auth data')
+        self.assertEqual(manila_plugin.name, 'generic')
+        self.assertEqual(manila_plugin.configuration_data,
+                         {'file': 'contents'})
+        self.assertEqual(kv[manila_generic.PRINCIPAL_CONFIG_FINGERPRINT_KEY],
+                         'fp1')
+        # nothing changed, so no render and no relation write.
+        manila_plugin.reset_mock()
+        self.get_config_for_principal.reset_mock()
+        self.assertFalse(c.publish_config_to_principal(manila_plugin))
+        self.get_config_for_principal.assert_not_called()
+        self.assertEqual(self.record_published.call_args_list,
+                         [mock.call(True), mock.call(False)])
+        # forcing a refresh renders and publishes anyway.
+        self.assertTrue(
+            c.publish_config_to_principal(manila_plugin, force=True))
+        self.get_config_for_principal.assert_called_once_with('auth data')
+        # a change of inputs renders, but if the configuration is the same
+        # it isn't published again.
+        self.get_config_for_principal.reset_mock()
+        manila_plugin = mock.MagicMock()
+        manila_plugin.authentication_data = 'auth data'
+        self.principal_config_fingerprint.return_value = 'fp2'
+        self.assertFalse(c.publish_config_to_principal(manila_plugin))
+        self.get_config_for_principal.assert_called_once_with('auth data')
+        self.assertIsInstance(manila_plugin.configuration_data, mock.Mock)
+        self.assertEqual(kv[manila_generic.PRINCIPAL_CONFIG_FINGERPRINT_KEY],
+                         'fp2')
+        # a changed configuration is.
+        self.principal_config_fingerprint.return_value = 'fp3'
+        self.get_config_for_principal.return_value = {'file': 'changed'}
+        self.assertTrue(c.publish_config_to_principal(manila_plugin))
+        self.assertEqual(manila_plugin.configuration_data,
+                         {'file': 'changed'})
+        # as is the same configuration on a new relation.
+        self.principal_config_fingerprint.return_value = 'fp4'
+        self.relation_ids.return_value = ['manila-plugin:2']
+        self.assertTrue(c.publish_config_to_principal(manila_plugin))
+        # without the endpoint (i.e. in an action), the auth data is read
+        # and the configuration set with relation-get and relation-set.
+        self.patch_object(manila_generic, 'principal_auth_data',
+                          return_value='relation auth data')
+        self.patch_object(manila_generic, 'set_principal_config')
+        self.get_config_for_principal.reset_mock()
+        self.assertTrue(c.publish_config_to_principal(force=True))
+        self.get_config_for_principal.assert_called_once_with(
+            'relation auth data')
+        self.set_principal_config.assert_called_once_with(
+            'generic', {'file': 'changed'})
+
+    def test_assess_status(self):
+        self._patch_config_and_charm({})
+        self.patch_object(manila_generic.hookenv, 'atexit')
+        self.patch_object(manila_generic.charms_openstack.charm.OpenStackCharm,
+                          'assess_status', name='base_assess_status')
+        c = manila_generic.ManilaGenericCharm()
+        c.assess_status()
+        c.assess_status()
+        self.assertEqual(self.base_assess_status.call_count, 2)
+        # the status is saved once, at the end of the hook.
+        self.atexit.assert_called_once_with(
+            manila_generic.status.save_status)
 
     def test_maybe_write_ssh_keys(self):
         config = {
@@ -227,7 +545,7 @@ class TestManilaGenericCharm(Helper):
         config['driver-service-ssh-key'] = 'this is my key'
         config['driver-service-ssh-key-public'] = 'my public key'
         c = manila_generic.ManilaGenericCharm()
-        self.patch_object(manila_generic, 'write_file')
+        self.patch_object(manila_generic.files, 'write_file')
         c.maybe_write_ssh_keys()
         self.assertEqual(self.write_file.call_count, 2)
         self.write_file.assert_has_calls(
@@ -235,40 +553,957 @@ class TestManilaGenericCharm(Helper):
              mock.call('my public key',
                        manila_generic.MANILA_SSH_KEY_PATH_PUBLIC,
                        0o644)])
+        # the keys are written if any of the backends uses ssh.
+        config['driver-auth-type'] = 'password'
+        config['backends'] = """
+            - name: fast
+            - name: bulk
+              driver-auth-type: ssh
+            """
+        c = manila_generic.ManilaGenericCharm()
+        self.write_file.reset_mock()
+        c.maybe_write_ssh_keys()
+        self.assertEqual(self.write_file.call_count, 2)
+
+    def test_maybe_write_ssh_keys_generated(self):
+        config = {
+            'driver-auth-type': 'ssh',
+            'driver-service-ssh-key': '',
+            'driver-service-ssh-key-public': '',
+        }
+        self._patch_config_and_charm(config)
+        key_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, key_dir)
+        key_path = os.path.join(key_dir, 'ssh_image_key-{}')
+        self.patch_object(manila_generic, 'GENERATED_SSH_KEY_PATH',
+                          new=key_path)
+        self.patch_object(manila_generic.files, 'remove_file',
+                          return_value=False)
+        self.patch_object(manila_generic.hookenv, 'is_leader',
+                          return_value=False)
+        self.patch_object(manila_generic, 'rotate_ssh_keys')
+        # a unit that isn't the leader waits for the leader's keys.
+        c = manila_generic.ManilaGenericCharm()
+        c.maybe_write_ssh_keys()
+        self.rotate_ssh_keys.assert_not_called()
+        # the leader generates them.
+        self.is_leader.return_value = True
+        self.rotate_ssh_keys.return_value = json.loads(generated_keys(1))
+        self.patch_object(manila_generic.files, 'write_file')
+        c.maybe_write_ssh_keys()
+        self.rotate_ssh_keys.assert_called_once_with()
+        # owned by manila, as manila-share reads them.
+        self.write_file.assert_has_calls([
+            mock.call('private key 1', key_path.format(1),
+                      owner='manila', group='manila'),
+            mock.call('public key 1', key_path.format(1) + '.pub', 0o644,
+                      owner='manila', group='manila')])
+        # every generation is installed, even if ssh is no longer used, and
+        # those that were pruned are removed.
+        self.write_file.reset_mock()
+        self.remove_file.reset_mock()
+        self.rotate_ssh_keys.reset_mock()
+        self.leader_settings['ssh-keys'] = generated_keys(2, 3)
+        for generation in (1, 2):
+            with open(key_path.format(generation), 'w'):
+                pass
+        config['driver-auth-type'] = 'password'
+        c = manila_generic.ManilaGenericCharm()
+        c.maybe_write_ssh_keys()
+        self.rotate_ssh_keys.assert_not_called()
+        self.assertEqual(
+            [call[0][1] for call in self.write_file.call_args_list],
+            [key_path.format(2), key_path.format(2) + '.pub',
+             key_path.format(3), key_path.format(3) + '.pub'])
+        self.remove_file.assert_has_calls([
+            mock.call(manila_generic.MANILA_SSH_KEY_PATH),
+            mock.call(manila_generic.MANILA_SSH_KEY_PATH_PUBLIC),
+            mock.call(key_path.format(1))])
+        self.assertEqual(self.remove_file.call_count, 3)
+
+
+class TestBackends(Helper):
+
+    def _options(self, **config):
+        options = {name.replace('-', '_'): value
+                   for name, value in default_config().items()}
+        options.update(config)
+        options = types.SimpleNamespace(**options)
+        options.computed_backends = manila_generic.computed_backends(options)
+        return options
+
+    def test_parse_backends_single(self):
+        options = self._options(driver_auth_type='both',
+                                driver_service_instance_password='pass')
+        backends = manila_generic.parse_backends(options)
+        self.assertEqual(len(backends), 1)
+        self.assertEqual(backends[0]['name'], 'generic')
+        self.assertEqual(backends[0]['driver_service_image_name'],
+                         'manila-service-image')
+        self.assertTrue(backends[0]['computed_use_password'])
+        self.assertTrue(backends[0]['computed_use_ssh'])
+        self.assertEqual(manila_generic.backend_names(options), 'generic')
+
+    def test_parse_backends(self):
+        options = self._options(
+            driver_service_instance_flavor_id=100,
+            backends="""
+                - name: fast
+                  driver-service-instance-flavor-id: 200
+                  driver-auth-type: ssh
+                - name: bulk
+                """)
+        fast, bulk = manila_generic.parse_backends(options)
+        self.assertEqual(fast['name'], 'fast')
+        self.assertEqual(fast['driver_service_instance_flavor_id'], 200)
+        self.assertTrue(fast['computed_use_ssh'])
+        self.assertEqual(bulk['name'], 'bulk')
+        self.assertEqual(bulk['driver_service_instance_flavor_id'], 100)
+        self.assertFalse(bulk['computed_use_ssh'])
+        self.assertEqual(manila_generic.backend_names(options), 'fast,bulk')
+
+    def test_parse_backends_invalid(self):
+        for backends, message in (
+                ('[', "not valid YAML"),
+                ('name: fast', "must be a list of backends"),
+                ('[]', "must be a list of backends"),
+                ('- fast', "each backend must have a 'name'"),
+                ('- driver-auth-type: ssh', "each backend must have a 'name'"),
+                ('[{name: a}, {name: a}]',
+                 "backend names must be unique strings"),
+                ('[{name: a, flavor: 1}]', "a: unknown option 'flavor'"),
+                ('[{name: a, driver-service-instance-flavor-id: big}]',
+                 "a: 'driver-service-instance-flavor-id' must be int"),
+                ('[{name: a, driver-handles-share-servers: 1}]',
+                 "a: 'driver-handles-share-servers' must be bool")):
+            with self.subTest(backends=backends):
+                options = self._options(backends=backends)
+                with self.assertRaises(ValueError) as e:
+                    manila_generic.parse_backends(options)
+                self.assertEqual(str(e.exception), message)
+                self.assertEqual(manila_generic.computed_backends(options),
+                                 [])
+                self.assertEqual(manila_generic.backend_names(options), '')
+
+    def test_check_backend(self):
+        options = self._options(
+            driver_handles_share_servers=False,
+            driver_service_image_name='',
+            driver_service_instance_user='',
+            driver_service_instance_flavor_id=0,
+            driver_service_instance_password='',
+            driver_keypair_name='')
+        backend, = manila_generic.parse_backends(options)
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options), [])
+        # every problem is reported, not just the first.
+        backend['driver_handles_share_servers'] = True
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["Missing 'driver-service-image-name'",
+             "Missing 'driver-service-instance-user'",
+             "Missing 'driver-service-instance-flavor-id'",
+             "Need at least one of instance password or keypair name"])
+        backend['driver_service_image_name'] = 'image'
+        backend['driver_service_instance_user'] = 'manila'
+        backend['driver_service_instance_flavor_id'] = 100
+        backend['driver_keypair_name'] = 'keypair'
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options), [])
+        backend['driver_ssh_conn_timeout'] = 1
+        backend['driver_max_share_server_size'] = -1
+        backend['driver_reserved_share_extend_percentage'] = 101
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-max-share-server-size' must not be negative",
+             "'driver-reserved-share-extend-percentage' must be between 0 "
+             "and 100",
+             "'driver-max-share-server-size' needs OpenStack wallaby or "
+             "later",
+             "'driver-reserved-share-extend-percentage' needs OpenStack zed "
+             "or later",
+             "'driver-ssh-conn-timeout' must be between 5 and 600"])
+        backend['driver_ssh_conn_timeout'] = 60
+        backend['driver_max_share_server_size'] = 100
+        backend['driver_reserved_share_extend_percentage'] = 0
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'victoria', options),
+            ["'driver-max-share-server-size' needs OpenStack wallaby or "
+             "later"])
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'wallaby', options), [])
+
+    def test_check_backend_auth(self):
+        options = self._options(driver_service_instance_flavor_id=100,
+                                driver_keypair_name='')
+        backend, = manila_generic.parse_backends(options)
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["Need at least one of instance password or keypair name"])
+        backend['driver_auth_type'] = 'keys'
+        backend['driver_keypair_name'] = 'keypair'
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-auth-type' must be one of both, password, ssh"])
+        backend['driver_auth_type'] = 'Both'
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-auth-type' password or both needs "
+             "'driver-service-instance-password'"])
+        # the SSH keys aren't needed: the leader generates them.
+        backend['driver_service_instance_password'] = 'pass'
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options), [])
+        # the auth options aren't used unless the driver handles share
+        # servers.
+        backend['driver_auth_type'] = 'password'
+        backend['driver_service_instance_password'] = ''
+        backend['driver_handles_share_servers'] = False
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options), [])
+
+    def test_check_backend_name(self):
+        message = ("The backend name must be letters, digits, '_', '.' or "
+                   "'-', and not one of DEFAULT, nova, neutron, cinder")
+        for name, violations in (
+                ('generic', []),
+                ('fast-1.2_b', []),
+                ('', [message]),
+                ('a b', [message]),
+                ('a]\n[DEFAULT', [message]),
+                ('fast\n', [message]),
+                ('DEFAULT', [message]),
+                ('Nova', [message])):
+            with self.subTest(name=name):
+                options = self._options(share_backend_name=name,
+                                        driver_handles_share_servers=False)
+                backend, = manila_generic.parse_backends(options)
+                self.assertEqual(
+                    manila_generic.check_backend(backend, 'mitaka', options),
+                    violations)
+        # so the unit is blocked rather than rendering a broken manila.conf.
+        options = self._options(backends="""
+            - name: fast
+            - name: cinder
+            """, driver_handles_share_servers=False)
+        self.assertEqual(
+            manila_generic.validate_config(options, 'mitaka'),
+            (manila_generic.parse_backends(options),
+             ("cinder: " + message,)))
+
+    def test_check_backend_share_server_cleanup(self):
+        options = self._options(driver_service_instance_flavor_id=100)
+        backend, = manila_generic.parse_backends(options)
+        self.assertTrue(backend['driver_automatic_share_server_cleanup'])
+        backend['driver_unused_share_server_cleanup_interval'] = 5
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-unused-share-server-cleanup-interval' must be between "
+             "10 and 60"])
+        backend['driver_unused_share_server_cleanup_interval'] = 30
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options), [])
+        backend['driver_automatic_share_server_cleanup'] = False
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-unused-share-server-cleanup-interval' needs "
+             "'driver-automatic-share-server-cleanup'"])
+        # there are no share servers to clean up.
+        backend['driver_handles_share_servers'] = False
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options), [])
+
+    def test_check_backend_release_options(self):
+        options = self._options(driver_handles_share_servers=False)
+        backend, = manila_generic.parse_backends(options)
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options), [])
+        backend['driver_max_shares_per_share_server'] = 10
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-max-shares-per-share-server' needs OpenStack wallaby "
+             "or later"])
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'caracal', options), [])
+        backend['driver_reserved_share_from_snapshot_percentage'] = 10
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'wallaby', options),
+            ["'driver-reserved-share-from-snapshot-percentage' needs "
+             "OpenStack xena or later"])
+        backend['driver_reserved_share_extend_percentage'] = 10
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'yoga', options),
+            ["'driver-reserved-share-extend-percentage' needs OpenStack zed "
+             "or later"])
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'zed', options), [])
+
+    def test_check_backend_network(self):
+        options = self._options(driver_service_instance_flavor_id=100,
+                                driver_keypair_name='keypair')
+        backend, = manila_generic.parse_backends(options)
+        self.assertIsNone(backend['computed_interface_driver'])
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options), [])
+        backend['driver_service_network_cidr'] = '10.254.0.1/16'
+        backend['driver_service_network_division_mask'] = 16
+        backend['driver_interface_driver'] = 'bridge'
+        backend['driver_admin_network_id'] = 'admin-net'
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-service-network-cidr' must be a network in CIDR "
+             "notation",
+             "'driver-interface-driver' must be one of linuxbridge, noop, "
+             "ovs",
+             "'driver-admin-network-id' and 'driver-admin-subnet-id' must "
+             "be set together",
+             "'driver-admin-network-id' must be a UUID"])
+        # the division mask is checked against manila's default network if
+        # the network isn't set.
+        backend['driver_service_network_cidr'] = ''
+        backend['driver_interface_driver'] = 'noop'
+        backend['driver_admin_network_id'] = (
+            '5a1f2c8e-3f43-4a4e-9a0e-2f4a1c7d9b10')
+        backend['driver_admin_subnet_id'] = (
+            '0b6e0f2d-7c1a-4d58-8f7e-5b2f9a3c4d21')
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-service-network-division-mask' must be longer than the "
+             "prefix of 'driver-service-network-cidr', leaving at least 4 "
+             "addresses in each subnet",
+             "'driver-interface-driver' noop needs OpenStack ussuri or "
+             "later"])
+        backend['driver_service_network_cidr'] = '192.168.0.0/24'
+        backend['driver_service_network_division_mask'] = 30
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'ussuri', options), [])
+        backend['driver_service_network_division_mask'] = 31
+        self.assertEqual(
+            len(manila_generic.check_backend(backend, 'ussuri', options)), 1)
+        backend['driver_service_network_cidr'] = 'fd00:254::/64'
+        backend['driver_service_network_division_mask'] = 120
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'ussuri', options), [])
+
+    def test_check_backend_volumes(self):
+        options = self._options(driver_handles_share_servers=False)
+        backend, = manila_generic.parse_backends(options)
+        backend['driver_cinder_volume_type'] = 'ssd'
+        backend['driver_volume_name_template'] = 'manila-fast-%s'
+        backend['driver_share_volume_fstype'] = 'ext3'
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options), [])
+        backend['driver_share_volume_fstype'] = 'xfs'
+        for template in ('manila-fast', 'manila-%s-%s', 'manila-%d',
+                         'manila-%'):
+            backend['driver_volume_name_template'] = template
+            self.assertEqual(
+                manila_generic.check_backend(backend, 'mitaka', options),
+                ["'driver-volume-name-template' must contain '%s' once, for "
+                 "the ID",
+                 "'driver-share-volume-fstype' must be one of ext3, ext4"])
+        backend['driver_volume_name_template'] = '100%%-%s'
+        backend['driver_share_volume_fstype'] = 'ext4'
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options), [])
+
+    def test_check_backend_capacity(self):
+        options = self._options(driver_handles_share_servers=False)
+        backend, = manila_generic.parse_backends(options)
+        backend['driver_reserved_share_percentage'] = 10
+        backend['driver_reserved_share_from_snapshot_percentage'] = 5
+        backend['driver_reserved_share_extend_percentage'] = 10
+        backend['driver_filter_function'] = 'share.size < 500'
+        backend['driver_goodness_function'] = '100'
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'zed', options), [])
+        # the other reservations may not be more than that of new shares.
+        backend['driver_reserved_share_percentage'] = 2
+        backend['driver_filter_function'] = 'share.size < 500\nor 1'
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'zed', options),
+            ["'driver-reserved-share-from-snapshot-percentage' must not be "
+             "more than 'driver-reserved-share-percentage'",
+             "'driver-reserved-share-extend-percentage' must not be more "
+             "than 'driver-reserved-share-percentage'",
+             "'driver-filter-function' must be on one line"])
+        # unless it isn't set, as manila reserves nothing for new shares.
+        backend['driver_reserved_share_percentage'] = 0
+        backend['driver_filter_function'] = 'share.size < 500\n'
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'zed', options), [])
+        backend['driver_reserved_share_percentage'] = 101
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-reserved-share-percentage' must be between 0 and 100",
+             "'driver-reserved-share-extend-percentage' needs OpenStack zed "
+             "or later",
+             "'driver-reserved-share-from-snapshot-percentage' needs "
+             "OpenStack xena or later"])
+
+    def test_parse_backends_performance_profile(self):
+        fast, bulk = manila_generic.parse_backends(self._options(
+            driver_performance_profile='burst',
+            driver_max_time_to_attach=200,
+            backends="""
+                - name: fast
+                - name: bulk
+                  driver-performance-profile: large-fleet
+                  driver-ssh-max-pool-conn: 60
+                """))
+        burst = manila_generic.PERFORMANCE_PROFILES['burst']
+        self.assertEqual(fast['driver_max_time_to_build_instance'],
+                         burst['driver-max-time-to-build-instance'])
+        self.assertEqual(fast['driver_ssh_max_pool_conn'],
+                         burst['driver-ssh-max-pool-conn'])
+        self.assertEqual(fast['driver_max_time_to_attach'], 200)
+        large = manila_generic.PERFORMANCE_PROFILES['large-fleet']
+        self.assertEqual(bulk['driver_ssh_min_pool_conn'],
+                         large['driver-ssh-min-pool-conn'])
+        self.assertEqual(bulk['driver_ssh_max_pool_conn'], 60)
+        self.assertEqual(bulk['driver_max_time_to_attach'], 200)
+
+    def test_check_backend_performance_options(self):
+        # the profiles must be valid themselves.
+        for profile in manila_generic.PERFORMANCE_PROFILES:
+            options = self._options(driver_handles_share_servers=False,
+                                    driver_performance_profile=profile)
+            backend, = manila_generic.parse_backends(options)
+            self.assertEqual(
+                manila_generic.check_backend(backend, 'mitaka', options), [])
+        # the performance options aren't checked against an unknown profile.
+        options = self._options(driver_handles_share_servers=False,
+                                driver_performance_profile='fast')
+        backend, = manila_generic.parse_backends(options)
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-performance-profile' must be one of burst, default, "
+             "large-fleet"])
+        options = self._options(driver_handles_share_servers=False,
+                                driver_max_time_to_build_instance=10,
+                                driver_ssh_min_pool_conn=20,
+                                driver_ssh_max_pool_conn=10)
+        backend, = manila_generic.parse_backends(options)
+        self.assertEqual(
+            manila_generic.check_backend(backend, 'mitaka', options),
+            ["'driver-max-time-to-build-instance' must be between 60 and "
+             "7200",
+             "'driver-ssh-min-pool-conn' must not be more than "
+             "'driver-ssh-max-pool-conn'"])
+
+    def test_validate_config(self):
+        options = self._options(driver_service_ssh_key='key',
+                                driver_handles_share_servers=False)
+        backends, violations = manila_generic.validate_config(options,
+                                                              'mitaka')
+        self.assertEqual([b['name'] for b in backends], ['generic'])
+        self.assertEqual(
+            violations,
+            ("'driver-service-ssh-key' and 'driver-service-ssh-key-public' "
+             "must be set together",))
+        options = self._options(backends="""
+            - name: fast
+              driver-service-instance-flavor-id: 0
+            - name: bulk
+              driver-handles-share-servers: false
+              driver-ssh-conn-timeout: 1
+            """)
+        backends, violations = manila_generic.validate_config(options,
+                                                              'mitaka')
+        self.assertEqual(len(backends), 2)
+        self.assertEqual(
+            violations,
+            ("fast: Missing 'driver-service-instance-flavor-id'",
+             "bulk: 'driver-ssh-conn-timeout' must be between 5 and 600"))
+        options = self._options(relation_payload_format='json',
+                                driver_handles_share_servers=False)
+        self.assertEqual(
+            manila_generic.validate_config(options, 'mitaka')[1],
+            ("'relation-payload-format' must be one of both, string, "
+             "structured",))
+        options = self._options(client_endpoint_type='internal',
+                                client_timeout=-1,
+                                driver_handles_share_servers=False)
+        self.assertEqual(
+            manila_generic.validate_config(options, 'mitaka')[1],
+            ("'client-endpoint-type' must be one of adminURL, internalURL, "
+             "publicURL",
+             "'client-timeout' must not be negative"))
+        options = self._options(log_levels='generic=LOUD ssh',
+                                log_rate_limit_interval=10,
+                                log_rate_limit_except_level='fatal',
+                                driver_handles_share_servers=False)
+        self.assertEqual(
+            manila_generic.validate_config(options, 'mitaka')[1],
+            ("'log-levels' must be name=value pairs, with values one of "
+             "DEBUG, INFO, WARNING, ERROR, CRITICAL",
+             "'log-rate-limit-interval' and 'log-rate-limit-burst' must be "
+             "set together",
+             "'log-rate-limit-except-level' must be one of critical, debug, "
+             "error, info, warning",
+             "'log-rate-limit-interval' needs OpenStack pike or later"))
+        options = self._options(log_levels='generic=debug',
+                                log_rate_limit_interval=10,
+                                log_rate_limit_burst=100,
+                                log_rate_limit_except_level='error',
+                                driver_handles_share_servers=False)
+        self.assertEqual(
+            manila_generic.validate_config(options, 'pike')[1], ())
+        options = self._options(share_service_inithost_offload=True,
+                                driver_handles_share_servers=False)
+        self.assertEqual(
+            manila_generic.validate_config(options, 'victoria')[1],
+            ("'share-service-inithost-offload' needs OpenStack wallaby or "
+             "later",))
+        self.assertEqual(
+            manila_generic.validate_config(options, 'wallaby')[1], ())
+        options = self._options(backends='- name: [')
+        self.assertEqual(manila_generic.validate_config(options, 'mitaka'),
+                         ([], ("Invalid 'backends': not valid YAML",)))
+
+
+class TestRenderTemplate(Helper):
+
+    def setUp(self):
+        super().setUp()
+        self.charm_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.charm_path)
+        self.patch_object(manila_generic.hookenv, 'charm_dir',
+                          return_value=self.charm_path)
+        self.patch('charmhelpers.contrib.openstack.templating.get_loader',
+                   name='get_loader', side_effect=get_loader)
+        self.patch_object(manila_generic, 'TEMPLATES_DIR', new=TEMPLATES_DIR)
+        self.patch_object(manila_generic, '_template_environments', new={})
+
+    @staticmethod
+    def _context(**config):
+        """Return the template context for the config, which overrides the
+        defaults; the config keys are the option names with '_' for '-'.
+        """
+        options = {name.replace('-', '_'): value
+                   for name, value in default_config().items()}
+        options.update({
+            'driver_service_instance_flavor_id': 100,
+            'driver_auth_type': 'password',
+            'driver_service_instance_password': 'secret',
+        })
+        options.update(config)
+        options = types.SimpleNamespace(**options)
+        options.computed_backends = manila_generic.parse_backends(options)
+        options.computed_ssh_keys = manila_generic.computed_ssh_keys(options)
+        options.computed_default_log_levels = (
+            manila_generic.computed_default_log_levels(options))
+        auth_data = {
+            'username': 'manila',
+            'password': 'pass',
+            'project_domain_name': 'pd1',
+            'project_name': 'p1',
+            'user_domain_name': 'ud1',
+            'auth_uri': 'uri1',
+            'auth_url': 'url1',
+            'auth_type': 'password',
+        }
+        return {
+            'options': options,
+            'manila_plugin': types.SimpleNamespace(
+                authentication_data=auth_data),
+        }
+
+    def test_render_template(self):
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context())
+        self.get_loader.assert_called_once_with(TEMPLATES_DIR, 'mitaka')
+        for line in ('[nova]', '[neutron]', '[cinder]', '[generic]',
+                     'username = manila',
+                     'service_instance_flavor_id = 100',
+                     'service_instance_password = secret',
+                     'max_time_to_build_instance = 300',
+                     'max_time_to_attach = 120',
+                     'ssh_max_pool_conn = 10'):
+            self.assertIn(line, rendered)
+        self.assertNotIn('path_to_private_key', rendered)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka',
+            self._context(driver_handles_share_servers=False))
+        self.assertNotIn('[nova]', rendered)
+        self.assertIn('driver_handles_share_servers = False', rendered)
+        self.assertIn('[generic]', rendered)
+        self.assertNotIn('max_time_to_build_instance', rendered)
+        self.assertIn('max_time_to_create_volume = 180', rendered)
+        # the environment, and so the loader, is reused.
+        self.get_loader.assert_called_once_with(TEMPLATES_DIR, 'mitaka')
+
+    def test_render_template_backends(self):
+        self.leader_settings['ssh-keys'] = generated_keys(1, 2)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context(backends="""
+                - name: fast
+                  driver-service-instance-flavor-id: 200
+                  driver-auth-type: ssh
+                - name: bulk
+                - name: simple
+                  driver-handles-share-servers: false
+                """))
+        # the nova, neutron and cinder sections are only rendered once.
+        for section in ('[nova]', '[neutron]', '[cinder]', '[fast]',
+                        '[bulk]', '[simple]'):
+            self.assertEqual(rendered.count(section), 1)
+        fast = rendered[rendered.index('[fast]'):rendered.index('[bulk]')]
+        self.assertIn('service_instance_flavor_id = 200', fast)
+        # the SSH keys generated by the leader are used.
+        self.assertIn('path_to_private_key = /etc/manila/ssh_image_key-2\n',
+                      fast)
+        self.assertIn(
+            'path_to_public_key = /etc/manila/ssh_image_key-2.pub\n', fast)
+        self.assertIn('manila_service_keypair_name = manila-service-2\n',
+                      fast)
+        self.assertNotIn('service_instance_password', fast)
+        bulk = rendered[rendered.index('[bulk]'):rendered.index('[simple]')]
+        self.assertIn('service_instance_flavor_id = 100', bulk)
+        self.assertIn('service_instance_password = secret', bulk)
+        simple = rendered[rendered.index('[simple]'):]
+        self.assertIn('driver_handles_share_servers = False', simple)
+        # without a backend that handles share servers, no nova etc.
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context(backends="""
+                - name: a
+                  driver-handles-share-servers: false
+                - name: b
+                  driver-handles-share-servers: false
+                """))
+        self.assertNotIn('[nova]', rendered)
+        self.assertIn('[a]', rendered)
+        self.assertIn('[b]', rendered)
+
+    def test_render_template_release(self):
+        context = self._context(driver_max_shares_per_share_server=10,
+                                driver_max_share_server_size=500)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'victoria', context)
+        self.assertNotIn('max_shares_per_share_server', rendered)
+        self.assertNotIn('max_share_server_size', rendered)
+        for release in ('wallaby', 'caracal'):
+            rendered = manila_generic.render_template(
+                'manila.conf', release, context)
+            self.assertIn('max_shares_per_share_server = 10', rendered)
+            self.assertIn('max_share_server_size = 500', rendered)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'caracal', self._context())
+        self.assertNotIn('max_shares_per_share_server', rendered)
+
+    def test_render_template_share_server_cleanup(self):
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context())
+        self.assertNotIn('share_server_cleanup', rendered)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context(
+                driver_unused_share_server_cleanup_interval=30))
+        self.assertIn('unused_share_server_cleanup_interval = 30', rendered)
+        self.assertNotIn('automatic_share_server_cleanup', rendered)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context(
+                driver_automatic_share_server_cleanup=False))
+        self.assertIn('automatic_share_server_cleanup = False', rendered)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context(
+                driver_handles_share_servers=False,
+                driver_automatic_share_server_cleanup=False))
+        self.assertNotIn('share_server_cleanup', rendered)
+
+    def test_render_template_release_capacity(self):
+        context = self._context(
+            driver_reserved_share_from_snapshot_percentage=5,
+            driver_reserved_share_extend_percentage=10)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'wallaby', context)
+        self.assertNotIn('reserved_share', rendered)
+        # each option is rendered from the release that supports it, by the
+        # templates of the closest release at or before the one running.
+        rendered = manila_generic.render_template(
+            'manila.conf', 'yoga', context)
+        self.assertIn('reserved_share_from_snapshot_percentage = 5', rendered)
+        self.assertNotIn('reserved_share_extend_percentage', rendered)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'caracal', context)
+        self.assertIn('reserved_share_from_snapshot_percentage = 5', rendered)
+        self.assertIn('reserved_share_extend_percentage = 10', rendered)
+
+    def test_render_template_service_clients(self):
+        # by default, the client sections are as they were before the
+        # client-* options, so that manila.conf doesn't change on upgrade.
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context())
+        for option in ('endpoint_type', 'region_name', 'timeout', 'cafile',
+                       'insecure'):
+            self.assertNotIn('\n{} = '.format(option), rendered)
+        # the region is given on the relation, unless it is set by config.
+        context = self._context(client_endpoint_type='internalURL',
+                                client_timeout=30,
+                                client_ca_file='/etc/ssl/certs/ca.pem',
+                                client_insecure=True)
+        context['manila_plugin'].authentication_data['region'] = 'RegionOne'
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', context)
+        for section in ('[nova]', '[neutron]', '[cinder]'):
+            client = rendered.split(section)[1].split('[')[0]
+            for line in ('endpoint_type = internalURL\n',
+                         'region_name = RegionOne\n',
+                         'timeout = 30\n',
+                         'cafile = /etc/ssl/certs/ca.pem\n',
+                         'insecure = True\n'):
+                self.assertIn(line, client)
+        context['options'].client_region_name = 'RegionTwo'
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', context)
+        self.assertEqual(rendered.count('region_name = RegionTwo\n'), 3)
+        # not without a backend that handles share servers.
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context(
+                driver_handles_share_servers=False))
+        self.assertNotIn('endpoint_type', rendered)
+
+    def test_render_template_logging(self):
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context())
+        self.assertNotIn('[DEFAULT]', rendered)
+        # in either driver mode.
+        for dhss in (True, False):
+            rendered = manila_generic.render_template(
+                'manila.conf', 'caracal', self._context(
+                    log_levels='service-instance=DEBUG',
+                    log_rate_limit_interval=30,
+                    log_rate_limit_burst=200,
+                    log_rate_limit_except_level='error',
+                    driver_handles_share_servers=dhss))
+            default = rendered.split('[DEFAULT]\n')[1].split('[')[0]
+            self.assertIn('default_log_levels = amqp=WARN,', default)
+            self.assertIn(
+                ',manila.share.drivers.service_instance=DEBUG\n', default)
+            for line in ('rate_limit_interval = 30\n',
+                         'rate_limit_burst = 200\n',
+                         'rate_limit_except_level = ERROR\n'):
+                self.assertIn(line, default)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'caracal', self._context(
+                log_rate_limit_interval=30,
+                log_rate_limit_burst=200))
+        self.assertNotIn('default_log_levels', rendered)
+        self.assertNotIn('rate_limit_except_level', rendered)
+        self.assertIn('[DEFAULT]\nrate_limit_interval = 30\n',
+                      rendered.replace('\n\n', '\n'))
+
+    def test_render_template_share_service(self):
+        context = self._context(share_service_inithost_offload=True)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'victoria', context)
+        self.assertNotIn('share_service_inithost_offload', rendered)
+        for release in ('wallaby', 'caracal'):
+            rendered = manila_generic.render_template(
+                'manila.conf', release, context)
+            default = rendered.split('[DEFAULT]\n')[1].split('[')[0]
+            self.assertIn('share_service_inithost_offload = True\n', default)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'caracal', self._context())
+        self.assertNotIn('[DEFAULT]', rendered)
+
+    def test_render_template_capacity(self):
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context())
+        for option in ('reserved_share_percentage', 'filter_function',
+                       'goodness_function'):
+            self.assertNotIn(option, rendered)
+        # in both driver modes, on every release.
+        for release in ('mitaka', 'caracal'):
+            rendered = manila_generic.render_template(
+                'manila.conf', release, self._context(
+                    driver_reserved_share_percentage=10,
+                    driver_reserved_share_from_snapshot_percentage=5,
+                    driver_filter_function='share.size < 500',
+                    backends="""
+                        - name: fast
+                          driver-goodness-function: '100'
+                        - name: simple
+                          driver-handles-share-servers: false
+                        """))
+            self.assertEqual(
+                rendered.count('reserved_share_percentage = 10\n'), 2)
+            self.assertEqual(
+                rendered.count('filter_function = share.size < 500\n'), 2)
+            self.assertEqual(rendered.count('goodness_function = 100\n'), 1)
+            self.assertEqual(
+                rendered.count('reserved_share_from_snapshot_percentage'),
+                0 if release == 'mitaka' else 2)
+
+    def test_render_template_network(self):
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context())
+        for option in ('service_network_cidr', 'interface_driver',
+                       'admin_network_id'):
+            self.assertNotIn(option, rendered)
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context(
+                driver_service_network_cidr='10.20.0.0/16',
+                driver_service_network_division_mask=26,
+                driver_interface_driver='linuxbridge',
+                driver_admin_network_id='admin-net',
+                driver_admin_subnet_id='admin-subnet'))
+        for line in ('service_network_cidr = 10.20.0.0/16\n',
+                     'service_network_division_mask = 26\n',
+                     'interface_driver = '
+                     'manila.network.linux.interface.BridgeInterfaceDriver\n',
+                     'admin_network_id = admin-net\n',
+                     'admin_subnet_id = admin-subnet\n'):
+            self.assertIn(line, rendered)
+        # not without share servers to connect.
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context(
+                driver_handles_share_servers=False,
+                driver_interface_driver='linuxbridge'))
+        self.assertNotIn('interface_driver', rendered)
+
+    def test_render_template_volumes(self):
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context())
+        for option in ('cinder_volume_type', 'volume_name_template',
+                       'share_volume_fstype'):
+            self.assertNotIn(option, rendered)
+        # in both driver modes, and for each backend.
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context(
+                driver_cinder_volume_type='standard',
+                backends="""
+                    - name: fast
+                      driver-cinder-volume-type: ssd
+                      driver-volume-name-template: manila-fast-%s
+                      driver-share-volume-fstype: ext3
+                    - name: simple
+                      driver-handles-share-servers: false
+                    """))
+        fast = rendered[rendered.index('[fast]'):rendered.index('[simple]')]
+        for line in ('cinder_volume_type = ssd\n',
+                     'volume_name_template = manila-fast-%s\n',
+                     'share_volume_fstype = ext3\n'):
+            self.assertIn(line, fast)
+        simple = rendered[rendered.index('[simple]'):]
+        self.assertIn('cinder_volume_type = standard\n', simple)
+        self.assertNotIn('volume_name_template', simple)
+
+    def test_structured_config(self):
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context())
+        structured = manila_generic.structured_config(rendered)
+        self.assertEqual(structured['version'],
+                         manila_generic.STRUCTURED_PAYLOAD_VERSION)
+        sections = structured['sections']
+        self.assertEqual(list(sections),
+                         ['cinder', 'generic', 'neutron', 'nova'])
+        # the credentials are only sent once.
+        cinder = sections['cinder']
+        self.assertEqual(cinder['options']['username'], 'manila')
+        self.assertEqual(cinder['options']['auth_type'], 'password')
+        for name in ('neutron', 'nova'):
+            self.assertEqual(sections[name],
+                             {'hash': cinder['hash'], 'same-as': 'cinder'})
+        options = sections['generic']['options']
+        self.assertEqual(list(options), sorted(options))
+        self.assertEqual(options['service_instance_flavor_id'], '100')
+        self.assertEqual(options['share_driver'],
+                         'manila.share.drivers.generic.GenericShareDriver')
+        # layout and ordering don't change the hashes; the options do.
+        reordered = ('[generic]\n' + '\n'.join(
+            '{}={}'.format(k, v) for k, v in reversed(options.items())) +
+            '\n')
+        self.assertEqual(
+            manila_generic.structured_config(
+                reordered)['sections']['generic']['hash'],
+            sections['generic']['hash'])
+        changed = manila_generic.structured_config(
+            manila_generic.render_template(
+                'manila.conf', 'mitaka',
+                self._context(driver_max_time_to_attach=200)))
+        self.assertNotEqual(changed['hash'], structured['hash'])
+        self.assertNotEqual(changed['sections']['generic']['hash'],
+                            sections['generic']['hash'])
+        self.assertEqual(changed['sections']['cinder'], cinder)
+
+    def test_principal_payload(self):
+        rendered = '[generic]\nshare_backend_name = generic\n'
+        self.assertEqual(
+            manila_generic.principal_payload(rendered, 'string'),
+            {manila_generic.MANILA_CONF: rendered})
+        structured = manila_generic.structured_config(rendered)
+        self.assertEqual(
+            manila_generic.principal_payload(rendered, 'structured'),
+            {manila_generic.STRUCTURED_PAYLOAD_KEY: structured})
+        self.assertEqual(
+            manila_generic.principal_payload(rendered, 'both'),
+            {manila_generic.MANILA_CONF: rendered,
+             manila_generic.STRUCTURED_PAYLOAD_KEY: structured})
+
+    def test_render_template_uses_compiled_cache(self):
+        rendered = manila_generic.render_template(
+            'manila.conf', 'mitaka', self._context())
+        self.assertTrue(os.listdir(
+            os.path.join(self.charm_path, manila_generic.TEMPLATE_CACHE_DIR)))
+        # A new environment, as in the next hook, must not compile the
+        # templates again.
+        manila_generic._template_environments.clear()
+        with mock.patch.object(jinja2.Environment, 'compile',
+                               side_effect=AssertionError('compiled')):
+            self.assertEqual(
+                manila_generic.render_template(
+                    'manila.conf', 'mitaka', self._context()),
+                rendered)
 
 
 class TestAuxilaryFunctions(Helper):
 
-    def test_write_file(self):
-        f = mock.MagicMock()
-        self.patch_object(manila_generic.os, 'fdopen', return_value=f)
-        self.patch_object(manila_generic.os, 'open', return_value='opener')
-        text = """
-            This
-            One"""
-        # strip the first new line off when passing the test string through
-        # this is to test dedenting strings
-        manila_generic.write_file(text[1:], 'file1')
-        self.open.assert_called_once_with(
-            'file1',
-            manila_generic.os.O_WRONLY | manila_generic.os.O_CREAT,
-            0o600)
-        self.fdopen.assert_called_once_with('opener', 'w')
-        f.__enter__().write.assert_called_once_with("This\nOne")
-
-    def test_write_file_private(self):
-        f = mock.MagicMock()
-        self.patch_object(manila_generic.os, 'fdopen', return_value=f)
-        self.patch_object(manila_generic.os, 'open', return_value='opener')
-        text = """
-            This
-            Two"""
-        # strip the first new line off when passing the test string through
-        # this is to test dedenting strings
-        manila_generic.write_file(text[1:], 'file1', chown=0o644)
-        self.open.assert_called_once_with(
-            'file1',
-            manila_generic.os.O_WRONLY | manila_generic.os.O_CREAT,
-            0o644)
-        self.fdopen.assert_called_once_with('opener', 'w')
-        f.__enter__().write.assert_called_once_with("This\nTwo")
+    def test_template_files(self):
+        self.patch_object(manila_generic.os, 'walk', return_value=[
+            ('templates/', ['mitaka'], ['README']),
+            ('templates/mitaka', [], ['manila.conf'])])
+        self.assertEqual(manila_generic.template_files(),
+                         ['templates/README', 'templates/mitaka/manila.conf'])
+
+    def test_generate_ssh_keypair(self):
+        def ssh_keygen(cmd):
+            path = cmd[cmd.index('-f') + 1]
+            for suffix, key in (('', 'private'), ('.pub', 'public')):
+                with open(path + suffix, 'w') as f:
+                    f.write(key)
+
+        self.patch('subprocess.check_call', name='check_call',
+                   side_effect=ssh_keygen)
+        self.assertEqual(manila_generic.generate_ssh_keypair(),
+                         ('private', 'public'))
+        cmd = self.check_call.call_args[0][0]
+        self.assertEqual(cmd[:7], ['ssh-keygen', '-q', '-t', 'rsa', '-b',
+                                   '4096', '-m'])
+        # the keys are generated in a directory that is removed.
+        self.assertFalse(os.path.exists(os.path.dirname(cmd[-1])))
+
+    def test_leader_get(self):
+        self.leader_get.return_value = 'value'
+        self.assertEqual(manila_generic.leader_get('key'), 'value')
+        self.assertEqual(manila_generic.leader_get('key'), 'value')
+        self.leader_get.assert_called_once_with('key')
+
+    def test_rotate_ssh_keys(self):
+        self.patch_object(manila_generic.hookenv, 'leader_set')
+        self.patch_object(manila_generic, 'generate_ssh_keypair',
+                          side_effect=[('private key 1', 'public key 1'),
+                                       ('private key 2', 'public key 2'),
+                                       ('private key 3', 'public key 3')])
+        keys = manila_generic.rotate_ssh_keys()
+        self.assertEqual(keys, json.loads(generated_keys(1)))
+        self.assertEqual(manila_generic.generated_ssh_keys(), keys)
+        # the earlier generations are kept, unless they are pruned.
+        self.assertEqual(manila_generic.rotate_ssh_keys(),
+                         json.loads(generated_keys(1, 2)))
+        self.assertEqual(manila_generic.rotate_ssh_keys(prune=True),
+                         json.loads(generated_keys(3)))
+        self.assertEqual(manila_generic.generated_ssh_keys()['current'], 3)
+        self.leader_set.assert_called_with(
+            {'ssh-keys': json.dumps(json.loads(generated_keys(3)),
+                                    sort_keys=True)})
+        self.leader_get.assert_called_once_with('ssh-keys')
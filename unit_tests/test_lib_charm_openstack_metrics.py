@@ -0,0 +1,171 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import types
+
+import charm.openstack.manila_generic as manila_generic
+import charm.openstack.metrics as metrics
+
+import charms_openstack.test_utils as test_utils
+
+from unit_tests.helpers import (
+    default_config,
+)
+
+
+def backends(**config):
+    options = {name.replace('-', '_'): value
+               for name, value in default_config().items()}
+    options.update({'driver_service_instance_flavor_id': 100,
+                    'driver_auth_type': 'password',
+                    'driver_service_instance_password': 'secret'})
+    options.update(config)
+    return manila_generic.parse_backends(types.SimpleNamespace(**options))
+
+
+class TestMetrics(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(metrics, '_current', new={})
+        self.patch_object(metrics, '_started', new=None)
+        self.textfile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.textfile_dir)
+        self.config = {'prometheus-textfile-dir': self.textfile_dir}
+        self.patch_object(metrics.hookenv, 'config', name='hookenv_config',
+                          side_effect=self.config.get)
+        self.patch_object(metrics.hookenv, 'hook_name',
+                          return_value='config-changed')
+        self.kv = {}
+        self.patch_object(metrics.unitdata, 'kv', name='unitdata_kv')
+        self.unitdata_kv.return_value.get.side_effect = self.kv.get
+        self.unitdata_kv.return_value.set.side_effect = self.kv.__setitem__
+
+    def _read(self):
+        with open(os.path.join(self.textfile_dir,
+                               metrics.TEXTFILE_NAME)) as f:
+            return f.read()
+
+    def test_register(self):
+        self.patch_object(metrics.hookenv, 'atexit')
+        metrics.register()
+        self.atexit.assert_called_once_with(metrics.write_textfile)
+        self.assertIsNotNone(metrics._started)
+
+    def test_hook_work(self):
+        self.assertEqual(metrics.hook_work(),
+                         {'renders': 0, 'status_checks': 0})
+        with metrics.render_timer():
+            pass
+        metrics.record_check(None, None)
+        metrics.record_check(None, None)
+        self.assertEqual(metrics.hook_work(),
+                         {'renders': 1, 'status_checks': 2})
+
+    def test_write_textfile_disabled(self):
+        self.config['prometheus-textfile-dir'] = ''
+        metrics.write_textfile()
+        self.assertEqual(os.listdir(self.textfile_dir), [])
+        self.assertEqual(self.kv, {})
+
+    def test_write_textfile(self):
+        metrics.register()
+        metrics.record_check(None, None)
+        metrics.record_backends(backends())
+        with metrics.render_timer():
+            pass
+        metrics.record_published(True)
+        metrics.write_textfile()
+        text = self._read()
+        self.assertEqual(
+            stat.S_IMODE(os.stat(os.path.join(
+                self.textfile_dir, metrics.TEXTFILE_NAME)).st_mode),
+            0o644)
+        for line in (
+                '# TYPE manila_generic_hook_duration_seconds summary',
+                'manila_generic_hook_duration_seconds_count'
+                '{hook="config-changed"} 1',
+                'manila_generic_hook_renders{hook="config-changed"} 1',
+                'manila_generic_hook_status_checks{hook="config-changed"} 1',
+                'manila_generic_config_published 1',
+                'manila_generic_config_published_total 1',
+                'manila_generic_config_check{state="ok",message=""} 1',
+                'manila_generic_backend_info{backend="generic",'
+                'driver_handles_share_servers="true",auth_type="password",'
+                'performance_profile="default"} 1',
+                'manila_generic_backend_setting{backend="generic",'
+                'setting="service_instance_flavor_id"} 100',
+                'manila_generic_backend_setting{backend="generic",'
+                'setting="max_time_to_build_instance"} 300'):
+            self.assertIn(line, text)
+        self.assertIn('manila_generic_render_duration_seconds ', text)
+        self.assertIn('manila_generic_config_published_timestamp_seconds ',
+                      text)
+        # the secrets of the backends are never exported.
+        self.assertNotIn('secret', text)
+
+        # the next hook, e.g. update-status, doesn't check or render, so the
+        # values from the last hook that did are written.
+        metrics._current.clear()
+        self.hook_name.return_value = 'update-status'
+        metrics.write_textfile()
+        text = self._read()
+        for line in (
+                'manila_generic_hook_duration_seconds_count'
+                '{hook="config-changed"} 1',
+                'manila_generic_hook_duration_seconds_count'
+                '{hook="update-status"} 1',
+                'manila_generic_hook_renders{hook="config-changed"} 1',
+                'manila_generic_hook_renders{hook="update-status"} 0',
+                'manila_generic_hook_status_checks{hook="update-status"} 0',
+                'manila_generic_config_published 0',
+                'manila_generic_config_published_total 1',
+                'manila_generic_config_check{state="ok",message=""} 1',
+                'manila_generic_backend_setting{backend="generic",'
+                'setting="service_instance_flavor_id"} 100'):
+            self.assertIn(line, text)
+        self.unitdata_kv.return_value.flush.assert_called_with()
+
+    def test_write_textfile_started(self):
+        # the update-status fast path times the hook from its entry.
+        self.patch_object(metrics.time, 'perf_counter', return_value=20.0)
+        metrics.write_textfile(12.5)
+        self.assertIn('manila_generic_hook_last_duration_seconds'
+                      '{hook="config-changed"} 7.5', self._read())
+
+    def test_format_metrics_escapes(self):
+        metrics.record_check('blocked', 'Missing "x"\nand \\y')
+        metrics.record_backends(backends(backends="""
+            - name: fast
+              driver-performance-profile: burst
+            - name: bulk
+              driver-handles-share-servers: false
+            """))
+        text = metrics.format_metrics(metrics._merge({}, 'install', 1.5, 0))
+        self.assertIn(
+            'manila_generic_config_check{state="blocked",'
+            'message="Missing \\"x\\"\\nand \\\\y"} 1', text)
+        self.assertIn('backend="fast",driver_handles_share_servers="true",'
+                      'auth_type="password",performance_profile="burst"',
+                      text)
+        self.assertIn('backend="bulk",driver_handles_share_servers="false"',
+                      text)
+        self.assertIn('manila_generic_hook_last_duration_seconds'
+                      '{hook="install"} 1.5', text)
+        # nothing was published, so there is no timestamp.
+        self.assertNotIn('published_timestamp', text)
@@ -0,0 +1,137 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import charm.openstack.profiling as profiling
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestProfiling(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.log = os.path.join(self.tmpdir, 'profile', 'hook-profile.log')
+        self.patch_object(profiling, 'PROFILE_LOG', new=self.log)
+        self.patch_object(profiling, '_record', new=None)
+        self.patch_object(profiling.hookenv, 'config')
+        self.patch_object(profiling.hookenv, 'hook_name',
+                          return_value='config-changed')
+        self.patch_object(profiling.hookenv, 'atexit')
+        self.patch_object(profiling.status, 'charm_revision',
+                          return_value={'version': 'abc'})
+        # make sure the logger is set up for this test's log file.
+        logger = logging.getLogger('manila-generic.profile')
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
+    def test_stage_disabled(self):
+        self.config.return_value = False
+        with profiling.stage('render'):
+            pass
+        self.assertIsNone(profiling._record)
+        self.atexit.assert_not_called()
+
+    def test_stage_and_write_record(self):
+        self.config.return_value = True
+
+        @profiling.stage('decorated')
+        def decorated():
+            pass
+
+        with profiling.stage('render'):
+            pass
+        with profiling.stage('render'):
+            decorated()
+        self.config.assert_called_with('profile-hooks')
+        self.atexit.assert_called_once_with(profiling.write_record)
+        self.assertEqual(list(profiling._record['stages'].keys()),
+                         ['render', 'decorated'])
+        profiling.write_record()
+        self.assertIsNone(profiling._record)
+        with open(self.log) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['hook'], 'config-changed')
+        self.assertEqual(records[0]['revision'], 'abc')
+        self.assertEqual(sorted(records[0]['stages'].keys()),
+                         ['decorated', 'render'])
+        self.assertGreaterEqual(records[0]['stages']['render'],
+                                records[0]['stages']['decorated'])
+        self.assertIn('peak_memory', records[0])
+        self.assertIn('duration', records[0])
+
+    def test_register(self):
+        self.config.return_value = False
+        profiling.register()
+        self.assertIsNone(profiling._record)
+        self.atexit.assert_not_called()
+        self.config.return_value = True
+        profiling.register()
+        record = profiling._record
+        self.assertEqual(record['stages'], {})
+        self.atexit.assert_called_once_with(profiling.write_record)
+        # the stages are added to the record started at registration.
+        with profiling.stage('render'):
+            pass
+        self.assertIs(profiling._record, record)
+        self.assertEqual(list(record['stages'].keys()), ['render'])
+        self.atexit.assert_called_once_with(profiling.write_record)
+        profiling.write_record()
+
+    def test_read_records(self):
+        os.makedirs(os.path.dirname(self.log))
+        with open(self.log + '.1', 'w') as f:
+            f.write('{"hook": "install"}\n')
+        with open(self.log, 'w') as f:
+            f.write('not json\n{"hook": "update-status"}\n')
+        self.assertEqual(list(profiling.read_records(self.log)),
+                         [{'hook': 'install'}, {'hook': 'update-status'}])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(profiling.percentile(values, 50), 50)
+        self.assertEqual(profiling.percentile(values, 99), 99)
+        self.assertEqual(profiling.percentile(values, 100), 100)
+        self.assertEqual(profiling.percentile(values, 0), 1)
+        self.assertEqual(profiling.percentile([5], 90), 5)
+
+    def test_summarise(self):
+        records = [
+            {'hook': 'config-changed', 'revision': 'abc', 'duration': 1.0,
+             'peak_memory': 100, 'stages': {'render': 0.5}},
+            {'hook': 'config-changed', 'revision': 'abc', 'duration': 3.0,
+             'peak_memory': 300, 'stages': {'render': 1.5}},
+            {'hook': 'update-status', 'revision': 'def', 'duration': 0.1,
+             'peak_memory': 10, 'stages': {}},
+        ]
+        summary = profiling.summarise(records)
+        self.assertEqual(sorted(summary.keys()),
+                         ['config-changed', 'update-status'])
+        self.assertEqual(summary['config-changed']['duration'],
+                         {'count': 2, 'p50': 1.0, 'p90': 3.0, 'p99': 3.0,
+                          'max': 3.0})
+        self.assertEqual(summary['config-changed']['stages']['render']['p50'],
+                         0.5)
+        self.assertEqual(summary['update-status']['peak-memory']['max'], 10)
+        self.assertEqual(list(profiling.summarise(records, 'def').keys()),
+                         ['update-status'])
@@ -0,0 +1,210 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import types
+from unittest import mock
+
+import yaml
+
+import charm.openstack.recording as recording
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestRecording(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.trace = os.path.join(self.tmpdir, 'trace', 'hook-trace.log')
+        self.patch_object(recording, 'TRACE_LOG', new=self.trace)
+        self.patch_object(recording, '_started', new=None)
+        self.charm_config = {'record-hooks': True,
+                             'driver-service-instance-password': 'secret',
+                             'driver-service-ssh-key': '',
+                             'driver-service-ssh-key-public': 'public key'}
+        self.patch_object(recording.hookenv, 'config',
+                          side_effect=lambda key=None: (
+                              self.charm_config if key is None
+                              else self.charm_config.get(key)))
+        self.patch_object(recording.hookenv, 'hook_name',
+                          return_value='config-changed')
+        self.patch_object(recording.hookenv, 'atexit')
+        self.patch_object(recording.hookenv, 'is_leader', return_value=True)
+        self.patch_object(recording.hookenv, 'leader_get',
+                          return_value={'ssh-keys': json.dumps(
+                              {'current': 1,
+                               'keys': {'1': {'private': 'private key',
+                                              'public': 'public key'}}})})
+        self.patch('charms.reactive.get_flags', name='get_flags',
+                   return_value={'manila-plugin.available',
+                                 'config.changed'})
+        self.patch_object(recording.status, 'charm_revision',
+                          return_value={'version': 'abc'})
+        self.endpoint = types.SimpleNamespace(
+            authentication_data={'username': 'manila', 'password': 'pass'},
+            name='generic',
+            configuration_data={
+                '/etc/manila/manila.conf':
+                    '[generic]\nservice_instance_password = secret\n'
+                    'service_instance_user = manila\n'})
+        self.patch('charms.reactive.relations.endpoint_from_flag',
+                   name='endpoint_from_flag', return_value=self.endpoint,
+                   create=True)
+
+    def test_redact(self):
+        self.assertEqual(recording.redact({
+            'password': 'pass',
+            'driver-service-ssh-key': 'key',
+            'driver-service-ssh-key-public': 'public key',
+            'driver-service-instance-password': '',
+            'nested': [{'auth_token': 'token', 'username': 'manila'}],
+            'json': '{"keys": {"1": {"private": "key", "public": "pub"}}}',
+            'ini': '[nova]\npassword = pass\nusername = manila\n',
+            'number': 1,
+        }), {
+            'password': 'REDACTED',
+            'driver-service-ssh-key': 'REDACTED',
+            'driver-service-ssh-key-public': 'public key',
+            # an empty secret is left empty.
+            'driver-service-instance-password': '',
+            'nested': [{'auth_token': 'REDACTED', 'username': 'manila'}],
+            'json': '{"keys": {"1": {"private": "REDACTED", '
+                    '"public": "pub"}}}',
+            'ini': '[nova]\npassword = REDACTED\nusername = manila\n',
+            'number': 1,
+        })
+        self.assertEqual(recording.redact('[not json'), '[not json')
+        # the backends are YAML, of options named as the config's.
+        backends = ('- name: fast\n'
+                    '  driver-service-instance-password: hunter2\n'
+                    '  driver-service-ssh-key: key\n'
+                    '- name: bulk\n'
+                    '  driver-service-instance-password: ""\n')
+        redacted = recording.redact({'backends': backends})['backends']
+        self.assertNotIn('hunter2', redacted)
+        self.assertEqual(yaml.safe_load(redacted), [
+            {'name': 'fast',
+             'driver-service-instance-password': 'REDACTED',
+             'driver-service-ssh-key': 'REDACTED'},
+            {'name': 'bulk',
+             'driver-service-instance-password': ''}])
+        # as set, if there are no secrets in them.
+        backends = '- name: fast  # the fast one\n'
+        self.assertEqual(recording.redact({'backends': backends}),
+                         {'backends': backends})
+        # and line by line, if they aren't valid YAML.
+        self.assertEqual(
+            recording.redact({'backends': '- name: [\n'
+                                          '  driver-service-instance-password:'
+                                          ' hunter2\n'}),
+            {'backends': '- name: [\n'
+                         '  driver-service-instance-password: REDACTED\n'})
+        # the hashes of the structured configuration are of its secrets.
+        self.assertEqual(recording.redact({
+            'version': 1,
+            'hash': 'abc',
+            'sections': {
+                'nova': {'hash': 'def',
+                         'options': {'password': 'pass', 'username': 'a'}},
+                'cinder': {'hash': 'def', 'same-as': 'nova'},
+            },
+            'hash-of-nothing': {'hash': 'ghi'},
+        }), {
+            'version': 1,
+            'sections': {
+                'nova': {'options': {'password': 'REDACTED',
+                                     'username': 'a'}},
+                'cinder': {'same-as': 'nova'},
+            },
+            'hash-of-nothing': {'hash': 'ghi'},
+        })
+
+    def test_register_disabled(self):
+        self.charm_config['record-hooks'] = False
+        recording.register()
+        self.assertIsNone(recording._started)
+        self.atexit.assert_not_called()
+        recording.write_record()
+        self.assertFalse(os.path.exists(self.trace))
+
+    def test_register_and_write_record(self):
+        recording.register()
+        self.atexit.assert_called_once_with(recording.write_record)
+        # the flags and leader settings are those the hook started with.
+        self.get_flags.return_value = set()
+        self.leader_get.return_value = {}
+        recording.write_record()
+        self.assertIsNone(recording._started)
+        recording.register()
+        recording.write_record()
+        records = list(recording.read_records(self.trace))
+        self.assertEqual(len(records), 2)
+        record = records[0]
+        self.assertEqual(record['hook'], 'config-changed')
+        self.assertEqual(record['revision'], 'abc')
+        self.assertTrue(record['leader'])
+        self.assertEqual(record['flags'],
+                         ['config.changed', 'manila-plugin.available'])
+        self.assertEqual(
+            json.loads(record['leader_settings']['ssh-keys'])['keys']['1'],
+            {'private': 'REDACTED', 'public': 'public key'})
+        self.assertEqual(record['config']['driver-service-instance-password'],
+                         'REDACTED')
+        self.assertEqual(record['manila_plugin'], {
+            'authentication_data': {'username': 'manila',
+                                    'password': 'REDACTED'},
+            'published': {
+                'name': 'generic',
+                'configuration_data': {
+                    '/etc/manila/manila.conf':
+                        '[generic]\nservice_instance_password = REDACTED\n'
+                        'service_instance_user = manila\n'}}})
+        self.assertEqual(records[1]['flags'], [])
+        # only root may read the trace, whatever the umask.
+        self.assertEqual(os.stat(self.trace).st_mode & 0o777, 0o600)
+        # nothing secret is in the trace.
+        with open(self.trace) as f:
+            text = f.read()
+        for secret in ('secret', 'pass"', 'private key'):
+            self.assertNotIn(secret, text)
+
+    def test_write_record_no_relation(self):
+        self.endpoint_from_flag.return_value = None
+        recording.register()
+        recording.write_record()
+        record, = recording.read_records(self.trace)
+        self.assertIsNone(record['manila_plugin'])
+
+    def test_write_record_fails(self):
+        self.patch_object(recording.hookenv, 'log')
+        recording.register()
+        with mock.patch.object(recording.os, 'makedirs',
+                               side_effect=OSError('read-only')):
+            recording.write_record()
+        self.log.assert_called_once_with(
+            "Couldn't record the hook: read-only",
+            level=recording.hookenv.WARNING)
+
+    def test_read_records(self):
+        os.makedirs(os.path.dirname(self.trace))
+        with open(self.trace, 'w') as f:
+            f.write('{"hook": "install"}\n{"hook": "conf\n')
+        self.assertEqual(list(recording.read_records(self.trace)),
+                         [{'hook': 'install'}])
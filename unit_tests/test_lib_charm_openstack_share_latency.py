@@ -0,0 +1,177 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+
+import charm.openstack.share_latency as share_latency
+
+import charms_openstack.test_utils as test_utils
+
+FIXTURE_LOG = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'manila-share.log')
+
+SINCE = datetime.datetime(2024, 5, 1)
+UNTIL = datetime.datetime(2024, 5, 2)
+
+
+def fixture_lines():
+    with open(FIXTURE_LOG) as f:
+        return f.readlines()
+
+
+class TestShareLatency(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+
+    def test_measure(self):
+        report = share_latency.measure(fixture_lines(), SINCE, UNTIL)
+        self.assertEqual(report['since'], '2024-05-01 00:00:00')
+        self.assertEqual(report['until'], '2024-05-02 00:00:00')
+        stages = report['stages']
+        self.assertEqual(sorted(stages), ['service-instance', 'ssh-ready',
+                                          'volume-attach', 'volume-create'])
+        # the service instance built in the window, and the one that failed;
+        # those before and after the window aren't counted.
+        self.assertEqual(stages['service-instance']['count'], 1)
+        self.assertEqual(stages['service-instance']['failures'], 1)
+        self.assertEqual(stages['service-instance']['max'], 80.0)
+        # SSH is timed from the first check while the service instance is
+        # built; the check of an existing service instance isn't timed.
+        self.assertEqual(stages['ssh-ready']['count'], 1)
+        self.assertEqual(stages['ssh-ready']['max'], 10.0)
+        self.assertEqual(stages['ssh-ready']['failures'], 0)
+        self.assertEqual(stages['volume-create']['count'], 2)
+        self.assertEqual(stages['volume-create']['max'], 40.0)
+        self.assertGreaterEqual(stages['volume-create']['p50'], 30.0)
+        self.assertLess(stages['volume-create']['p50'], 33.0)
+        self.assertEqual(stages['volume-create']['p99'], 40.0)
+        # the attach that timed out is timed, and its failure (repeated in
+        # the traceback) counted once.
+        self.assertEqual(stages['volume-attach']['count'], 2)
+        self.assertEqual(stages['volume-attach']['failures'], 1)
+        self.assertEqual(stages['volume-attach']['max'], 120.0)
+
+    def test_measure_window(self):
+        report = share_latency.measure(
+            fixture_lines(), datetime.datetime(2024, 5, 1, 10, 30), UNTIL)
+        stages = report['stages']
+        self.assertEqual(stages['service-instance']['count'], 0)
+        self.assertNotIn('p50', stages['service-instance'])
+        self.assertEqual(stages['volume-create']['count'], 1)
+        self.assertEqual(stages['volume-attach']['count'], 1)
+        report = share_latency.measure(
+            fixture_lines(), SINCE, datetime.datetime(2024, 5, 1, 11))
+        self.assertEqual(report['stages']['volume-attach']['count'], 1)
+        self.assertEqual(report['stages']['volume-attach']['failures'], 0)
+
+    def test_measure_forgets_stale(self):
+        # stages that never end are forgotten, so memory is bounded.
+        lines = (
+            "2024-05-01 10:{:02d}:{:02d}.000 1 DEBUG manila.share.drivers."
+            "generic [req-{:08d}-0000-0000-0000-000000000000 - - - - -] "
+            "Creating share server 'srv'.\n".format(n // 60, n % 60, n)
+            for n in range(3600))
+        self.patch_object(share_latency, 'MAX_PENDING', new=10)
+        self.patch_object(share_latency, '_forget_stale',
+                          wraps=share_latency._forget_stale)
+        share_latency.measure(lines, SINCE, UNTIL)
+        pending = self._forget_stale.call_args[0][0]
+        self.assertEqual(len(pending), 10)
+
+    def test_keywords(self):
+        # each alternative of each pattern can be found by its keyword.
+        for stage in share_latency.STAGES:
+            for kind in ('start', 'end', 'failure'):
+                for alternative in getattr(stage, kind).split('|'):
+                    with self.subTest(stage=stage.name, kind=kind,
+                                      alternative=alternative):
+                        self.assertTrue(any(
+                            keyword in alternative
+                            for keyword in share_latency.KEYWORDS))
+
+    def test_log_files(self):
+        path = os.path.join(self.log_dir, 'manila-share.log')
+        self.assertEqual(share_latency.log_files(path), [])
+        for name in ('manila-share.log', 'manila-share.log.1',
+                     'manila-share.log.2.gz', 'manila-share.log.10.gz',
+                     'manila-share.log.old'):
+            open(os.path.join(self.log_dir, name), 'w').close()
+        self.assertEqual(share_latency.log_files(path),
+                         [path + '.10.gz', path + '.2.gz', path + '.1', path])
+
+    def test_read_lines_rotated(self):
+        path = os.path.join(self.log_dir, 'manila-share.log')
+        lines = fixture_lines()
+        # the oldest lines are compressed, as logrotate leaves them.
+        with gzip.open(path + '.2.gz', 'wt') as f:
+            f.writelines(lines[:10])
+        with open(path + '.1', 'w') as f:
+            f.writelines(lines[10:20])
+        with open(path, 'w') as f:
+            f.writelines(lines[20:])
+        self.assertEqual(
+            list(share_latency.read_lines(share_latency.log_files(path))),
+            lines)
+        self.assertEqual(
+            share_latency.measure(
+                share_latency.read_lines(share_latency.log_files(path)),
+                SINCE, UNTIL),
+            share_latency.measure(lines, SINCE, UNTIL))
+        # files last written before the window are skipped.
+        os.utime(path + '.2.gz', (0, 0))
+        self.assertEqual(
+            list(share_latency.read_lines(share_latency.log_files(path),
+                                          since=SINCE)),
+            lines[10:])
+
+    def test_histogram(self):
+        histogram = share_latency.Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        for seconds in range(1, 101):
+            histogram.add(float(seconds))
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.max, 100.0)
+        # percentiles are accurate to the width of a bucket.
+        for pct in (50, 90, 99):
+            self.assertGreaterEqual(histogram.percentile(pct), pct)
+            self.assertLess(histogram.percentile(pct), pct * 1.1)
+        self.assertEqual(histogram.percentile(100), 100.0)
+        histogram.add(0.0)
+        histogram.add(10 ** 9)
+        self.assertEqual(histogram.buckets[0], 1)
+        self.assertEqual(histogram.buckets[-1], 1)
+
+    def test_window(self):
+        now = datetime.datetime(2024, 5, 2, 12)
+        self.assertEqual(share_latency.window(now=now),
+                         (datetime.datetime(2024, 5, 1, 12), now))
+        self.assertEqual(
+            share_latency.window(since='2024-05-01', until='2024-05-01 10:30',
+                                 now=now),
+            (datetime.datetime(2024, 5, 1),
+             datetime.datetime(2024, 5, 1, 10, 30)))
+        self.assertEqual(
+            share_latency.window(since='2024-05-01 10:30:15', now=now)[0],
+            datetime.datetime(2024, 5, 1, 10, 30, 15))
+        with self.assertRaises(ValueError):
+            share_latency.window(since='yesterday', now=now)
+        with self.assertRaises(ValueError):
+            share_latency.window(since='2024-05-03', now=now)
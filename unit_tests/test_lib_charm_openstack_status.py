@@ -0,0 +1,139 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+
+import charm.openstack.manila_generic as manila_generic
+import charm.openstack.metrics as metrics
+import charm.openstack.profiling as profiling
+import charm.openstack.recording as recording
+import charm.openstack.status as status
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestStatus(test_utils.PatchHelper):
+
+    def test_charm_revision(self):
+        self.patch_object(status.hookenv, 'charm_dir',
+                          return_value='/charm')
+
+        def fake_open(path):
+            if path == '/charm/version':
+                return mock.mock_open(read_data='abc123')()
+            raise OSError("No such file")
+
+        self.patch('builtins.open', name='open', side_effect=fake_open)
+        self.assertEqual(status.charm_revision(), {'version': 'abc123'})
+
+    def test_is_flag_set(self):
+        self.patch_object(status.unitdata, 'kv')
+        self.kv.return_value.getrange.return_value = {
+            'manila-plugin.connected': None}
+        self.assertTrue(status.is_flag_set('manila-plugin.connected'))
+        self.assertFalse(status.is_flag_set('manila-plugin.available'))
+        self.kv.return_value.getrange.assert_called_with(
+            'reactive.states.', strip=True)
+        self.kv.return_value.getrange.return_value = None
+        self.assertFalse(status.is_flag_set('manila-plugin.connected'))
+
+    def _patch_status_inputs(self):
+        config = {'share-backend-name': 'generic'}
+        self.patch_object(status.hookenv, 'config', return_value=config)
+        flags = set()
+        self.patch_object(status, 'is_flag_set',
+                          side_effect=flags.__contains__)
+        self.patch_object(status, 'charm_revision',
+                          return_value={'version': 'abc123'})
+        self.patch_object(status.os, 'stat')
+        self.stat.return_value.st_mtime = 1000.0
+        leader_settings = {}
+        self.patch_object(status.hookenv, 'leader_get',
+                          side_effect=leader_settings.get)
+        return config, flags, leader_settings
+
+    def test_status_fingerprint(self):
+        config, flags, leader_settings = self._patch_status_inputs()
+        fingerprint = status.status_fingerprint()
+        self.assertEqual(status.status_fingerprint(), fingerprint)
+        # a change of any of the inputs changes the fingerprint.
+        config['share-backend-name'] = 'other'
+        self.assertNotEqual(status.status_fingerprint(), fingerprint)
+        config['share-backend-name'] = 'generic'
+        flags.add('manila-plugin.connected')
+        self.assertNotEqual(status.status_fingerprint(), fingerprint)
+        flags.clear()
+        # the leader generated the SSH keys that the driver waits for.
+        leader_settings['ssh-keys'] = '{"current": 1}'
+        self.assertNotEqual(status.status_fingerprint(), fingerprint)
+        leader_settings.clear()
+        self.stat.return_value.st_mtime = 2000.0
+        self.assertNotEqual(status.status_fingerprint(), fingerprint)
+        self.stat.side_effect = OSError('no dpkg')
+        self.assertNotEqual(status.status_fingerprint(), fingerprint)
+        self.stat.side_effect = None
+        self.stat.return_value.st_mtime = 1000.0
+        self.charm_revision.return_value = {'version': 'def456'}
+        self.assertNotEqual(status.status_fingerprint(), fingerprint)
+
+    def test_status_leader_settings(self):
+        self.assertIn(manila_generic.SSH_KEYS_LEADER_KEY,
+                      status.STATUS_LEADER_SETTINGS)
+
+    def _patch_kv(self):
+        kv = {}
+        self.patch_object(status.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = kv.get
+        self.kv.return_value.set.side_effect = kv.__setitem__
+        return kv
+
+    def test_save_and_restore_status(self):
+        config, flags, leader_settings = self._patch_status_inputs()
+        self._patch_kv()
+        self.patch_object(status.hookenv, 'status_get',
+                          return_value=('active', 'Unit is ready'))
+        self.patch_object(status.hookenv, 'status_set')
+        # nothing saved yet, so the status needs assessing.
+        self.assertFalse(status.restore_status())
+        status.save_status()
+        self.kv.return_value.flush.assert_called_once_with()
+        self.assertTrue(status.restore_status())
+        self.status_set.assert_called_once_with('active', 'Unit is ready')
+        # the inputs changed, so the saved status is stale.
+        self.status_set.reset_mock()
+        config['debug'] = True
+        self.assertFalse(status.restore_status())
+        self.status_set.assert_not_called()
+
+    def test_update_status(self):
+        self.patch_object(status, 'restore_status', return_value=True)
+        self.patch_object(profiling, 'enabled', return_value=False)
+        self.patch_object(recording, 'enabled', return_value=False)
+        self.patch_object(metrics, 'write_textfile')
+        self.patch_object(status.unitdata, 'kv')
+        self.assertTrue(status.update_status(12.5))
+        self.write_textfile.assert_called_once_with(12.5)
+        self.kv.return_value.flush.assert_called_once_with()
+        # the status needs assessing, by the reactive handlers.
+        self.write_textfile.reset_mock()
+        self.restore_status.return_value = False
+        self.assertFalse(status.update_status())
+        self.write_textfile.assert_not_called()
+        # as does a hook that is profiled or recorded.
+        self.restore_status.return_value = True
+        for instrumented in (profiling, recording):
+            with mock.patch.object(instrumented, 'enabled',
+                                   return_value=True):
+                self.assertFalse(status.update_status())
+        self.write_textfile.assert_not_called()
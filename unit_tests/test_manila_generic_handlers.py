@@ -23,17 +23,23 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
 
     def test_hooks(self):
         defaults = [
-            'charm.installed',
-            'update-status']
+            'charm.installed']
         hook_set = {
+            'hook': {
+                'update_status': ('update-status', ),
+                'leader_settings_changed': ('leader-settings-changed', ),
+            },
             'when': {
                 'send_config': ('manila-plugin.changed', ),
                 'update_config': ('manila-plugin.available',
                                   'config.changed', ),
+                'update_ssh_keys': ('manila-plugin.available',
+                                    handlers.LEADER_SETTINGS_CHANGED, ),
             },
             'when_not': {
                 'send_config': ('config.changed', 'update-status'),
                 'update_config': ('update-status', ),
+                'update_ssh_keys': ('config.changed', 'update-status'),
             },
         }
         # test that the hooks were registered via the
@@ -43,6 +49,10 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
 
 class TestHandlerFunctions(test_utils.PatchHelper):
 
+    def setUp(self):
+        super().setUp()
+        self.patch_object(handlers.profiling, 'enabled', return_value=False)
+
     def _patch_provide_charm_instance(self):
         manila_generic_charm = mock.MagicMock()
         self.patch('charms_openstack.charm.provide_charm_instance',
@@ -58,24 +68,48 @@ class TestHandlerFunctions(test_utils.PatchHelper):
 
         class FakeManilaPlugin(object):
 
-            name = None
-            configuration_data = None
-            authentication_data = 'auth data'
-
             _clear_changed = 0
 
             def clear_changed(self):
                 self._clear_changed += 1
 
-        generic.get_config_for_principal.return_value = "some data"
         manila_plugin = FakeManilaPlugin()
+        self.patch_object(handlers.charms.reactive, 'clear_flag')
         handlers.send_config(manila_plugin)
 
         # test for expecations
-        self.assertEqual(manila_plugin.name,
-                         generic.options.share_backend_name)
-        self.assertEqual(manila_plugin.configuration_data, "some data")
-        generic.get_config_for_principal.assert_called_once_with('auth data')
+        generic.publish_config_to_principal.assert_called_once_with(
+            manila_plugin)
         generic.assess_status.assert_called_once_with()
         generic.maybe_write_ssh_keys.assert_called_once_with()
+        # the keys are written before the configuration using them.
+        self.assertEqual([name for name, _, _ in generic.mock_calls][:2],
+                         ['maybe_write_ssh_keys',
+                          'publish_config_to_principal'])
         self.assertEqual(manila_plugin._clear_changed, 1)
+        self.clear_flag.assert_called_once_with(
+            handlers.LEADER_SETTINGS_CHANGED)
+
+    def test_leader_settings_changed(self):
+        self.patch_object(handlers.charms.reactive, 'set_flag')
+        handlers.leader_settings_changed()
+        self.set_flag.assert_called_once_with(
+            handlers.LEADER_SETTINGS_CHANGED)
+
+    def test_update_status_restored(self):
+        generic = self._patch_provide_charm_instance()
+        self.patch_object(handlers.status, 'restore_status',
+                          return_value=True)
+        handlers.update_status()
+        self.restore_status.assert_called_once_with()
+        generic.assess_status.assert_not_called()
+
+    def test_update_status_assessed(self):
+        generic = self._patch_provide_charm_instance()
+        self.patch_object(handlers.status, 'restore_status',
+                          return_value=False)
+        self.patch_object(handlers.hookenv, 'application_version_set')
+        handlers.update_status()
+        self.application_version_set.assert_called_once_with(
+            generic.application_version)
+        generic.assess_status.assert_called_once_with()
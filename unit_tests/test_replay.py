@@ -0,0 +1,122 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import charm.openstack.recording as recording
+
+from unit_tests import helpers
+from unit_tests import replay
+from unit_tests import simulator
+
+CONNECTED = ['charm.installed', simulator.CONNECTED]
+AVAILABLE = CONNECTED + [simulator.AVAILABLE]
+
+
+def record(hook, flags, config=None, auth_data=None, published=None):
+    """Return a record of the hook, as the recorder writes it."""
+    full_config = helpers.default_config()
+    full_config.update(simulator.VALID_CONFIG)
+    full_config.update(config or {})
+    return recording.redact({
+        'hook': hook,
+        'timestamp': 0,
+        'revision': 'abc',
+        'duration': 0.5,
+        'leader': True,
+        'config': full_config,
+        'flags': sorted(flags),
+        'leader_settings': {},
+        'manila_plugin': ({'authentication_data': auth_data,
+                           'published': published}
+                          if simulator.CONNECTED in flags else None),
+    })
+
+
+def trace(published=None, flavor=100):
+    return [
+        record('install', []),
+        record('manila-plugin-relation-joined', CONNECTED),
+        record('manila-plugin-relation-changed', AVAILABLE,
+               auth_data=simulator.AUTH_DATA, published=published),
+        record('config-changed', AVAILABLE + ['config.changed'],
+               config={'driver-service-instance-flavor-id': flavor},
+               auth_data=simulator.AUTH_DATA, published=published),
+    ]
+
+
+class TestReplay(unittest.TestCase):
+
+    def test_replay(self):
+        results = replay.replay(trace())
+        self.assertEqual([r.hook for r in results],
+                         ['install', 'manila-plugin-relation-joined',
+                          'manila-plugin-relation-changed', 'config-changed'])
+        # the configuration is rendered and published once, and the status
+        # is checked at most once per hook.
+        self.assertEqual([r.renders for r in results], [0, 0, 1, 0])
+        self.assertEqual([r.relation_writes for r in results], [0, 0, 1, 0])
+        self.assertEqual([r.status_checks for r in results], [0, 0, 1, 1])
+        published = results[-1].published
+        self.assertEqual(published['name'], 'generic')
+        self.assertIn('password = REDACTED\n',
+                      published['configuration_data'][
+                          '/etc/manila/manila.conf'])
+        # nothing was recorded as published to compare with.
+        self.assertEqual([r.diff for r in results], [[], [], [], []])
+
+        # the recorded payload is compared with.
+        results = replay.replay(trace(published))
+        self.assertEqual([r.diff for r in results], [[], [], [], []])
+        results = replay.replay(trace(published, flavor=200))
+        self.assertEqual([bool(r.diff) for r in results],
+                         [False, False, False, True])
+        self.assertIn('-service_instance_flavor_id = 100', results[-1].diff)
+        self.assertIn('+service_instance_flavor_id = 200', results[-1].diff)
+
+    def test_replay_baseline(self):
+        baseline = replay.replay(trace())
+        results = replay.replay(trace(flavor=200), baseline=baseline)
+        self.assertEqual([bool(r.diff) for r in results],
+                         [False, False, False, True])
+        text = replay.format_results(results, baseline)
+        self.assertIn('DIFFERS', text)
+        self.assertIn('4 hooks in ', text)
+        self.assertIn('2 renders; 1 payloads differ', text)
+
+    def test_main(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        trace_path = os.path.join(tmpdir, 'hook-trace.log')
+        with open(trace_path, 'w') as f:
+            for r in trace():
+                f.write(json.dumps(r) + '\n')
+        report = os.path.join(tmpdir, 'report.json')
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(replay.main([trace_path, '--save', report]), 0)
+        self.assertIn('manila-plugin-relation-changed', stdout.getvalue())
+        self.assertEqual(len(replay.load_results(report)), 4)
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(
+                replay.main([trace_path, '--baseline', report]), 0)
+        self.assertIn('%', stdout.getvalue())
+        with mock.patch('sys.stderr', new_callable=io.StringIO), \
+                self.assertRaises(SystemExit):
+            replay.main([os.devnull, '--baseline', report])
@@ -0,0 +1,207 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import json
+import unittest
+from unittest import mock
+
+import charm.openstack.manila_generic as manila_generic
+
+from unit_tests import simulator
+from unit_tests.helpers import generated_keys
+
+# The random sequences run by the convergence test.
+RANDOM_SEEDS = range(10)
+
+SSH_CONFIG = {
+    'driver-auth-type': 'ssh',
+    'driver-service-ssh-key': 'private key',
+    'driver-service-ssh-key-public': 'public key',
+}
+
+
+def deploy():
+    return [simulator.install(), simulator.relation_joined(),
+            simulator.relation_changed()]
+
+
+class TestSimulator(unittest.TestCase):
+
+    def test_load_handlers(self):
+        handlers = {h.function.__name__: h[1:]
+                    for h in simulator.load_handlers()}
+        self.assertEqual(handlers, {
+            'update_status': (('update-status',), (), ()),
+            'send_config': ((), ('manila-plugin.changed',),
+                            ('config.changed', 'update-status')),
+            'update_config': ((), ('manila-plugin.available',
+                                   'config.changed'),
+                              ('update-status',)),
+            'leader_settings_changed': (('leader-settings-changed',), (), ()),
+            'update_ssh_keys': ((), ('manila-plugin.available',
+                                     'manila-generic.leader-settings.changed'),
+                                ('config.changed', 'update-status')),
+        })
+
+    def test_deploy(self):
+        report = simulator.simulate(deploy(), simulator.VALID_CONFIG)
+        self.assertEqual(report.problems, [])
+        self.assertTrue(report.converged)
+        self.assertEqual(report.status, ('active', 'Unit is ready'))
+        self.assertEqual((report.hooks, report.renders,
+                          report.relation_writes, report.key_writes),
+                         (4, 1, 1, 0))
+        self.assertEqual(report.relation_data['name'], 'generic')
+        self.assertIn('service_instance_flavor_id = 100',
+                      report.relation_data['configuration_data'][
+                          manila_generic.MANILA_CONF])
+
+    def test_config_changes(self):
+        report = simulator.simulate(
+            deploy() + [
+                # not rendered: nothing is published.
+                simulator.config_changed({'debug': True}),
+                # blocked: the configuration is withdrawn, once.
+                simulator.config_changed(
+                    {'driver-service-instance-flavor-id': 0}),
+                simulator.config_changed({'verbose': True}),
+                simulator.config_changed(
+                    {'driver-service-instance-flavor-id': 200}),
+            ],
+            simulator.VALID_CONFIG)
+        self.assertEqual(report.problems, [])
+        self.assertEqual((report.renders, report.relation_writes), (3, 3))
+        self.assertIn('service_instance_flavor_id = 200',
+                      report.relation_data['configuration_data'][
+                          manila_generic.MANILA_CONF])
+
+    def test_ssh_keys(self):
+        report = simulator.simulate(
+            deploy() + [
+                simulator.config_changed(SSH_CONFIG),
+                simulator.config_changed({'driver-performance-profile':
+                                          'burst'}),
+                simulator.config_changed({'driver-auth-type': 'password'}),
+            ],
+            simulator.VALID_CONFIG)
+        self.assertEqual(report.problems, [])
+        # the keys are written, then removed.
+        self.assertEqual(report.key_writes, 4)
+
+    def test_generated_ssh_keys(self):
+        with simulator.Simulation(simulator.VALID_CONFIG) as unit:
+            report = unit.run(deploy() + [
+                simulator.config_changed({'driver-auth-type': 'ssh'})])
+            self.assertEqual(report.problems, [])
+            self.assertEqual(report.status, ('active', 'Unit is ready'))
+            # the leader generated the keys, and installed them.
+            self.assertEqual(json.loads(unit.leader_settings['ssh-keys'])[
+                'current'], 1)
+            self.assertEqual(report.key_writes, 2)
+            self.assertIn('manila_service_keypair_name = manila-service-1',
+                          report.relation_data['configuration_data'][
+                              manila_generic.MANILA_CONF])
+            # the keys aren't generated, or written, again.
+            report = unit.run([simulator.config_changed(
+                {'driver-performance-profile': 'burst'})])
+            self.assertEqual(report.problems, [])
+            self.assertEqual(report.key_writes, 2)
+
+    def test_shared_ssh_keys(self):
+        config = dict(simulator.VALID_CONFIG, **{'driver-auth-type': 'ssh'})
+        with simulator.Simulation(config, leader=False) as unit:
+            report = unit.run(deploy())
+            self.assertEqual(
+                report.status,
+                ('waiting', "Waiting for the leader to generate the SSH "
+                            "keys"))
+            self.assertEqual(report.relation_data['configuration_data'], {})
+            report = unit.run([simulator.leader_settings_changed(
+                {'ssh-keys': generated_keys(1)})])
+            self.assertEqual(report.problems, [])
+            self.assertEqual(report.status, ('active', 'Unit is ready'))
+            # the counts are of every hook the unit ran.
+            self.assertEqual((report.key_writes, report.relation_writes),
+                             (2, 2))
+            # a rotation installs the new keys alongside the old, and
+            # publishes the configuration using them; pruning removes the
+            # old keys.
+            report = unit.run([
+                simulator.leader_settings_changed(
+                    {'ssh-keys': generated_keys(1, 2)}),
+                simulator.leader_settings_changed(
+                    {'ssh-keys': generated_keys(2)}),
+            ])
+            self.assertEqual(report.problems, [])
+            self.assertEqual((report.key_writes, report.relation_writes),
+                             (6, 3))
+            self.assertIn('path_to_private_key = '
+                          '/etc/manila/ssh_image_key-2\n',
+                          report.relation_data['configuration_data'][
+                              manila_generic.MANILA_CONF])
+
+    def test_relation_rejoined(self):
+        report = simulator.simulate(
+            deploy() + [simulator.relation_departed()] + deploy()[1:],
+            simulator.VALID_CONFIG)
+        self.assertEqual(report.problems, [])
+        # the new relation is given the configuration.
+        self.assertEqual(report.relation_writes, 2)
+
+    def test_random_sequences_converge(self):
+        for seed in RANDOM_SEEDS:
+            events, report = simulator.simulate_random(
+                seed, config=simulator.VALID_CONFIG)
+            with self.subTest(seed=seed, events=events):
+                self.assertEqual(report.problems, [])
+                self.assertTrue(report.converged)
+                self.assertEqual(report.settle_hooks, 1)
+
+    def test_flags_excess_writes(self):
+        # publishing regardless of the fingerprint writes the same
+        # configuration again.
+        publish = manila_generic.ManilaGenericCharm.publish_config_to_principal
+        with mock.patch.object(
+                manila_generic.ManilaGenericCharm,
+                'publish_config_to_principal',
+                new=functools.partialmethod(publish, force=True)):
+            report = simulator.simulate(
+                deploy() + [simulator.config_changed({'debug': True})],
+                simulator.VALID_CONFIG)
+        self.assertFalse(report.converged)
+        self.assertEqual(report.problems, ['1 writes changed nothing'])
+
+    def test_flags_not_quiescent(self):
+        # a relation change that is never handled.
+        with mock.patch.object(simulator.ManilaPluginEndpoint,
+                               'clear_changed'):
+            report = simulator.simulate(deploy(), simulator.VALID_CONFIG)
+        self.assertFalse(report.converged)
+        self.assertEqual(report.settle_hooks, simulator.MAX_SETTLE_HOOKS)
+        self.assertIn('not quiescent after 5 update-status hooks',
+                      report.problems)
+
+    def test_flags_repeated_work(self):
+        # without the memo, the status is checked for the render and again
+        # for the assessment at the end of the hook.
+        def memoised(self, name, key, compute):
+            return compute()
+        with mock.patch.object(manila_generic.ManilaGenericCharm,
+                               '_memoised', new=memoised):
+            report = simulator.simulate(deploy(), simulator.VALID_CONFIG)
+        self.assertFalse(report.converged)
+        self.assertEqual(
+            report.problems,
+            ['1 hooks rendered or checked the config more than once'])